@@ -4,24 +4,56 @@ This is the primary script to extract phenotypes from a stack of multiimage tif
 
 # %% Setup
 # Import these libraries (make sure they are installed)
-from plantcv import plantcv as pcv
-import importlib
+# plantcv and matplotlib are only imported by src/analysis/psII.py for the outputs that need them
+import argparse
+import glob
 import os
-from datetime import datetime, timedelta
-import cv2 as cv2
-import numpy as np
+from datetime import datetime
 import pandas as pd
-from matplotlib import pyplot as plt
 import warnings
 warnings.filterwarnings("ignore", module="matplotlib")
 warnings.filterwarnings("ignore", module='plotnine')
 
 # %% Import functions from src/ directory to get snaphots, create masks, and setup image classification
+from src.data import arraystore
 from src.data import import_snapshots
-from src.segmentation import createmasks
-from src.util import masked_stats
+from src.data import resultstore
+from src.data import validate
+from src.data import watchfolder
+from src.segmentation import roilayout
 from src.util import strip_whitespace
-from src.viz import add_scalebar, custom_colormaps
+from src.util import profiling
+from src.util import resultcache
+from src.viz import timelapse
+from src.analysis import level1
+from src.analysis import runner
+
+# %% Command line options
+# e.g. ipython scripts/ProcessImages.py -- --workers 8
+# parse_known_args so the script can still be run cell-by-cell in an interactive session
+parser = argparse.ArgumentParser(description='Extract phenotypes from multiframe tif files of the Imaging-PAM')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of processes. each process handles one sample-day at a time (default: 1)')
+parser.add_argument('--no-cache', dest='cache', action='store_false',
+                    help='reprocess every sample-day even if its input files and settings have not changed')
+parser.add_argument('--profile', action='store_true',
+                    help='record time, peak memory and bytes read/written of each stage and write a timing report to outdir/profile')
+parser.add_argument('--timelapse', action='store_true',
+                    help='make timelapse videos of each control x treatment pair of trays in outdir/timelapse, like scripts/makeVideos.R')
+parser.add_argument('--watch', action='store_true',
+                    help='after processing the existing files keep watching raw_multiframe/ and process each new tif as soon as it is completely written. stop with ctrl-c')
+parser.add_argument('--poll', type=float, default=2.,
+                    help='seconds between checks for new files with --watch (default: 2)')
+parser.add_argument('--shard', default=None, metavar='i/N',
+                    help='only process the i-th of N parts of the sample-days, e.g. --shard 2/4 on the second of 4 machines. the results are written to outdir/shards')
+parser.add_argument('--merge', action='store_true',
+                    help='combine the results of all shards in outdir/shards with the genotypes and write output_psII_level0.csv')
+args, _ = parser.parse_known_args()
+if args.shard is not None:
+    shard, nshards = (int(v) for v in args.shard.split('/'))
+    if not 1 <= shard <= nshards:
+        parser.error('--shard must be i/N with 1 <= i <= N')
+    shardname = '%dof%d' % (shard, nshards)
 
 # %% Setup the io directories
 indir = 'diy_data'
@@ -38,299 +70,67 @@ os.makedirs(fluordir, exist_ok=True)
 # This needs to be measured for the camera and working distance. With an ImagingPAM you could punch a leaf and then relate the number of pixels to the physical dimension.  See scripts/estimate_area_rgb.py for a method of getting pixel dimensions in ImageJ
 pixelresolution = 0.35
 
-# %% Import tif file information based on the filenames. If extract_frames=True it will save each frame form the multiframe TIF to a separate file in data/pimframes/ with a numeric suffix
-fdf = import_snapshots.import_snapshots(indir, 'psii', extract_frames=True)
-
-# %% Define the frames from the PSII measurements and merge this information with the filename information
+# %% Import tif file information based on the filenames. With read_multiframe=True the frames are read directly from the multiframe TIFs in raw_multiframe/.
+# The index of the TIFs is kept in outdir/manifest.sqlite so only new or changed files are opened. Delete it to rebuild the index from scratch
+# If you prefer to have each frame as a separate file in pimframes/ with a numeric suffix use read_multiframe=False, extract_frames=True
+# Each shard has its own manifest because sqlite files should not be written by several machines at once
+# Truncated, blank, saturated and duplicate TIFs are excluded before they are analyzed. if jobs_removed.csv isnt blank then you should investigate! see src/data/validate.py
+# Define the frames from the PSII measurements first so the number of pages of each TIF can be checked
 pimframes = pd.read_csv(os.path.join(
     indir, 'pimframes_map.csv'), skipinitialspace=True)
 pimframes = strip_whitespace.strip_dfwhitespace(pimframes)#this eliminate weird whitespace around any of the character fields
-fdf_dark = (pd.merge(fdf.reset_index(),
-                     pimframes,
-                     on=['imageid'],
-                     how='right'))
-
-# %% remove absorptivity measurements (frames 3 and 4) which are blank images in the default protocol
-df = (fdf_dark
-      .query('~parameter.str.contains("Abs") and ~parameter.str.contains("FRon")', engine='python')
-      )
-
-# %% remove the duplicate Fm and Fo frames where frame = Fmp or Fp (frames 5 and 6)
-df = df.query(
-    '(parameter!="FvFm") or (parameter=="FvFm" and (frame=="Fo" or frame=="Fm") )'
-)
 
-# %% Arrange dataframe of metadata so Fv/Fm comes first
-param_order = pimframes.parameter.unique()
-df['parameter'] = pd.Categorical(df.parameter,
-                                 categories=param_order,
-                                 ordered=True)
+# the files that are already in raw_multiframe/ before the import. anything exported during the run is picked up by --watch
+known = watchfolder.snapshot(os.path.join(indir, 'raw_multiframe'))
+manifestfn = os.path.join(outdir, 'manifest.sqlite' if args.shard is None else 'manifest-%s.sqlite' % shardname)
+checks = {'pimframes': pimframes,
+          'report': os.path.join(outdir, 'jobs_removed.csv' if args.shard is None else 'jobs_removed-%s.csv' % shardname),
+          'workers': args.workers}
+fdf = import_snapshots.import_snapshots(indir, 'psii', read_multiframe=True, manifest=manifestfn, validate=checks)
 
+# %% Merge with the filenames after removing
+# - absorptivity measurements (frames 3 and 4) which are blank images in the default protocol
+# - the duplicate Fm and Fo frames where frame = Fmp or Fp (frames 5 and 6)
+# and arrange the dataframe of metadata so Fv/Fm comes first. see src/analysis/runner.py
+df = runner.worklist(fdf, pimframes)
 
-# %% Setup Debug parmaeters
-# pcv.params.debug can be 'plot', 'print', or 'None'. 'plot' is useful if you are testing your pipeline over a few samples so you can see each step.
-pcv.params.debug = 'plot'  # 'print' #'plot', 'None'
-plt.rcParams["figure.figsize"] = (9, 9) #Figures will show 9x9inches which fits my monitor well.
-plt.rcParams["font.family"] = "Arial" # All text is Arial
 
 # %% The main analysis function
 # I like to reload my mask function to make sure it's the latest if I've been optimizing it
-# importlib.reload(createmasks)
-
-# This function takes a dataframe of metadata that was created above. We loop through each pair of images to compute photosynthetic parameters
-def image_avg(fundf):
-    # Predefine some variables
-    global c, h, roi_c, roi_h
-
-    # Get the filename for minimum and maximum fluoresence
-    fn_min = fundf.query('frame == "Fo" or frame == "Fp"').filename.values[0]
-    fn_max = fundf.query('frame == "Fm" or frame == "Fmp"').filename.values[0]
-
-    # Get the parameter name that links these 2 frames
-    param_name = fundf['parameter'].iloc[0]
-
-    # Create a new output filename that combines existing filename with parameter
-    outfn = os.path.splitext(os.path.basename(fn_max))[0]
-    outfn_split = outfn.split('-')
-    basefn = "-".join(outfn_split[0:-1])
-    outfn_split[-1] = param_name
-    outfn = "-".join(outfn_split)
-    print(outfn)
-
-    # Make some directories based on sample id to keep output organized
-    sampleid = outfn_split[2]
-    fmaxdir = os.path.join(fluordir, sampleid)
-    os.makedirs(fmaxdir, exist_ok=True)
-
-    # If debug mode is 'print', create a specific debug dir for each pim file
-    if pcv.params.debug == 'print':
-        debug_outdir = os.path.join(debugdir, outfn)
-        if not os.path.exists(debug_outdir):
-            os.makedirs(debug_outdir)
-        pcv.params.debug_outdir = debug_outdir
-
-    # read images and create mask from max fluorescence
-    # read image as is. only gray values in PSII images
-    imgmin, _, _ = pcv.readimage(fn_min)
-    img, _, _ = pcv.readimage(fn_max)
-    fdark = np.zeros_like(img)
-    out_flt = fdark.astype('float32')  # <- needs to be float32 for imwrite
-
-    # We always identify the leaf area using Fm and then apply the mask to subsequent frames in the induction curve for the same day and sample
-    if param_name == 'FvFm':
-        # create mask
-        mask = createmasks.psIImask(img)
-
-        # find objects and setup roi to designate where the plants should be
-        c, h = pcv.find_objects(img, mask)
-        roi_c, roi_h = pcv.roi.multi(img,
-                                     coord=(160, 90),
-                                     radius=30,
-                                     spacing=(160, 175),
-                                     ncols=3,
-                                     nrows=3)
-
-
-        #setup individual roi plant masks
-        newmask = np.zeros_like(mask)
-
-        # compute fv/fm and save to file
-        Fv, hist_fvfm = pcv.fluor_fvfm(
-            fdark=fdark, fmin=imgmin, fmax=img, mask=mask, bins=128)
-        YII = np.divide(Fv, img, out=out_flt.copy(),
-                        where=np.logical_and(mask > 0, img > 0))
-        cv2.imwrite(os.path.join(fmaxdir, outfn + '_fvfm.tif'), YII)
-
-        # NPQ is 0
-        NPQ = np.zeros_like(YII)
-
-        # print Fm
-        cv2.imwrite(os.path.join(fmaxdir, outfn + '_fmax.tif'), img)
-        # NPQ will always be an array of 0s
-
-
-    else: # compute YII and NPQ if parameter is other than FvFm
-        #use cv2 to read image becase pcv.readimage will save as input_image.png overwriting img
-        newmask = cv2.imread(os.path.join(
-            maskdir, basefn + '-FvFm_mask.png'), -1)
-
-        # compute YII
-        Fvp, hist_yii = pcv.fluor_fvfm(
-            fdark, fmin=imgmin, fmax=img, mask=newmask, bins=128)
-        # make sure to initialize with out=. using where= provides random values at False pixels. you will get a strange result. newmask comes from Fm instead of Fm' so they can be different
-        #newmask<0, img>0 = FALSE: not part of plant but fluorescence detected.
-        #newmask>0, img<=0 = FALSE: part of plant in Fm but no fluorescence detected <- this is likely the culprit because pcv.apply_mask doesn't always solve issue.
-        YII = np.divide(Fvp, img, out=out_flt.copy(),
-                        where=np.logical_and(newmask > 0, img > 0))
-        cv2.imwrite(os.path.join(fmaxdir, outfn + '_yii.tif'), YII)
-
-        # compute NPQ
-        Fm = cv2.imread(os.path.join(fmaxdir, basefn + '-FvFm_fmax.tif'), -1)
-        NPQ = np.divide(Fm, img, out=out_flt.copy(),
-                        where=np.logical_and(newmask > 0, img > 0))
-        NPQ = np.subtract(NPQ, 1, out=out_flt.copy(),
-                          where=np.logical_and(NPQ >= 1, newmask > 0))
-        cv2.imwrite(os.path.join(fmaxdir, outfn + '_npq.tif'), NPQ)
-    # end if-else Fv/Fm
-
-    # Make as many copies of incoming dataframe as there are ROIs so all results can be saved
-    outdf = fundf.copy()
-    for i in range(0, len(roi_c)-1):
-        outdf = outdf.append(fundf)
-    outdf.imageid = outdf.imageid.astype('uint8')
-
-    # Initialize lists to store variables for each ROI and iterate through each plant
-    frame_avg = []
-    yii_avg = []
-    yii_std = []
-    npq_avg = []
-    npq_std = []
-    plantarea = []
-    ithroi = []
-    inbounds = []
-    i = 0
-    rc = roi_c[i]
-    for i, rc in enumerate(roi_c):
-        # Store iteration Number
-        ithroi.append(int(i))
-        ithroi.append(int(i))  # append twice so each image has a value.
-        # extract ith hierarchy
-        rh = roi_h[i]
-
-        # Filter objects based on being in the defined ROI
-        # Filter objects based on being in the defined ROI
-        roi_obj, hierarchy_obj, submask, obj_area = pcv.roi_objects(
-            img,
-            roi_contour=rc,
-            roi_hierarchy=rh,
-            object_contour=c,
-            obj_hierarchy=h,
-            roi_type='partial')
-
-        if obj_area > 0:
-            # Combine multiple plant objects within an roi together
-            plant_contour, plant_mask = pcv.object_composition(
-                img=img, contours=roi_obj, hierarchy=hierarchy_obj)
-
-            #combine plant masks after roi filter
-            if param_name == 'FvFm':
-                newmask = pcv.image_add(newmask, plant_mask)
-
-            # Calc mean and std dev of fluoresence, YII, and NPQ and save to list
-            frame_avg.append(masked_stats.mean(imgmin, plant_mask))
-            frame_avg.append(masked_stats.mean(img, plant_mask))
-            # need double because there are two images per loop
-            yii_avg.append(masked_stats.mean(YII, plant_mask))
-            yii_avg.append(masked_stats.mean(YII, plant_mask))
-            yii_std.append(masked_stats.std(YII, plant_mask))
-            yii_std.append(masked_stats.std(YII, plant_mask))
-            npq_avg.append(masked_stats.mean(NPQ, plant_mask))
-            npq_avg.append(masked_stats.mean(NPQ, plant_mask))
-            npq_std.append(masked_stats.std(NPQ, plant_mask))
-            npq_std.append(masked_stats.std(NPQ, plant_mask))
-
-            # Check if plant is compeltely within the frame of the image
-            inbounds.append(pcv.within_frame(plant_mask))
-            inbounds.append(pcv.within_frame(plant_mask))
-
-            #Compute the plantarea in mm^2
-            plantarea.append(obj_area * pixelresolution**2.)
-            plantarea.append(obj_area * pixelresolution**2.)
-
-        else:
-            print('!!! No plant detected in roi ', str(i))
-
-            frame_avg.append(0)
-            frame_avg.append(0)
-            yii_avg.append(np.nan)
-            yii_avg.append(np.nan)
-            yii_std.append(np.nan)
-            yii_std.append(np.nan)
-            npq_avg.append(np.nan)
-            npq_avg.append(np.nan)
-            npq_std.append(np.nan)
-            npq_std.append(np.nan)
-            inbounds.append(np.nan)
-            inbounds.append(np.nan)
-            plantarea.append(0)
-            plantarea.append(0)
-
-        # end if-else
-    # end roi loop
-
-    # save mask of all plants to file after roi filter
-    if param_name == 'FvFm':
-        pcv.print_image(newmask, os.path.join(maskdir, outfn + '_mask.png'))
-
-    # Output a pseudocolor of NPQ and YII for each induction period for each image
-    imgdir = os.path.join(outdir, 'pseudocolor_images', sampleid)
-    os.makedirs(imgdir, exist_ok=True)
-    npq_img = pcv.visualize.pseudocolor(NPQ,
-                                        obj=None,
-                                        mask=newmask,
-                                        cmap='inferno',
-                                        axes=False,
-                                        min_value=0,
-                                        max_value=2.5,
-                                        background='black',
-                                        obj_padding=0)
-    npq_img = add_scalebar.add_scalebar(npq_img,
-                                        pixelresolution=pixelresolution,
-                                        barwidth=20,
-                                        barlocation='lower left')
-    # If you change the output size and resolution you will need to adjust the  timelapse video script
-    npq_img.set_size_inches(6,6, forward=False)
-    npq_img.savefig(os.path.join(imgdir, outfn + '_NPQ.png'),
-                    bbox_inches='tight',
-                    dpi = 150)
-    npq_img.clf()
-
-    yii_img = pcv.visualize.pseudocolor(YII,
-                                        obj=None,
-                                        mask=newmask,
-                                        cmap=custom_colormaps.get_cmap('imagingwin'),
-                                        axes=False,
-                                        min_value=0,
-                                        max_value=1,
-                                        background='black',
-                                        obj_padding=0)
-    yii_img = add_scalebar.add_scalebar(yii_img,
-                                        pixelresolution=pixelresolution,
-                                        barwidth = 20,
-                                        barlocation = 'lower left')
-    yii_img.set_size_inches(6,6, forward=False)
-    yii_img.savefig(os.path.join(imgdir, outfn + '_YII.png'),
-                    bbox_inches='tight',
-                    dpi = 150)
-    yii_img.clf()
-
-    # check YII values for uniqueness between all ROI. nonunique ROI suggests the plants grew into each other and can no longer be reliably separated in image processing.
-    # a single value isn't always robust. I think because there ae small independent objects that fall in one roi but not the other that change the object within the roi slightly.
-    # also note, I originally designed this for trays of 2 pots. It will not detect if e.g. 2 out of 9 plants grow into each other
-    rounded_avg = [round(n, 3) for n in yii_avg]
-    rounded_std = [round(n, 3) for n in yii_std]
-    isunique = not (rounded_avg.count(rounded_avg[0]) == len(yii_avg) and
-                    rounded_std.count(rounded_std[0]) == len(yii_std))
-
-    # save all values to outgoing dataframe
-    outdf['roi'] = ithroi
-    outdf['frame_avg'] = frame_avg
-    outdf['yii_avg'] = yii_avg
-    outdf['npq_avg'] = npq_avg
-    outdf['yii_std'] = yii_std
-    outdf['npq_std'] = npq_std
-    outdf['plantarea'] = plantarea
-    outdf['obj_in_frame'] = inbounds
-    outdf['unique_roi'] = isunique
-
-    return (outdf)
-# end of function!
+# import importlib; from src.analysis import psII; importlib.reload(psII)
+
+# The analysis of each pair of images is in src/analysis/psII.py. Every sample-day (treatment, sampleid, jobdate) is processed independently: FvFm first and then each parameter of the induction curve.
+# These are the settings that are passed to each sample-day
+# Modify diy_data/roi_layouts.json to indicate where the plants are in the image. Each tray (sampleid) can have its own layout of circles, rectangles or polygons, see src/segmentation/roilayout.py
+config = {'outdir': outdir,
+          'maskdir': maskdir,
+          'fluordir': fluordir,
+          'debugdir': debugdir,
+          'pixelresolution': pixelresolution,
+          'maskmode': 'thresh',  # 'fast' gives the same masks without plantcv, see src/segmentation/createmasks.py
+          'pseudocolor': 'lut',  # 'matplotlib' for the pcv.visualize.pseudocolor figures
+          'persist_fvfm': True,  # write the Fm tif and the mask png of each day. the induction curve uses the copies in memory, see src/analysis/fvfmcache.py
+          'fvfm_cache_mb': 256,  # memory budget of the FvFm masks, plant labels and Fm kept in memory in each process
+          'write_threads': 2,  # threads in each process that encode and write the tifs and pngs while the next images are processed. 0 writes them inline, see src/util/asyncwriter.py
+          'write_queue': 32,  # number of images waiting to be written before the processing waits for the disk
+          'fsync': False,  # True to force every file to disk, e.g. on network storage
+          'arraystore': None,  # e.g. os.path.join(outdir, 'fluorescence.h5') to keep all YII and NPQ images in one compressed hdf5 file (needs h5py) instead of thousands of tifs in fluordir. src.data.arraystore.ArrayStore(fn).export_tifs(fluordir) writes the tifs
+          'pixelstore': None,  # e.g. os.path.join(outdir, 'pixels') to keep only the YII and NPQ of the plant pixels, one npz per sample-day, instead of the tifs in fluordir. src.data.pixelstore.PixelStore(dir).plant() gives the per-pixel kinetics of one plant
+          'roi': roilayout.load(os.path.join(indir, 'roi_layouts.json'))}
+
+# Results of each sample-day are cached in outdir/cache. A sample-day is only reprocessed if its tif file, pimframes_map.csv or the settings above change. Delete the cache directory (or use --no-cache) if you deleted output images and want them recreated.
+if args.cache:
+    config['cachedir'] = os.path.join(outdir, 'cache')
+    config['paramhash'] = resultcache.params_hash(config, pimframes)
+    # digests of the tifs are kept with the manifest so only new or changed files are read for the cache keys
+    config['hashdb'] = manifestfn
 
 # %% Setup Debug parameters
-#by default params.debug should be 'None' when you are ready to process all your images
-pcv.params.debug = 'None'
+# the plantcv debug mode (pcv.params.debug) of every sample-day. 'plot' is useful if you are testing your pipeline over a few samples so you can see each step, 'print' writes the images to debugdir
+#by default debug should be None when you are ready to process all your images
+debug = None
 # if you choose to print debug files to disk then remove the old ones first (if they exist)
-if pcv.params.debug == 'print':
+if debug == 'print':
     import shutil
     shutil.rmtree(os.path.join(debugdir), ignore_errors=True)
 
@@ -352,24 +152,94 @@ else:
     print('df2 already exists!')
 
 # Each unique combination of treatment, sampleid, jobdate, parameter should result in exactly 2 rows in the dataframe that correspond to Fo/Fm or F'/Fm'
-dfgrps = df2.groupby(['treatment', 'sampleid', 'jobdate', 'parameter'])
-grplist = []
-for grp, grpdf in dfgrps:
-    # print(grp)#'%s ---' % (grp))
-    grplist.append(image_avg(grpdf))
-df_avg = pd.concat(grplist)
-
-
-# %% Add genotype information to the processing results
+# Each sample-day is independent so they can be processed in parallel. The output is the same for any number of workers.
+# The results of each sample-day are joined with the genotype information and written to the sqlite database outdir/output_psII_level0.sqlite as soon as they are finished
+# Load only the rows and columns you need with e.g. resultstore.ResultStore(dbfile).query(['date', 'roi', 'yii_avg'], sampleid='tray2', parameter='FvFm')
 gtypeinfo = pd.read_csv(os.path.join(indir, 'genotype_map.csv'), skipinitialspace=True)
 gtypeinfo = strip_whitespace.strip_dfwhitespace(gtypeinfo)  #strip whitespace from any fields. using sep="\s*,\s" in read_csv doesn't work. first header value get messed up
-df_avg2 = (pd.merge(df_avg,
-                    gtypeinfo,
-                    on=['treatment', 'sampleid', 'roi'],
-                    how='inner')
-           )
-
-# %% Write the tabular results to file!
-(df_avg2.sort_values(['treatment', 'date', 'sampleid', 'imageid'])
- .to_csv(os.path.join(outdir, 'output_psII_level0.csv'), na_rep='nan', float_format='%.4f', index=False)
- )
+sink = resultstore.ResultStore(os.path.join(outdir, 'output_psII_level0.sqlite'), gtypeinfo)
+# one csv (or parquet with fmt='parquet') per sample-day instead:
+# from src.data import resultsink
+# sink = resultsink.ResultSink(os.path.join(outdir, 'level0_parts'), gtypeinfo, fmt='csv')
+# The level1 dataset (plants in frame and alone in their roi) and the genotype x treatment x day summaries of reports/postprocessingQC.Rmd are updated as each sample-day finishes, see src/analysis/level1.py
+agg = level1.Level1(gtypeinfo)
+
+config['debug'] = debug
+if args.profile:
+    import shutil
+    profdir = os.path.join(outdir, 'profile' if args.shard is None else 'profile-%s' % shardname)
+    shutil.rmtree(profdir, ignore_errors=True)  # only report this run
+    config['profdir'] = os.path.join(profdir, 'records')
+    profiling.enable()
+    profiling.set_group('main')
+
+# %% Distributed processing
+# Start the script with --shard 1/N, --shard 2/N, ... --shard N/N on N machines (or N terminals) that share indir and outdir. Every sample-day is assigned to exactly one shard by a hash of treatment, sampleid and date.
+# Each shard writes its results without genotypes (and its own array store) to outdir/shards. When all shards are finished run the script once with --merge
+sharddir = os.path.join(outdir, 'shards')
+if args.shard is not None:
+    df2 = runner.select_shard(df2, shard - 1, nshards)
+    sink = resultstore.ResultStore(os.path.join(sharddir, 'level0-%s.sqlite' % shardname))
+    if config['arraystore']:
+        config['arraystore'] = os.path.join(sharddir, 'fluorescence-%s.h5' % shardname)
+    print('shard %s: %d sample-days' % (args.shard, len(df2.groupby(runner.WORKUNIT, observed=True))))
+
+if args.merge:
+    with profiling.stage('merge'):
+        n = sink.merge(sorted(glob.glob(os.path.join(sharddir, 'level0-*.sqlite'))))
+        for treatment, date, sampleid in sink.partitions().itertuples(index=False):
+            agg.add(sink.query(treatment=treatment, date=date, sampleid=sampleid))
+        if config['arraystore']:
+            arraystore.ArrayStore(config['arraystore']).merge(sorted(glob.glob(os.path.join(sharddir, 'fluorescence-*.h5'))))
+    print('merged %d sample-days from %s' % (n, sharddir))
+else:
+    runner.run(df2, config, workers=args.workers, sink=sink, level1=None if args.shard else agg)
+
+# %% Write the tabular results to file! output_psII_level0.csv is still used by the R scripts
+# output_psII_level1.csv, output_psII_level1_summary.csv (mean, sd and standard error of plantarea, yii_avg and npq_avg with the change from control) and output_psII_level1_steadystate.csv (last 2 steps of the induction curve)
+profiling.set_group('main')
+if args.shard is None:
+    with profiling.stage('export_csv'):
+        sink.export_csv(os.path.join(outdir, 'output_psII_level0.csv'))
+        agg.export(outdir)
+
+# %% Timelapse videos
+# The frames are rendered from the YII and NPQ tifs in fluordir with the genotypes of genotype_map.csv above each roi of config['roi'] and streamed to the video encoder. Each video is made in its own process
+if args.timelapse and args.shard is None:
+    profiling.set_group('main')
+    with profiling.stage('timelapse'):
+        videos = timelapse.make_videos(os.path.join(outdir, 'timelapse'), config, gtypeinfo, workers=args.workers)
+    for fn, nframes in videos:
+        print('%s: %d frames' % (fn, nframes))
+
+# %% Watch for new measurements
+# Each tif exported from ImagingWin into raw_multiframe/ is processed as soon as it is completely written and its results are in the sink within seconds.
+# Files that were processed above are only processed again if they change. output_psII_level0.csv is rewritten when you stop with ctrl-c
+if args.watch and args.shard is None:
+    rawdir = os.path.join(indir, 'raw_multiframe')
+    print('watching %s for new files. ctrl-c to stop' % rawdir)
+    try:
+        for fn in watchfolder.watch(rawdir, npages=len(pimframes), poll=args.poll, known=known):
+            # the same checks as the batch import, including the duplicate check against the files that passed before
+            check = validate.check_new(fn, pimframes, report=checks['report'], dbfile=manifestfn)
+            if check['reason']:
+                print('%s excluded: %s %s' % (fn, check['reason'], check['detail']))
+                continue
+            newdf = runner.worklist(import_snapshots.index_multiframes([fn]), pimframes)
+            try:
+                runner.run(newdf, config, workers=1, sink=sink, level1=agg)
+            except Exception as e:
+                # keep watching. the file will be retried if it is replaced
+                print('%s failed: %s' % (fn, e))
+                continue
+            print('%s processed %s' % (datetime.now().strftime('%H:%M:%S'), fn))
+    except KeyboardInterrupt:
+        pass
+    profiling.set_group('main')
+    sink.export_csv(os.path.join(outdir, 'output_psII_level0.csv'))
+    agg.export(outdir)
+
+# %% Timing report
+if args.profile:
+    profiling.flush(config['profdir'])
+    profiling.report(config['profdir'], profdir)
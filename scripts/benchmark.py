@@ -0,0 +1,154 @@
+'''
+Benchmark the image processing with synthetic Imaging-PAM datasets.
+
+A dataset following pimframes_map.csv (Fo/Fm, absorptivity and the induction curve) is generated with src/data/synthetic.py and then
+import_snapshots, psIImask, the full sample-day analysis and the pseudocolor output are timed end-to-end and per stage.
+
+Example:
+python scripts/benchmark.py --trays 4 --pots 6x8 --size 480x640 --days 3 --workers 4 --save benchmarks/baseline_6x8.json
+python scripts/benchmark.py --trays 4 --pots 6x8 --size 480x640 --days 3 --workers 4 --compare benchmarks/baseline_6x8.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.data import import_snapshots, synthetic
+from src.analysis import runner
+from src.segmentation import createmasks
+from src.util import profiling
+
+# slower than this factor compared to the baseline is reported as a regression
+TOLERANCE = 1.2
+
+
+def parse_pair(s):
+    a, b = s.lower().split('x')
+    return int(a), int(b)
+
+
+def run_benchmark(args):
+    datadir = args.datadir or tempfile.mkdtemp(prefix='pam_benchmark_')
+    outdir = os.path.join(datadir, 'output')
+    shutil.rmtree(outdir, ignore_errors=True)
+    nrows, ncols = parse_pair(args.pots)
+    shape = parse_pair(args.size)
+    pimframes = pd.read_csv(args.pimframes, skipinitialspace=True)
+    pimframes.columns = pimframes.columns.str.strip()
+
+    timings = {}
+    t0 = time.perf_counter()
+    roi = synthetic.make_dataset(datadir, pimframes, ntrays=args.trays, nrows=nrows, ncols=ncols,
+                                 shape=shape, ndays=args.days, dtype=args.dtype)
+    timings['generate_s'] = time.perf_counter() - t0
+
+    # metadata
+    t0 = time.perf_counter()
+    fdf = import_snapshots.import_snapshots(datadir, 'psii', read_multiframe=True)
+    timings['import_snapshots_s'] = time.perf_counter() - t0
+    df = runner.worklist(fdf, pimframes)
+
+    # segmentation alone on every Fm frame
+    fm = df.query('parameter == "FvFm" and frame == "Fm"')
+    t0 = time.perf_counter()
+    for _, row in fm.iterrows():
+        createmasks.psIImask(runner.psII.readframe(row), mode=args.maskmode)
+    timings['psIImask_s'] = (time.perf_counter() - t0) / max(len(fm), 1)
+
+    # full analysis including the pseudocolor output, with per stage records
+    config = {'outdir': outdir,
+              'maskdir': os.path.join(outdir, 'masks'),
+              'fluordir': os.path.join(outdir, 'fluorescence'),
+              'debugdir': os.path.join(outdir, 'debug'),
+              'pixelresolution': 0.35,
+              'maskmode': args.maskmode,
+              'pseudocolor': args.pseudocolor,
+              'roi': roi,
+              'debug': None,
+              'profdir': os.path.join(outdir, 'profile')}
+    for d in ['maskdir', 'fluordir']:
+        os.makedirs(config[d], exist_ok=True)
+    t0 = time.perf_counter()
+    runner.run(df, config, workers=args.workers)
+    timings['pipeline_s'] = time.perf_counter() - t0
+    nsampledays = df.groupby(runner.WORKUNIT).ngroups
+    timings['pipeline_per_sampleday_s'] = timings['pipeline_s'] / nsampledays
+
+    # records of this process that are not in profdir yet
+    profiling.flush(config['profdir'])
+    summary = profiling.report(config['profdir'])
+    stages = {stage: {'calls': int(r.calls), 'mean_s': float(r.mean_s), 'total_s': float(r.total_s)}
+              for stage, r in summary.iterrows()}
+
+    if not args.keep:
+        shutil.rmtree(datadir, ignore_errors=True)
+
+    return {'created': datetime.now().isoformat(timespec='seconds'),
+            'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+            'params': {'trays': args.trays, 'pots': args.pots, 'size': args.size, 'days': args.days,
+                       'dtype': args.dtype, 'workers': args.workers, 'maskmode': args.maskmode,
+                       'pseudocolor': args.pseudocolor},
+            'timings': timings,
+            'stages': stages}
+
+
+def compare(result, baseline):
+    '''
+    Print current vs baseline timings. Returns True if any timing is slower than TOLERANCE times the baseline.
+    '''
+    if result['params'] != baseline['params']:
+        print('Warning: the benchmark parameters differ from the baseline\n  baseline: %s\n  current:  %s' % (baseline['params'], result['params']))
+
+    rows = []
+    for k, v in result['timings'].items():
+        rows.append((k, baseline['timings'].get(k, np.nan), v))
+    for stage, v in result['stages'].items():
+        rows.append(('stage:' + stage, baseline['stages'].get(stage, {}).get('mean_s', np.nan), v['mean_s']))
+    table = pd.DataFrame(rows, columns=['metric', 'baseline_s', 'current_s']).set_index('metric')
+    table['ratio'] = table.current_s / table.baseline_s
+    table['regression'] = table.ratio > TOLERANCE
+    with pd.option_context('display.float_format', '{:.4f}'.format, 'display.width', 120):
+        print(table)
+    return bool(table.regression.any())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Imaging-PAM pipeline with a synthetic dataset')
+    parser.add_argument('--trays', type=int, default=2, help='trays (sampleid) per treatment')
+    parser.add_argument('--pots', default='3x3', help='pots per tray as ROWSxCOLS')
+    parser.add_argument('--size', default='480x640', help='image size as HEIGHTxWIDTH')
+    parser.add_argument('--days', type=int, default=2, help='number of days')
+    parser.add_argument('--dtype', default='uint8', choices=['uint8', 'uint16'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--maskmode', default='thresh')
+    parser.add_argument('--pseudocolor', default='lut', choices=['lut', 'matplotlib'])
+    parser.add_argument('--pimframes', default=os.path.join('diy_data', 'pimframes_map.csv'))
+    parser.add_argument('--datadir', default=None, help='directory for the synthetic dataset (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic dataset and output')
+    parser.add_argument('--save', default=None, help='save the results as json, e.g. as a new baseline')
+    parser.add_argument('--compare', default=None, help='json from a previous --save to compare against')
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    print(json.dumps(result['timings'], indent=1))
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(result, baseline):
+            sys.exit(1)
@@ -0,0 +1,98 @@
+'''
+Compares the plant area and mean YII of each roi from src.segmentation.roiobjects.label_objects (used by src/analysis/psII.py) with the plantcv steps
+it replaced: pcv.find_objects, pcv.roi.multi, pcv.roi_objects(..., roi_type='partial'), pcv.object_composition and cv2.countNonZero.
+Run it on FvFm of a real Imaging-PAM file before trusting the results of a new setup, e.g.
+    python scripts/compare_roi_objects.py diy_data/raw_multiframe/control-20190801-tray2.tif
+Needs plantcv. The table is printed and written to outdir/roi_objects_comparison.csv
+
+Where the two can differ:
+    membership = plantcv keeps an object if the filled outer contour overlaps the filled roi contour, label_objects if any pixel of the object is in the roi.
+                 only an object whose hole contains the whole roi is kept by plantcv and not by label_objects
+    area, YII = plantcv counts the pixels of the kept contours drawn back into a mask. a hole of a kept object that does not overlap the roi is drawn
+                over with its contour, so the pixels of the plant around the hole are lost. label_objects counts the pixels of the mask
+'''
+
+# %% Setup
+import argparse
+import glob
+import os
+import numpy as np
+import pandas as pd
+from plantcv import plantcv as pcv
+
+from src.analysis import fluorescence
+from src.data import multiframe
+from src.data.resultsink import CSV_OPTIONS
+from src.segmentation import createmasks
+from src.segmentation import roilayout
+from src.segmentation import roiobjects
+from src.util import masked_stats
+from src.util import strip_whitespace
+
+indir = 'diy_data'
+outdir = os.path.join('output', 'from_' + indir)
+
+parser = argparse.ArgumentParser(description='Compare the roi area and YII of label_objects with pcv.roi_objects')
+parser.add_argument('files', nargs='*', help='multiframe tifs (default: every file in diy_data/raw_multiframe)')
+parser.add_argument('--maskmode', default='thresh', help='see src.segmentation.createmasks.psIImask (default: thresh)')
+parser.add_argument('--pixelresolution', type=float, default=0.2, help='mm per pixel (default: 0.2)')
+args, _ = parser.parse_known_args()
+fns = args.files or sorted(glob.glob(os.path.join(indir, 'raw_multiframe', '*.tif')))
+
+pimframes = strip_whitespace.strip_dfwhitespace(pd.read_csv(os.path.join(indir, 'pimframes_map.csv'), skipinitialspace=True))
+fvfm = pimframes[pimframes.parameter == 'FvFm'].set_index('frame').imageid
+roi = roilayout.load(os.path.join(indir, 'roi_layouts.json'))
+
+
+# %% plantcv steps of the original roi loop
+def plantcv_rois(img, mask, YII, layout):
+    # pcv.roi.multi only knows circle grids
+    spec = layout[0] if isinstance(layout, list) else layout
+    if len(roilayout.expand(layout)) != spec.get('nrows', 0) * spec.get('ncols', 0) or spec.get('shape', 'circle') != 'circle':
+        raise ValueError('pcv.roi.multi can only make a single grid of circles')
+    c, h = pcv.find_objects(img, mask)
+    # pcv.roi.multi needs tuples for a grid
+    roi_c, roi_h = pcv.roi.multi(img, coord=tuple(spec['coord']), radius=spec['radius'], spacing=tuple(spec['spacing']), nrows=spec['nrows'], ncols=spec['ncols'])
+    area = []
+    yii = []
+    for rc, rh in zip(roi_c, roi_h):
+        roi_obj, hierarchy_obj, submask, obj_area = pcv.roi_objects(img, roi_contour=rc, roi_hierarchy=rh, object_contour=c, obj_hierarchy=h, roi_type='partial')
+        if obj_area > 0:
+            plant_contour, plant_mask = pcv.object_composition(img=img, contours=roi_obj, hierarchy=hierarchy_obj)
+            area.append(obj_area)
+            yii.append(masked_stats.mean(YII, plant_mask))
+        else:
+            area.append(0)
+            yii.append(np.nan)
+    return np.array(area), np.array(yii)
+
+
+# %% Compare
+rows = []
+for fn in fns:
+    fo, fm = multiframe.read_frames(fn, [fvfm['Fo'] - 1, fvfm['Fm'] - 1])
+    mask = createmasks.psIImask(fm, mode=args.maskmode)
+    YII = fluorescence.fvfm(fo, fm, mask)
+    sampleid = os.path.splitext(os.path.basename(fn))[0].split('-')[2]
+    layout = roilayout.layout_for(roi, sampleid)
+
+    pcv_area, pcv_yii = plantcv_rois(fm, mask, YII, layout)
+    labels, member, inframe = roiobjects.label_objects(mask, roilayout.label_image(fm.shape, layout), roilayout.count(layout))
+    avg, _, npixels = masked_stats.roi_stats([YII], labels, member)
+    for i in range(len(npixels)):
+        rows.append({'filename': os.path.basename(fn), 'roi': i,
+                     'pcv_pixels': int(pcv_area[i]), 'pixels': int(npixels[i]),
+                     'pcv_plantarea': pcv_area[i] * args.pixelresolution**2, 'plantarea': npixels[i] * args.pixelresolution**2,
+                     'pcv_yii_avg': pcv_yii[i], 'yii_avg': avg[0, i]})
+
+df = pd.DataFrame(rows)
+df['pixel_diff'] = df.pixels - df.pcv_pixels
+df['yii_diff'] = df.yii_avg - df.pcv_yii_avg
+os.makedirs(outdir, exist_ok=True)
+df.to_csv(os.path.join(outdir, 'roi_objects_comparison.csv'), **CSV_OPTIONS)
+
+with pd.option_context('display.width', 160, 'display.max_rows', None):
+    print(df[df.pixel_diff != 0])
+print('%d of %d rois have a different pixel count, max |difference| %d pixels (%.2f%%)' %
+      ((df.pixel_diff != 0).sum(), len(df), df.pixel_diff.abs().max(), 100 * (df.pixel_diff.abs() / df.pcv_pixels.clip(lower=1)).max()))
+print('max |difference| of the mean YII %.2g' % df.yii_diff.abs().max())
@@ -0,0 +1,137 @@
+'''
+Batch processing of the multiframe tifs of the Imaging-PAM without the interactive setup of scripts/ProcessImages.py, e.g.
+    python -m src --indir diy_data --workers 8
+    python -m src --indir diy_data --outputs csv hdf5 --maskmode fast
+
+No debug images are written unless --debug is given, and plantcv and matplotlib are only imported for the outputs that need them.
+'''
+import argparse
+import os
+import sys
+
+# files written in addition to outdir/output_psII_level0.sqlite
+OUTPUTS = ('csv', 'level1', 'masks', 'pseudocolor', 'hdf5', 'pixels', 'timelapse')
+DEFAULT_OUTPUTS = ['csv', 'level1', 'masks', 'pseudocolor']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src',
+                                     description='Extract phenotypes from multiframe tif files of the Imaging-PAM')
+    parser.add_argument('--indir', default='diy_data',
+                        help='data directory with raw_multiframe/, pimframes_map.csv, genotype_map.csv and roi_layouts.json (default: diy_data)')
+    parser.add_argument('--outdir', default=None,
+                        help='output directory (default: output/from_<indir>)')
+    parser.add_argument('--pixelresolution', type=float, default=0.35,
+                        help='mm per pixel of the camera at its working distance (default: 0.35)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes. each process handles one sample-day at a time (default: 1)')
+    parser.add_argument('--outputs', nargs='*', choices=OUTPUTS, default=DEFAULT_OUTPUTS, metavar='OUTPUT',
+                        help='files to write besides output_psII_level0.sqlite: %s. hdf5 keeps the YII and NPQ images in outdir/fluorescence.h5 and pixels only the plant pixels in outdir/pixels instead of tifs in outdir/fluorescence (default: %s)'
+                        % (', '.join(OUTPUTS), ' '.join(DEFAULT_OUTPUTS)))
+    parser.add_argument('--write-threads', type=int, default=2,
+                        help='threads in each process that write the image files in the background. 0 writes them inline (default: 2)')
+    parser.add_argument('--fsync', action='store_true',
+                        help='force every image file to disk before the run ends, e.g. on network storage')
+    parser.add_argument('--maskmode', choices=('thresh', 'fast'), default='thresh',
+                        help="'fast' gives the same masks without plantcv, see src/segmentation/createmasks.py (default: thresh)")
+    parser.add_argument('--roi', default=None,
+                        help='json file with the roi layouts (default: <indir>/roi_layouts.json)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='reprocess every sample-day even if its input files and settings have not changed. use it if you add outputs that were not written before')
+    parser.add_argument('--no-validate', dest='validate', action='store_false',
+                        help='skip the checks of the multiframe tifs for truncated, blank, saturated and duplicate files. the excluded files are listed in outdir/jobs_removed.csv')
+    parser.add_argument('--profile', action='store_true',
+                        help='record time, peak memory and bytes read/written of each stage and write a timing report to outdir/profile')
+    parser.add_argument('--debug', action='store_true',
+                        help='write the plantcv debug images of every step to debug/from_<indir>. slow, only for a few samples')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print the name of every image')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # imported after the arguments are parsed so --help and argument errors are instant
+    import pandas as pd
+    from src.analysis import level1
+    from src.analysis import runner
+    from src.data import import_snapshots
+    from src.data import resultstore
+    from src.segmentation import roilayout
+    from src.util import profiling
+    from src.util import resultcache
+    from src.util import strip_whitespace
+
+    indir = args.indir.rstrip('/\\')
+    outdir = args.outdir or os.path.join('output', 'from_' + os.path.basename(indir))
+    outputs = set(args.outputs)
+    config = {'outdir': outdir,
+              'maskdir': os.path.join(outdir, 'masks'),
+              'fluordir': os.path.join(outdir, 'fluorescence'),
+              'debugdir': os.path.join('debug', 'from_' + os.path.basename(indir)),
+              'pixelresolution': args.pixelresolution,
+              'maskmode': args.maskmode,
+              'pseudocolor': 'lut' if 'pseudocolor' in outputs else None,
+              'persist_fvfm': 'masks' in outputs,
+              'arraystore': os.path.join(outdir, 'fluorescence.h5') if 'hdf5' in outputs else None,
+              'pixelstore': os.path.join(outdir, 'pixels') if 'pixels' in outputs else None,
+              'write_threads': args.write_threads,
+              'fsync': args.fsync,
+              'debug': 'print' if args.debug else None,
+              'verbose': args.verbose,
+              'roi': roilayout.load(args.roi or os.path.join(indir, 'roi_layouts.json'))}
+    for d in (outdir, config['maskdir'], config['fluordir']):
+        os.makedirs(d, exist_ok=True)
+    if args.debug:
+        import shutil
+        shutil.rmtree(config['debugdir'], ignore_errors=True)
+
+    pimframes = strip_whitespace.strip_dfwhitespace(pd.read_csv(os.path.join(indir, 'pimframes_map.csv'), skipinitialspace=True))
+    gtypeinfo = strip_whitespace.strip_dfwhitespace(pd.read_csv(os.path.join(indir, 'genotype_map.csv'), skipinitialspace=True))
+    if args.cache:
+        config['cachedir'] = os.path.join(outdir, 'cache')
+        config['paramhash'] = resultcache.params_hash(config, pimframes)
+        # digests of the tifs are kept with the manifest so only new or changed files are read for the cache keys
+        config['hashdb'] = os.path.join(outdir, 'manifest.sqlite')
+    if args.profile:
+        import shutil
+        profdir = os.path.join(outdir, 'profile')
+        shutil.rmtree(profdir, ignore_errors=True)
+        config['profdir'] = os.path.join(profdir, 'records')
+        profiling.enable()
+        profiling.set_group('main')
+
+    validate = {'pimframes': pimframes, 'report': os.path.join(outdir, 'jobs_removed.csv'), 'workers': args.workers} if args.validate else None
+    fdf = import_snapshots.import_snapshots(indir, 'psii', read_multiframe=True, manifest=os.path.join(outdir, 'manifest.sqlite'), validate=validate)
+    df = runner.worklist(fdf, pimframes)
+    sink = resultstore.ResultStore(os.path.join(outdir, 'output_psII_level0.sqlite'), gtypeinfo)
+    # level1 summaries are updated as each sample-day finishes
+    agg = level1.Level1(gtypeinfo) if 'level1' in outputs else None
+    runner.run(df, config, workers=args.workers, sink=sink, level1=agg)
+
+    profiling.set_group('main')
+    if 'csv' in outputs:
+        with profiling.stage('export_csv'):
+            sink.export_csv(os.path.join(outdir, 'output_psII_level0.csv'))
+    if agg is not None:
+        with profiling.stage('level1'):
+            agg.export(outdir)
+    if 'timelapse' in outputs:
+        # renders with opencv. the encoder is only started here
+        from src.viz import timelapse
+        with profiling.stage('timelapse'):
+            videos = timelapse.make_videos(os.path.join(outdir, 'timelapse'), config, gtypeinfo, workers=args.workers)
+        for fn, nframes in videos:
+            print('%s: %d frames' % (fn, nframes))
+
+    if args.profile:
+        profiling.flush(config['profdir'])
+        profiling.report(config['profdir'], profdir)
+
+    print('%d sample-days processed. results in %s' % (len(df.groupby(runner.WORKUNIT, observed=True)), outdir))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1 @@
+__all__ = ["level1", "psII", "rgbarea", "runner"]
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+'''
+PSII chlorophyll fluorescence parameters. Every function takes single images (H, W) or stacks of images (n_steps, H, W) with a (H, W) mask,
+writes into optional preallocated buffers and returns 0 outside the mask and wherever a parameter is not defined.
+'''
+import numpy as np
+
+
+def fv(fmin, fmax, out=None):
+    '''
+    Input:
+    fmin = Fo (or F') image or stack of images
+    fmax = Fm (or Fm') image or stack of images with the same shape as fmin
+    out = optional buffer with the shape and dtype of fmax to reuse between calls
+
+    Output:
+    Fv = Fm - Fo in the integer type of the images. 0 where Fo > Fm because the subtraction would roll over (the same as pcv.fluor_fvfm)
+    '''
+    if out is None:
+        out = np.empty_like(fmax)
+    out.fill(0)
+    np.subtract(fmax, fmin, out=out, where=fmax > fmin)
+    return out
+
+
+def yii(fmin, fmax, mask, out=None, fvbuf=None):
+    '''
+    Input:
+    fmin = F' (or Fo) image or stack of images (n_steps, H, W)
+    fmax = Fm' (or Fm) image or stack of images with the same shape as fmin
+    mask = binary mask of the plants (H, W). broadcast to every step
+    out = optional float32 buffer with the shape of fmax to reuse between calls
+    fvbuf = optional buffer for Fv with the shape and dtype of fmax to reuse between calls
+
+    Output:
+    float32 YII = (Fm' - F') / Fm' inside the mask where Fm' > 0, 0 everywhere else. Fv is 0 where F' > Fm' (the same as pcv.fluor_fvfm)
+    '''
+    if out is None:
+        out = np.empty(fmax.shape, dtype=np.float32)
+
+    fvar = fv(fmin, fmax, out=fvbuf)
+
+    # divide with integer inputs into a float32 buffer gives the same values as the per-image np.divide
+    out.fill(0)
+    np.divide(fvar, fmax, out=out, where=np.logical_and(mask > 0, fmax > 0))
+    return out
+
+
+def fvfm(fo, fm, mask, out=None, fvbuf=None):
+    '''
+    Input:
+    fo, fm = Fo and Fm images of the dark adapted plants
+    mask, out, fvbuf = see yii()
+
+    Output:
+    float32 Fv/Fm, the maximum quantum efficiency of PSII. This is YII of the dark adapted measurement so the values are identical to
+    Fv from pcv.fluor_fvfm(fdark=0, fmin=fo, fmax=fm, mask=mask) divided by Fm, without the histogram
+    '''
+    return yii(fo, fm, mask, out=out, fvbuf=fvbuf)
+
+
+def npq(fm, fmp, mask, out=None):
+    '''
+    Input:
+    fm = Fm image (H, W) from the dark adapted FvFm measurement
+    fmp = Fm' image or stack of images (n_steps, H, W)
+    mask = binary mask of the plants (H, W)
+    out = optional float32 buffer with the shape of fmp to reuse between calls
+
+    Output:
+    float32 NPQ = Fm / Fm' - 1 inside the mask where Fm' > 0 and Fm >= Fm', 0 everywhere else
+    '''
+    if out is None:
+        out = np.empty(fmp.shape, dtype=np.float32)
+
+    out.fill(0)
+    np.divide(fm, fmp, out=out, where=np.logical_and(mask > 0, fmp > 0))
+    # NPQ < 0 is not meaningful so those pixels are set to 0
+    keep = np.logical_and(out >= 1, mask > 0)
+    np.subtract(out, 1, out=out, where=keep)
+    out[~keep] = 0
+    return out
+
+
+def fop(fo, fm, fmp, mask, out=None):
+    '''
+    Input:
+    fo, fm = Fo and Fm images of the dark adapted plants (H, W)
+    fmp = Fm' image or stack of images (n_steps, H, W)
+    mask = binary mask of the plants (H, W)
+    out = optional float32 buffer with the shape of fmp
+
+    Output:
+    float32 Fo' estimated as Fo / (Fv/Fm + Fo/Fm') (Oxborough and Baker 1997) because the protocol has no far-red measurement of Fo'. 0 outside the mask
+    '''
+    if out is None:
+        out = np.empty(fmp.shape, dtype=np.float32)
+    fo32 = fo.astype(np.float32)
+    fm32 = fm.astype(np.float32)
+    valid = np.logical_and(mask > 0, np.logical_and(fm > 0, fmp > 0))
+
+    out.fill(0)
+    # Fv/Fm + Fo/Fm'
+    np.divide(fo32, fmp, out=out, where=valid)
+    out += np.divide(fm32 - fo32, fm32, out=np.zeros_like(fm32), where=fm > 0)
+    np.divide(fo32, out, out=out, where=np.logical_and(valid, out > 0))
+    out[~valid] = 0
+    return out
+
+
+def qp(fo, fm, fp, fmp, mask, out=None):
+    '''
+    Input:
+    fo, fm = Fo and Fm images of the dark adapted plants (H, W)
+    fp, fmp = F' and Fm' image or stack of images (n_steps, H, W)
+    mask = binary mask of the plants (H, W)
+    out = optional float32 buffer with the shape of fmp
+
+    Output:
+    float32 photochemical quenching qP = (Fm' - F') / (Fm' - Fo') with Fo' from fop(), 0 where Fm' <= Fo' or outside the mask
+    '''
+    out = fop(fo, fm, fmp, mask, out=out)
+    denom = fmp.astype(np.float32) - out
+    num = fmp.astype(np.float32) - fp
+    valid = np.logical_and(mask > 0, denom > 0)
+    out.fill(0)
+    np.divide(num, denom, out=out, where=valid)
+    return out
+
+
+def qn(fo, fm, fmp, mask, out=None):
+    '''
+    Input:
+    fo, fm = Fo and Fm images of the dark adapted plants (H, W)
+    fmp = Fm' image or stack of images (n_steps, H, W)
+    mask = binary mask of the plants (H, W)
+    out = optional float32 buffer with the shape of fmp
+
+    Output:
+    float32 non-photochemical quenching qN = 1 - (Fm' - Fo') / (Fm - Fo) with Fo' from fop(), 0 where Fm <= Fo or outside the mask
+    '''
+    out = fop(fo, fm, fmp, mask, out=out)
+    fvd = fm.astype(np.float32) - fo
+    valid = np.logical_and(np.logical_and(mask > 0, fvd > 0), out > 0)
+    np.subtract(fmp.astype(np.float32), out, out=out)
+    np.divide(out, fvd, out=out, where=valid)
+    np.subtract(1, out, out=out, where=valid)
+    out[~valid] = 0
+    return out
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+import numpy as np
+
+# default memory budget of the cache in each process
+DEFAULT_MB = 256
+
+
+def nbytes(fvfm):
+    '''
+    Output:
+    number of bytes of the arrays in a fvfm dict from src.analysis.psII.fvfm_avg()
+    '''
+    return sum(v.nbytes for v in fvfm.values() if isinstance(v, np.ndarray))
+
+
+class FvFmCache:
+    '''
+    Least recently used cache of the FvFm state (plant labels, roi membership, mask and Fm) of each sample-day, keyed by (treatment, sampleid, jobdate).
+    Entries are evicted oldest first when the arrays exceed the memory budget. The cached arrays are shared so they must not be modified.
+
+    Input:
+    maxbytes = memory budget in bytes. an entry larger than the budget is not cached
+    '''
+
+    def __init__(self, maxbytes=DEFAULT_MB * 2**20):
+        self.maxbytes = maxbytes
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        '''
+        Output:
+        the fvfm dict of key or None
+        '''
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key, fvfm):
+        self.discard(key)
+        n = nbytes(fvfm)
+        if n > self.maxbytes:
+            return
+        self._entries[key] = (fvfm, n)
+        self.size += n
+        self.shrink()
+
+    def discard(self, key):
+        if key in self._entries:
+            _, n = self._entries.pop(key)
+            self.size -= n
+
+    def shrink(self, maxbytes=None):
+        '''
+        Evict the least recently used entries until the cache fits in maxbytes (default: the budget of the cache)
+        '''
+        if maxbytes is not None:
+            self.maxbytes = maxbytes
+        while self.size > self.maxbytes:
+            _, (_, n) = self._entries.popitem(last=False)
+            self.size -= n
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+# one cache per process
+CACHE = FvFmCache()
+
+
+def get_cache(config):
+    '''
+    Input:
+    config = dict of pipeline settings. config['fvfm_cache_mb'] sets the memory budget (default DEFAULT_MB)
+
+    Output:
+    the cache of this process with the budget from config
+    '''
+    maxbytes = int(config.get('fvfm_cache_mb', DEFAULT_MB) * 2**20)
+    if maxbytes != CACHE.maxbytes:
+        CACHE.shrink(maxbytes)
+    return CACHE
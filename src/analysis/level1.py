@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+'''
+Level1 dataset and the genotype x treatment x day summaries of reports/postprocessingQC.Rmd, updated as each sample-day finishes.
+Each sample-day only contributes counts, sums and sums of squares to the summaries so the tables are ready when processing ends without reloading output_psII_level0.csv.
+'''
+import os
+import numpy as np
+import pandas as pd
+
+from src.data.resultsink import PARTITION, SORT_COLUMNS, CSV_OPTIONS
+
+# groups of the summaries, like group_by(gtype, treatment, idate, parameter) in the Rmd. idate follows from date
+KEY = ['gtype', 'treatment', 'date', 'parameter', 'variable']
+SUMS = ['n', 'sum', 'sumsq']
+
+
+def valid(df):
+    '''
+    Input:
+    df = results with genotypes, e.g. from src.data.resultstore.ResultStore.query()
+
+    Output:
+    the rows where the plant is completely in frame and is the only plant in its roi, filter(unique_roi == T, obj_in_frame == T) in the Rmd
+    '''
+    # == True because nan (no plant in the roi) is neither True nor False
+    return df[(df.unique_roi == True) & (df.obj_in_frame == True)]
+
+
+def _values(l1):
+    # long table of the values that are summarized: plant area of the FvFm frames and YII and NPQ of the Fm and Fm' frames
+    parts = [l1.loc[l1.parameter == 'FvFm', ['gtype', 'treatment', 'date', 'parameter', 'plantarea']].rename(columns={'plantarea': 'value'}).assign(variable='plantarea')]
+    maxframes = l1[l1.frame.isin(['Fm', 'Fmp'])]
+    for variable in ('yii_avg', 'npq_avg'):
+        parts.append(maxframes[['gtype', 'treatment', 'date', 'parameter', variable]].rename(columns={variable: 'value'}).assign(variable=variable))
+    return pd.concat(parts, ignore_index=True)
+
+
+def partial_sums(l1):
+    '''
+    Input:
+    l1 = level1 rows, see valid()
+
+    Output:
+    dataframe indexed by KEY with the count, sum and sum of squares of plantarea, yii_avg and npq_avg
+    '''
+    values = _values(l1)
+    values = values[values.value.notna()]
+    # float64 before squaring. the results are float32 and the variance is the difference of two large sums
+    values['value'] = values.value.astype(np.float64)
+    values['sq'] = values.value ** 2
+    sums = values.groupby(KEY, observed=True).agg(n=('value', 'size'), sum=('value', 'sum'), sumsq=('sq', 'sum'))
+    return sums.astype(np.float64)
+
+
+def stats(sums):
+    '''
+    Input:
+    sums = dataframe with the columns n, sum and sumsq
+
+    Output:
+    n, avg, stdev (with n - 1 like sd() in R) and sterr = stdev / sqrt(n). stdev is nan for a single value
+    '''
+    n = sums['n']
+    avg = sums['sum'] / n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = ((sums['sumsq'] - sums['sum'] * avg) / (n - 1)).clip(lower=0)
+        var[n < 2] = np.nan
+        stdev = np.sqrt(var)
+        sterr = stdev / np.sqrt(n)
+    return pd.DataFrame({'n': n.astype(int), 'avg': avg, 'stdev': stdev, 'sterr': sterr}, index=sums.index)
+
+
+class Level1:
+    '''
+    Incremental level1 aggregation. Pass the results of every sample-day to add(), e.g. with src.analysis.runner.run(..., level1=agg), and call export() at the end.
+    Adding a sample-day again replaces its previous contribution, the same as the result sinks.
+
+    Input:
+    gtypeinfo = dataframe of genotype_map.csv. results without a gtype column are inner joined on treatment, sampleid, roi
+    control = treatment that the changes of the other treatments are relative to
+    nsteady = number of induction curve steps at the end that are averaged for the steady state
+    '''
+
+    def __init__(self, gtypeinfo=None, control='control', nsteady=2):
+        self.gtypeinfo = gtypeinfo
+        self.control = control
+        self.nsteady = nsteady
+        self._rows = {}
+        self._partials = {}
+        self._dates = {}
+        self._order = {}
+        self._totals = pd.DataFrame(columns=SUMS, dtype=np.float64, index=pd.MultiIndex.from_tuples([], names=KEY))
+
+    def add(self, df):
+        '''
+        Input:
+        df = level0 results of one or more sample-days, with or without genotypes
+        '''
+        if 'gtype' not in df.columns:
+            df = pd.merge(df, self.gtypeinfo, on=['treatment', 'sampleid', 'roi'], how='inner')
+        df = df.copy()
+        df['date'] = pd.to_datetime(df['date'])
+        df['parameter'] = df['parameter'].astype(str)
+        # wildtype is WT whatever the spelling in genotype_map.csv
+        df['gtype'] = df['gtype'].str.upper()
+
+        # order of the parameters in the protocol for the steady state
+        for parameter, imageid in df.groupby('parameter').imageid.min().items():
+            self._order[parameter] = min(imageid, self._order.get(parameter, imageid))
+
+        for part, partdf in df.groupby(PARTITION, sort=False):
+            if part in self._partials:
+                self._totals = self._totals.sub(self._partials[part], fill_value=0)
+            l1 = valid(partdf)
+            partial = partial_sums(l1)
+            self._totals = self._totals.add(partial, fill_value=0)
+            self._totals = self._totals[self._totals['n'] > 0]
+            self._partials[part] = partial
+            self._rows[part] = l1
+            self._dates[part] = partdf['date'].min()
+
+    def _idate(self, dates):
+        # days after the first measurement, starting at 1
+        first = min(self._dates.values())
+        return (pd.to_datetime(dates) - first).dt.days + 1
+
+    def level1(self):
+        '''
+        Output:
+        the valid rows of all sample-days with idate and measurement (FvFm or IndC), sorted like output_psII_level0.csv. output_psII_level1.csv of the Rmd
+        '''
+        if not self._rows:
+            return pd.DataFrame()
+        out = pd.concat([self._rows[part] for part in sorted(self._rows)], ignore_index=True)
+        out = out.sort_values(SORT_COLUMNS, kind='mergesort')
+        out['idate'] = self._idate(out['date']).values
+        out['measurement'] = np.where(out.parameter == 'FvFm', 'FvFm', 'IndC')
+        return out
+
+    def _finish(self, table, on):
+        # idate, and the change from the control average of the same genotype and day for the other treatments
+        table = table.reset_index()
+        table.insert(table.columns.get_loc('date') + 1, 'idate', self._idate(table['date']).values)
+        base = table[table.treatment == self.control][on + ['avg', 'stdev']].rename(columns={'avg': 'baseavg', 'stdev': 'basesd'})
+        table = table.merge(base, on=on, how='left')
+        iscontrol = table.treatment == self.control
+        table.loc[iscontrol, ['baseavg', 'basesd']] = np.nan
+        table['chg'] = table['avg'] - table['baseavg']
+        # parameters in the order of the protocol rather than alphabetical
+        order = table['parameter'].map(self._order) if 'parameter' in on else 0
+        table = table.assign(_order=order).sort_values(['variable', 'gtype', 'treatment', 'date', '_order'], kind='mergesort')
+        return table.drop(columns='_order').reset_index(drop=True)
+
+    def summary(self):
+        '''
+        Output:
+        n, avg, stdev and sterr of plantarea (FvFm only), yii_avg and npq_avg for each gtype, treatment, date and parameter with baseavg, basesd and chg = avg - baseavg relative to the control treatment
+        '''
+        table = self._finish(stats(self._totals), ['variable', 'gtype', 'date', 'parameter'])
+        table.insert(table.columns.get_loc('parameter') + 1, 'measurement', np.where(table.parameter == 'FvFm', 'FvFm', 'IndC'))
+        return table
+
+    def steadystate(self):
+        '''
+        Output:
+        the same statistics of yii_avg and npq_avg pooled over the last nsteady steps of the induction curve for each gtype, treatment and date
+        '''
+        steps = sorted((p for p in self._order if p != 'FvFm'), key=self._order.get)[-self.nsteady:]
+        totals = self._totals.reset_index()
+        totals = totals[totals.parameter.isin(steps) & totals.variable.isin(['yii_avg', 'npq_avg'])]
+        sums = totals.groupby(['gtype', 'treatment', 'date', 'variable'])[SUMS].sum()
+        return self._finish(stats(sums), ['variable', 'gtype', 'date'])
+
+    def export(self, outdir):
+        '''
+        Write output_psII_level1.csv, output_psII_level1_summary.csv and output_psII_level1_steadystate.csv to outdir
+
+        Output:
+        list of the files
+        '''
+        fns = []
+        for name, table in (('output_psII_level1.csv', self.level1()),
+                            ('output_psII_level1_summary.csv', self.summary()),
+                            ('output_psII_level1_steadystate.csv', self.steadystate())):
+            fn = os.path.join(outdir, name)
+            tmpfn = fn + '.tmp'
+            table.to_csv(tmpfn, date_format='%Y-%m-%d', **CSV_OPTIONS)
+            os.replace(tmpfn, fn)
+            fns.append(fn)
+        return fns
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+import os
+import cv2 as cv2
+import numpy as np
+import pandas as pd
+
+from src.analysis import fluorescence
+from src.analysis import fvfmcache
+from src.data import multiframe
+from src.segmentation import createmasks
+from src.segmentation import roilayout
+from src.segmentation import roiobjects
+from src.util import asyncwriter
+from src.util import masked_stats
+from src.util import profiling
+from src.viz import lut_pseudocolor
+
+
+def _pcv():
+    # plantcv (and matplotlib with it) is only imported when it is used: single frame tifs, debug images and the matplotlib pseudocolor
+    from plantcv import plantcv as pcv
+    return pcv
+
+
+def readframe(row):
+    '''
+    Input:
+    row = one row of the metadata dataframe. if it has a page the frame is read directly from the multiframe tif in filename, otherwise filename is a single frame tif.
+
+    Output:
+    numpy array of the frame as is. only gray values in PSII images
+    '''
+    page = row.get('page')
+    if page is None or pd.isna(page):
+        img, _, _ = _pcv().readimage(row['filename'])
+    else:
+        img = multiframe.read_frame(row['filename'], page)
+    return img
+
+
+def frame_basename(row):
+    '''
+    Input:
+    row = one row of the metadata dataframe
+
+    Output:
+    the filename of the frame without directory, {treatment}-{yyyymmdd}-{sampleid}-{imageid}.tif, whether or not the frame was extracted
+    '''
+    page = row.get('page')
+    if page is None or pd.isna(page):
+        return os.path.basename(row['filename'])
+    return multiframe.frame_name(row['filename'], page)
+
+
+def readframes(rows):
+    '''
+    Input:
+    rows = dataframe of metadata
+
+    Output:
+    numpy array (len(rows), H, W) with the frames in the order of rows. frames from the same multiframe tif are read with a single open of the file.
+    '''
+    if 'page' in rows and rows.page.notna().all() and rows.filename.nunique() == 1:
+        frames = multiframe.read_frames(rows.filename.iloc[0], rows.page)
+    else:
+        frames = [readframe(row) for _, row in rows.iterrows()]
+    return np.stack(frames)
+
+
+def _frame_rows(fundf):
+    # metadata of the minimum and maximum fluoresence frames
+    row_min = fundf.query('frame == "Fo" or frame == "Fp"').iloc[0]
+    row_max = fundf.query('frame == "Fm" or frame == "Fmp"').iloc[0]
+    return row_min, row_max
+
+
+def _outnames(fundf, config):
+    '''
+    Output:
+    outfn = {treatment}-{yyyymmdd}-{sampleid}-{parameter}. basename of the output files
+    basefn = {treatment}-{yyyymmdd}-{sampleid}
+    sampleid
+    '''
+    _, row_max = _frame_rows(fundf)
+
+    # Get the parameter name that links these 2 frames
+    param_name = fundf['parameter'].iloc[0]
+
+    # Create a new output filename that combines existing filename with parameter
+    outfn = os.path.splitext(frame_basename(row_max))[0]
+    outfn_split = outfn.split('-')
+    basefn = "-".join(outfn_split[0:-1])
+    outfn_split[-1] = param_name
+    outfn = "-".join(outfn_split)
+    if config.get('verbose', True):
+        print(outfn)
+
+    # If debug mode is 'print', create a specific debug dir for each pim file
+    if config.get('debug') == 'print':
+        debug_outdir = os.path.join(config['debugdir'], outfn)
+        if not os.path.exists(debug_outdir):
+            os.makedirs(debug_outdir)
+        _pcv().params.debug_outdir = debug_outdir
+
+    return outfn, basefn, outfn_split[2]
+
+
+def image_avg(fundf, config, fvfm=None, arrays=None):
+    '''
+    Input:
+    fundf = dataframe of metadata with exactly 2 rows (Fo/Fm or F'/Fm') for one treatment, sampleid, jobdate and parameter
+    config = dict of pipeline settings (outdir, maskdir, fluordir, debugdir, pixelresolution, maskmode, roi, debug and optionally pseudocolor, persist_fvfm, fvfm_cache_mb and verbose). roi is a layout or a dict of sampleid -> layout, see src.segmentation.roilayout. The keyword arguments of pcv.roi.multi also work
+    fvfm = dict returned from the FvFm group of the same day. If None it is taken from the FvFm cache or loaded from the FvFm output files, see get_fvfm()
+    arrays = optional dict to collect the images for src.data.arraystore or src.data.pixelstore instead of writing the _fvfm, _yii and _npq tifs. see sampleday_avg()
+
+    Output:
+    outdf = dataframe with one row per frame per roi
+    fvfm = dict with keys labels, member, inframe (see src.segmentation.roiobjects.label_objects), mask (all plants after roi filter) and fmax (Fm) to pass to the other parameters of the same day
+
+    Processes a single parameter. sampleday_avg() processes all parameters of a day and computes the induction curve in one step.
+    '''
+
+    # read images. only gray values in PSII images
+    row_min, row_max = _frame_rows(fundf)
+    with profiling.stage('import'):
+        imgmin = readframe(row_min)
+        img = readframe(row_max)
+
+    # We always identify the leaf area using Fm and then apply the mask to subsequent frames in the induction curve for the same day and sample
+    if fundf['parameter'].iloc[0] == 'FvFm':
+        return fvfm_avg(fundf, imgmin, img, config, arrays)
+
+    if fvfm is None:
+        fvfm = get_fvfm(fundf, config)
+    with profiling.stage('yii_npq'):
+        YII = fluorescence.yii(imgmin, img, fvfm['mask'])
+        NPQ = fluorescence.npq(fvfm['fmax'], img, fvfm['mask'])
+    return step_avg(fundf, imgmin, img, YII, NPQ, config, fvfm, arrays), fvfm
+
+
+def fvfm_avg(fundf, imgmin, img, config, arrays=None):
+    '''
+    Input:
+    fundf = dataframe of metadata with the Fo and Fm rows of one sample-day
+    imgmin = Fo image
+    img = Fm image
+    config = dict of pipeline settings. see image_avg()
+    arrays = see image_avg()
+
+    Output:
+    outdf = dataframe with one row per frame per roi
+    fvfm = dict with the plant objects, mask and Fm. see image_avg()
+    '''
+    outfn, _, sampleid = _outnames(fundf, config)
+    fmaxdir = os.path.join(config['fluordir'], sampleid)
+    os.makedirs(fmaxdir, exist_ok=True)
+
+    # create mask from max fluorescence
+    with profiling.stage('psIImask'):
+        mask = createmasks.psIImask(img, mode=config['maskmode'])
+
+    # find objects and setup roi to designate where the plants should be
+    with profiling.stage('roi_filter'):
+        # the label image of each layout is only rasterized once per process
+        layout = roilayout.layout_for(config['roi'], sampleid)
+        roilabels = roilayout.label_image(img.shape, layout)
+        labels, member, inframe = roiobjects.label_objects(mask, roilabels, roilayout.count(layout))
+
+        # mask of all plants after roi filter
+        newmask = np.where(member.any(axis=1)[labels], 255, 0).astype(np.uint8)
+
+    # compute fv/fm and save to file
+    with profiling.stage('yii_npq'):
+        # same values as Fv from pcv.fluor_fvfm divided by Fm, without the histogram. float32 for imwrite
+        YII = fluorescence.fvfm(imgmin, img, mask)
+
+        # NPQ will always be an array of 0s
+        NPQ = np.zeros_like(YII)
+
+    # the files are written in the background, see src.util.asyncwriter. src.analysis.runner waits for them before the results of the day are cached
+    writer = asyncwriter.get_writer(config)
+    unit = _daykey(fundf)
+    with profiling.stage('write'):
+        if arrays is None:
+            writer.imwrite(unit, outfn, os.path.join(fmaxdir, outfn + '_fvfm.tif'), YII)
+        else:
+            _collect_arrays(arrays, fundf, YII, NPQ)
+            arrays.update(fmax=img, mask=newmask, labels=labels, member=member)
+
+        # Fm and the mask are kept in memory for the induction curve. the files are only needed to check the masks or to process parameters in another session
+        if config.get('persist_fvfm', True):
+            # print Fm
+            writer.imwrite(unit, outfn, os.path.join(fmaxdir, outfn + '_fmax.tif'), img)
+
+            # save mask of all plants to file after roi filter. the same file as pcv.print_image
+            writer.imwrite(unit, outfn, os.path.join(config['maskdir'], outfn + '_mask.png'), newmask)
+
+    fvfm = {'labels': labels, 'member': member, 'inframe': inframe, 'mask': newmask, 'fmax': img}
+    fvfmcache.get_cache(config).put(_daykey(fundf), fvfm)
+    outdf = roi_avg(fundf, imgmin, img, YII, NPQ, fvfm, config['pixelresolution'], config.get('verbose', True))
+    with profiling.stage('pseudocolor'):
+        save_pseudocolor(YII, NPQ, newmask, outfn, sampleid, config, unit)
+
+    return outdf, fvfm
+
+
+def _collect_arrays(arrays, fundf, YII, NPQ):
+    # images of one parameter for src.data.arraystore.ArrayStore.append()
+    arrays.setdefault('parameters', []).append(str(fundf['parameter'].iloc[0]))
+    arrays.setdefault('yii', []).append(YII)
+    arrays.setdefault('npq', []).append(NPQ)
+
+
+def _daykey(fundf):
+    # (treatment, sampleid, jobdate) of the sample-day
+    treatment, sampleid, jobdate = fundf[['treatment', 'sampleid', 'jobdate']].iloc[0]
+    return treatment, sampleid, pd.Timestamp(jobdate)
+
+
+def load_fvfm(fundf, config):
+    '''
+    Input:
+    fundf = dataframe of metadata of any parameter of the sample-day
+    config = dict of pipeline settings. see image_avg()
+
+    Output:
+    fvfm dict rebuilt from the Fm and mask files written by fvfm_avg() or None if they do not exist.
+    The objects of the mask are the plants that were kept by the roi filter so the roi membership is the same as in fvfm_avg()
+    '''
+    _, basefn, sampleid = _outnames(fundf, config)
+    img = cv2.imread(os.path.join(config['fluordir'], sampleid, basefn + '-FvFm_fmax.tif'), cv2.IMREAD_UNCHANGED)
+    newmask = cv2.imread(os.path.join(config['maskdir'], basefn + '-FvFm_mask.png'), cv2.IMREAD_GRAYSCALE)
+    if img is None or newmask is None:
+        return None
+
+    layout = roilayout.layout_for(config['roi'], sampleid)
+    roilabels = roilayout.label_image(img.shape, layout)
+    labels, member, inframe = roiobjects.label_objects(newmask, roilabels, roilayout.count(layout))
+    return {'labels': labels, 'member': member, 'inframe': inframe, 'mask': newmask, 'fmax': img}
+
+
+def get_fvfm(fundf, config):
+    '''
+    Input:
+    fundf = dataframe of metadata of any parameter of the sample-day
+    config = dict of pipeline settings. see image_avg()
+
+    Output:
+    fvfm dict of the sample-day from the in-memory cache (see src.analysis.fvfmcache) or, if it was evicted or processed in another process, from the files written by fvfm_avg()
+    '''
+    cache = fvfmcache.get_cache(config)
+    key = _daykey(fundf)
+    fvfm = cache.get(key)
+    if fvfm is None:
+        with profiling.stage('import'):
+            fvfm = load_fvfm(fundf, config)
+        if fvfm is None:
+            raise RuntimeError('No FvFm results were found for %s. FvFm must be processed before the induction curve of the same day.' % _outnames(fundf, config)[0])
+        cache.put(key, fvfm)
+    return fvfm
+
+
+def step_avg(fundf, imgmin, img, YII, NPQ, config, fvfm, arrays=None):
+    '''
+    Input:
+    fundf = dataframe of metadata with the Fp and Fmp rows of one induction curve step
+    imgmin = F' image
+    img = Fm' image
+    YII = YII image computed with the FvFm mask
+    NPQ = NPQ image computed with Fm
+    config = dict of pipeline settings. see image_avg()
+    fvfm = dict returned from fvfm_avg() for the same day
+    arrays = see image_avg()
+
+    Output:
+    dataframe with one row per frame per roi. YII and NPQ are saved to file or added to arrays.
+    '''
+    outfn, _, sampleid = _outnames(fundf, config)
+    fmaxdir = os.path.join(config['fluordir'], sampleid)
+    os.makedirs(fmaxdir, exist_ok=True)
+
+    writer = asyncwriter.get_writer(config)
+    unit = _daykey(fundf)
+    with profiling.stage('write'):
+        if arrays is None:
+            writer.imwrite(unit, outfn, os.path.join(fmaxdir, outfn + '_yii.tif'), YII)
+            writer.imwrite(unit, outfn, os.path.join(fmaxdir, outfn + '_npq.tif'), NPQ)
+        else:
+            _collect_arrays(arrays, fundf, YII, NPQ)
+
+    outdf = roi_avg(fundf, imgmin, img, YII, NPQ, fvfm, config['pixelresolution'], config.get('verbose', True))
+    with profiling.stage('pseudocolor'):
+        save_pseudocolor(YII, NPQ, fvfm['mask'], outfn, sampleid, config, unit)
+
+    return outdf
+
+
+def induction_avg(inddf, config, fvfm=None, arrays=None):
+    '''
+    Input:
+    inddf = dataframe of metadata with the Fp and Fmp rows of every induction curve step of one sample-day
+    config = dict of pipeline settings. see image_avg()
+    fvfm = dict returned from fvfm_avg() for the same day. If None see get_fvfm()
+    arrays = see image_avg()
+
+    Output:
+    list of dataframes, one per step in the order of parameter
+
+    All F' and Fm' frames of the day are loaded as (n_steps, H, W) stacks and YII and NPQ are computed for every step at once with the Fm and mask already in memory.
+    '''
+    grps = [grpdf for _, grpdf in inddf.groupby('parameter', sort=True, observed=True)]
+    if not grps:
+        return []
+
+    if fvfm is None:
+        fvfm = get_fvfm(inddf, config)
+
+    rows = [_frame_rows(grpdf) for grpdf in grps]
+    with profiling.stage('import'):
+        fp = readframes(pd.DataFrame([r[0] for r in rows]))
+        fmp = readframes(pd.DataFrame([r[1] for r in rows]))
+
+    with profiling.stage('yii_npq'):
+        YII = fluorescence.yii(fp, fmp, fvfm['mask'])
+        NPQ = fluorescence.npq(fvfm['fmax'], fmp, fvfm['mask'])
+
+    return [step_avg(grpdf, fp[k], fmp[k], YII[k], NPQ[k], config, fvfm, arrays)
+            for k, grpdf in enumerate(grps)]
+
+
+def roi_avg(fundf, imgmin, img, YII, NPQ, fvfm, pixelresolution, verbose=True):
+    '''
+    Input:
+    verbose = print the rois without a plant
+
+    Output:
+    copy of fundf for each roi with the mean and std dev of fluoresence, YII and NPQ, plant area and quality checks of each plant
+    '''
+    labels, member, inframe = fvfm['labels'], fvfm['member'], fvfm['inframe']
+
+    # Make as many copies of incoming dataframe as there are ROIs so all results can be saved
+    nroi = member.shape[1]
+    outdf = pd.concat([fundf] * nroi)
+    outdf.imageid = outdf.imageid.astype('uint8')
+
+    # Calc mean and std dev of fluoresence, YII, and NPQ for all plants at once. every roi is the combination of the plant objects that overlap it
+    with profiling.stage('stats'):
+        avg, std, npixels = masked_stats.roi_stats([imgmin, img, YII, NPQ], labels, member)
+    roi_inframe = ~(member & ~inframe[:, None]).any(axis=0)
+
+    # Initialize lists to store variables for each ROI. each roi has 2 rows, one for each image
+    frame_avg = []
+    yii_avg = []
+    yii_std = []
+    npq_avg = []
+    npq_std = []
+    plantarea = []
+    ithroi = []
+    inbounds = []
+    for i in range(nroi):
+        ithroi.extend([i, i])
+        if npixels[i] > 0:
+            frame_avg.extend([avg[0, i], avg[1, i]])
+            yii_avg.extend([avg[2, i]] * 2)
+            yii_std.extend([std[2, i]] * 2)
+            npq_avg.extend([avg[3, i]] * 2)
+            npq_std.extend([std[3, i]] * 2)
+            # Check if plant is compeltely within the frame of the image
+            inbounds.extend([bool(roi_inframe[i])] * 2)
+            #Compute the plantarea in mm^2
+            plantarea.extend([npixels[i] * pixelresolution**2.] * 2)
+        else:
+            if verbose:
+                print('!!! No plant detected in roi ', str(i))
+            frame_avg.extend([0, 0])
+            yii_avg.extend([np.nan, np.nan])
+            yii_std.extend([np.nan, np.nan])
+            npq_avg.extend([np.nan, np.nan])
+            npq_std.extend([np.nan, np.nan])
+            inbounds.extend([np.nan, np.nan])
+            plantarea.extend([0, 0])
+
+    # check YII values for uniqueness between all ROI. nonunique ROI suggests the plants grew into each other and can no longer be reliably separated in image processing.
+    # a single value isn't always robust. I think because there ae small independent objects that fall in one roi but not the other that change the object within the roi slightly.
+    # also note, I originally designed this for trays of 2 pots. It will not detect if e.g. 2 out of 9 plants grow into each other
+    rounded_avg = [round(n, 3) for n in yii_avg]
+    rounded_std = [round(n, 3) for n in yii_std]
+    isunique = not (rounded_avg.count(rounded_avg[0]) == len(yii_avg) and
+                    rounded_std.count(rounded_std[0]) == len(yii_std))
+
+    # save all values to outgoing dataframe
+    outdf['roi'] = ithroi
+    outdf['frame_avg'] = frame_avg
+    outdf['yii_avg'] = yii_avg
+    outdf['npq_avg'] = npq_avg
+    outdf['yii_std'] = yii_std
+    outdf['npq_std'] = npq_std
+    outdf['plantarea'] = plantarea
+    outdf['obj_in_frame'] = inbounds
+    outdf['unique_roi'] = isunique
+
+    return outdf
+
+
+def save_pseudocolor(YII, NPQ, newmask, outfn, sampleid, config, unit=None):
+    '''
+    Save pseudocolor images of YII and NPQ with a scalebar to outdir/pseudocolor_images/<sampleid>/
+    config['pseudocolor'] selects the renderer: 'lut' (default) writes the png directly with a colormap lookup table, 'matplotlib' uses pcv.visualize.pseudocolor, None writes no pseudocolor images
+    unit = key of the sample-day for the background writer. the lut images are encoded and written by src.util.asyncwriter, the matplotlib figures in this thread
+    '''
+    if config.get('pseudocolor', 'lut') is None:
+        return
+
+    # Output a pseudocolor of NPQ and YII for each induction period for each image
+    pixelresolution = config['pixelresolution']
+    imgdir = os.path.join(config['outdir'], 'pseudocolor_images', sampleid)
+    os.makedirs(imgdir, exist_ok=True)
+
+    if config.get('pseudocolor', 'lut') == 'lut':
+        writer = asyncwriter.get_writer(config)
+        npqfn = os.path.join(imgdir, outfn + '_NPQ.png')
+        writer.submit(unit, outfn, npqfn, lut_pseudocolor.save_pseudocolor, npqfn, NPQ, newmask,
+                      cmap='inferno',
+                      min_value=0,
+                      max_value=2.5,
+                      pixelresolution=pixelresolution,
+                      barwidth=20)
+        yiifn = os.path.join(imgdir, outfn + '_YII.png')
+        writer.submit(unit, outfn, yiifn, lut_pseudocolor.save_pseudocolor, yiifn, YII, newmask,
+                      cmap='imagingwin',
+                      min_value=0,
+                      max_value=1,
+                      pixelresolution=pixelresolution,
+                      barwidth=20)
+        return
+
+    # matplotlib is only imported for these figures
+    from matplotlib import pyplot as plt
+    from src.viz import add_scalebar, custom_colormaps
+    pcv = _pcv()
+    # all text is Arial, as in the rcParams that scripts/ProcessImages.py used to set for the whole session
+    with plt.rc_context({'font.family': 'Arial'}):
+        npq_img = pcv.visualize.pseudocolor(NPQ,
+                                            obj=None,
+                                            mask=newmask,
+                                            cmap='inferno',
+                                            axes=False,
+                                            min_value=0,
+                                            max_value=2.5,
+                                            background='black',
+                                            obj_padding=0)
+        npq_img = add_scalebar.add_scalebar(npq_img,
+                                            pixelresolution=pixelresolution,
+                                            barwidth=20,
+                                            barlocation='lower left')
+        # If you change the output size and resolution you will need to adjust the  timelapse video script
+        npq_img.set_size_inches(6,6, forward=False)
+        npq_img.savefig(os.path.join(imgdir, outfn + '_NPQ.png'),
+                        bbox_inches='tight',
+                        dpi = 150)
+        npq_img.clf()
+
+        yii_img = pcv.visualize.pseudocolor(YII,
+                                            obj=None,
+                                            mask=newmask,
+                                            cmap=custom_colormaps.get_cmap('imagingwin'),
+                                            axes=False,
+                                            min_value=0,
+                                            max_value=1,
+                                            background='black',
+                                            obj_padding=0)
+        yii_img = add_scalebar.add_scalebar(yii_img,
+                                            pixelresolution=pixelresolution,
+                                            barwidth = 20,
+                                            barlocation = 'lower left')
+        yii_img.set_size_inches(6,6, forward=False)
+        yii_img.savefig(os.path.join(imgdir, outfn + '_YII.png'),
+                        bbox_inches='tight',
+                        dpi = 150)
+        yii_img.clf()
+
+
+def sampleday_avg(sampledf, config, arrays=None):
+    '''
+    Input:
+    sampledf = dataframe of metadata for a single treatment, sampleid and jobdate. parameter must be an ordered categorical with FvFm first.
+    config = dict of pipeline settings. see image_avg()
+    arrays = optional empty dict. if given the _fvfm, _yii and _npq tifs are not written and arrays is filled with parameters (list of names), yii and npq (lists of images in the order of parameters), fmax, mask, labels and member for src.data.arraystore and src.data.pixelstore
+
+    Output:
+    dataframe with the results of FvFm and every induction curve parameter of the day
+
+    The FvFm results (plant objects, rois, mask and Fm) are passed explicitly to the induction curve parameters so each sample-day is independent of every other.
+    '''
+
+    # pcv.params is module state so it needs to be set in each worker process. plantcv is not imported if neither the masks nor debug images need it
+    if config.get('debug') not in (None, 'None') or config['maskmode'] == 'thresh':
+        _pcv().params.debug = config.get('debug')
+
+    isfvfm = sampledf.parameter == 'FvFm'
+    if not isfvfm.any():
+        raise RuntimeError('No FvFm frames for %s. FvFm is needed to process the induction curve of the same day.' % '-'.join(str(v) for v in sampledf[['treatment', 'sampleid', 'jobdate']].iloc[0]))
+
+    outdf, fvfm = image_avg(sampledf[isfvfm], config, arrays=arrays)
+    grplist = [outdf] + induction_avg(sampledf[~isfvfm], config, fvfm, arrays)
+
+    return pd.concat(grplist)
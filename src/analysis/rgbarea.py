@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+'''
+Plant area from rgb photos of the trays as a cross-check of the plantarea of the PAM images.
+A calibration table, e.g. diy_data/rgb_calibration.csv, has one row per region of plants in a photo:
+    filename = image file in the rgb directory, e.g. tray2.png
+    sampleid = tray of the photo
+    pixels_per_inch = scale of the photo, e.g. from "Set Scale" in ImageJ across a 2" pot
+    x, y, width, height = rectangle around the plants of the region in pixels. every plant that overlaps it is counted, like pcv.roi_objects(..., roi_type='partial')
+and optionally treatment, date, roi and gtype to join the areas with the PAM results, and nplants, the number of plants in the region (default 1)
+'''
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import cv2 as cv2
+
+from src.segmentation import createmasks
+from src.util import strip_whitespace
+
+REQUIRED = ['filename', 'sampleid', 'pixels_per_inch', 'x', 'y', 'width', 'height']
+# columns of the calibration table that identify the PAM plants of a region
+JOIN_KEYS = ['treatment', 'sampleid', 'date', 'roi', 'gtype']
+
+
+def load_calibration(fn):
+    '''
+    Input:
+    fn = csv file with the calibration table, see the top of this module
+
+    Output:
+    dataframe of the calibration with nplants filled in
+    '''
+    calib = strip_whitespace.strip_dfwhitespace(pd.read_csv(fn, skipinitialspace=True))
+    missing = [c for c in REQUIRED if c not in calib.columns]
+    if missing:
+        raise KeyError('%s is missing the columns %s' % (fn, ', '.join(missing)))
+    if 'nplants' not in calib.columns:
+        calib['nplants'] = 1
+    if 'date' in calib.columns:
+        calib['date'] = pd.to_datetime(calib['date'])
+    return calib
+
+
+def plant_mask(img, athresh=115, minsize=200):
+    '''
+    Input:
+    img = BGR image
+    athresh = plants are at or below this value of the green-magenta (a) channel of LAB
+    minsize = objects with fewer pixels are removed
+
+    Output:
+    uint8 mask (0/255) of the plants. The same steps as pcv.rgb2gray_lab(img, 'a'), pcv.threshold.binary(..., 'dark') and pcv.fill with numpy/OpenCV only
+    '''
+    a = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)[:, :, 1]
+    return createmasks.remove_small_objects(a <= athresh, minsize)
+
+
+def region_areas(mask, regions):
+    '''
+    Input:
+    mask = binary mask of the plants
+    regions = list of (x, y, width, height) rectangles
+
+    Output:
+    int64 array with the number of pixels of the objects that overlap each rectangle. the mask is labeled once for all rectangles
+    '''
+    # 8-connectivity like the contours of pcv.find_objects
+    nobj, labels = cv2.connectedComponents((mask > 0).astype(np.uint8), connectivity=8, ltype=cv2.CV_32S)
+    npixels = np.bincount(labels.ravel(), minlength=nobj)
+    npixels[0] = 0
+    out = np.zeros(len(regions), dtype=np.int64)
+    for i, (x, y, width, height) in enumerate(regions):
+        objects = np.unique(labels[max(y, 0):y + height, max(x, 0):x + width])
+        out[i] = npixels[objects].sum()
+    return out
+
+
+def _image_areas(args):
+    # all regions of one photo. unpack for ProcessPoolExecutor.map
+    fn, calib, athresh, minsize = args
+    img = cv2.imread(fn, cv2.IMREAD_COLOR)
+    if img is None:
+        raise IOError('Could not read %s' % fn)
+    mask = plant_mask(img, athresh, minsize)
+    regions = calib[['x', 'y', 'width', 'height']].astype(int).itertuples(index=False)
+    out = calib.copy()
+    out['pixels'] = region_areas(mask, list(regions))
+    mm_per_pixel = 25.4 / out['pixels_per_inch']
+    out['rgb_area'] = out['pixels'] * mm_per_pixel ** 2 / out['nplants']
+    return out
+
+
+def estimate(calib, rgbdir, workers=1, athresh=115, minsize=200):
+    '''
+    Input:
+    calib = calibration table from load_calibration()
+    rgbdir = directory of the photos, e.g. diy_data/rgb
+    workers = number of processes. each process handles one photo at a time
+    athresh, minsize = see plant_mask()
+
+    Output:
+    calib with pixels, the number of plant pixels of each region, and rgb_area, the area per plant in mm^2, in the order of calib
+    '''
+    jobs = [(os.path.join(rgbdir, fn), grp, athresh, minsize) for fn, grp in calib.groupby('filename', sort=False)]
+    if workers is None or workers <= 1:
+        results = list(map(_image_areas, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_image_areas, jobs))
+    return pd.concat(results).loc[calib.index]
+
+
+def join_pam(areas, level0):
+    '''
+    Input:
+    areas = output of estimate()
+    level0 = results of the PAM images with genotypes, e.g. output_psII_level0.csv
+
+    Output:
+    areas with pam_plantarea, the mean plantarea (mm^2) of FvFm of the PAM plants that match the treatment, sampleid, date, roi and gtype of each region,
+    using the columns that are in the calibration table. Without a date the last day of each tray is used because the photos were taken at the end of the experiment
+    '''
+    keys = [k for k in JOIN_KEYS if k in areas.columns]
+    pam = level0[level0.parameter == 'FvFm'].copy()
+    pam['date'] = pd.to_datetime(pam['date'])
+    if 'date' not in keys:
+        pam = pam[pam['date'] == pam.groupby(['treatment', 'sampleid'])['date'].transform('max')]
+    if 'gtype' in keys:
+        pam['gtype'] = pam['gtype'].str.upper()
+        areas = areas.assign(gtype=areas['gtype'].str.upper())
+    # both frames of FvFm have the same plant area
+    pam = pam.groupby(keys, as_index=False).plantarea.mean().rename(columns={'plantarea': 'pam_plantarea'})
+    return areas.merge(pam, on=keys, how='left')
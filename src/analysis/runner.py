@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import itertools
+import pandas as pd
+
+from src.analysis import psII
+from src.data import arraystore
+from src.data import pixelstore
+from src.util import asyncwriter
+from src.util import profiling
+from src.util import resultcache
+
+# Each unique combination of these columns is one independent unit of work: the FvFm measurement plus the induction curve of the same day
+WORKUNIT = ['treatment', 'sampleid', 'jobdate']
+# most sample-days that one worker processes in a row, see run()
+MAX_CHUNK = 4
+
+
+def worklist(fdf, pimframes):
+    '''
+    Input:
+    fdf = dataframe from src.data.import_snapshots.import_snapshots()
+    pimframes = dataframe of pimframes_map.csv with whitespace stripped
+
+    Output:
+    dataframe with one row per frame to analyze, the same as the cells in scripts/ProcessImages.py:
+    absorptivity and FRon frames and the duplicate Fm and Fo frames are removed and parameter is an ordered categorical with FvFm first
+    '''
+    # filter the few rows of pimframes before the merge instead of the frames of every file
+    frames = pimframes[~pimframes.parameter.str.contains('Abs') & ~pimframes.parameter.str.contains('FRon')]
+    frames = frames[(frames.parameter != 'FvFm') | frames.frame.isin(['Fo', 'Fm'])]
+    df = pd.merge(fdf.reset_index(), frames, on=['imageid'], how='right')
+    df['parameter'] = pd.Categorical(df.parameter,
+                                     categories=pimframes.parameter.unique(),
+                                     ordered=True)
+    return df
+
+
+def workunit_label(sampledf):
+    '''
+    Output:
+    treatment-sampleid-yyyymmdd of the work unit, e.g. for messages
+    '''
+    treatment, sampleid, jobdate = sampledf[WORKUNIT].iloc[0]
+    return '%s-%s-%s' % (treatment, sampleid, pd.Timestamp(jobdate).strftime('%Y%m%d'))
+
+
+def shard_of(label, nshards):
+    '''
+    Input:
+    label = work unit label, see workunit_label()
+    nshards = number of shards
+
+    Output:
+    0-based shard of the work unit. sha1 of the label so every machine and every python version assigns the same shard
+    '''
+    return int(hashlib.sha1(label.encode()).hexdigest()[:12], 16) % nshards
+
+
+def select_shard(df, shard, nshards):
+    '''
+    Input:
+    df = work list from worklist()
+    shard = 0-based shard to keep
+    nshards = number of shards, e.g. the number of machines
+
+    Output:
+    rows of df of the work units (treatment, sampleid, jobdate) in the shard. the shards of all machines together cover every work unit exactly once
+    '''
+    units = df[WORKUNIT].drop_duplicates()
+    keep = [shard_of('%s-%s-%s' % (t, s, pd.Timestamp(d).strftime('%Y%m%d')), nshards) == shard
+            for t, s, d in units.itertuples(index=False)]
+    units = units[keep]
+    return df.merge(units, on=WORKUNIT, how='inner')
+
+
+def _start(sampledf, config):
+    # processes the sample-day. its output files may still be in the queue of the background writer
+    profdir = config.get('profdir')
+    profiling.enable(profdir is not None)
+    profiling.set_group(workunit_label(sampledf))
+    try:
+        with profiling.stage('sampleday'):
+            return _process(sampledf, config)
+    finally:
+        if profdir is not None:
+            profiling.flush(profdir)
+
+
+def _finish(sampledf, config, result):
+    # barrier for the files of the sample-day. the results are only cached once the files are written so a cache hit never misses its images
+    outdf, arrays, key = result
+    profiling.set_group(workunit_label(sampledf))
+    with profiling.stage('write_flush'):
+        asyncwriter.get_writer(config).flush(psII._daykey(sampledf))
+    if key is not None:
+        resultcache.save(config['cachedir'], key, outdf)
+    return outdf, arrays
+
+
+def _run_chunk(workunits):
+    # a few consecutive sample-days in one worker, pipelined like the serial loop so the files of each are written while the next is processed
+    return list(_run_serial(workunits))
+
+
+def _run_serial(workunits):
+    # the files of each sample-day are written in the background while the next sample-day is processed
+    pending = None
+    try:
+        for sampledf, config in workunits:
+            result = _start(sampledf, config)
+            if pending is not None:
+                yield _finish(*pending)
+            pending = (sampledf, config, result)
+        if pending is not None:
+            yield _finish(*pending)
+    finally:
+        if workunits:
+            asyncwriter.get_writer(workunits[-1][1]).flush()
+            # the records of the last _finish, the others are flushed by the next _start
+            if workunits[-1][1].get('profdir') is not None:
+                profiling.flush(workunits[-1][1]['profdir'])
+
+
+def _process(sampledf, config):
+    # returns the results, with an array or pixel store the images of the sample-day, and the cache key if the results should be cached
+    arrays = {} if config.get('arraystore') or config.get('pixelstore') else None
+
+    # without a cache directory every sample-day is processed
+    cachedir = config.get('cachedir')
+    if cachedir is None:
+        return psII.sampleday_avg(sampledf, config, arrays), arrays, None
+
+    # the key changes if any input file or any setting that affects the results changes
+    with profiling.stage('cache_lookup'):
+        key = resultcache.cache_key(sampledf.filename, config['paramhash'], workunit_label(sampledf), config.get('hashdb'))
+        outdf = resultcache.load(cachedir, key)
+    if outdf is not None:
+        if config.get('verbose', True):
+            print('cached: ' + workunit_label(sampledf))
+        return outdf, None, None
+
+    return psII.sampleday_avg(sampledf, config, arrays), arrays, key
+
+
+def run(df, config, workers=1, sink=None, level1=None):
+    '''
+    Input:
+    df = dataframe of metadata with one row per frame. see scripts/ProcessImages.py
+    config = dict of pipeline settings. see src.analysis.psII.image_avg(). If config has profdir, the time, memory and I/O of each stage are recorded there (see src.util.profiling). If config has cachedir, sample-days whose input files and paramhash (see src.util.resultcache.params_hash) are unchanged are loaded from the cache instead of being processed. With hashdb, e.g. the manifest sqlite, the digests of the input files are kept there so unchanged files are not read to compute the cache key.
+    If config has arraystore, the YII and NPQ images are appended to that hdf5 file (see src.data.arraystore) by this process instead of being written as tifs by the workers.
+    If config has pixelstore, the YII and NPQ values of the plant pixels are written to one npz file per sample-day in that directory (see src.data.pixelstore), also instead of the tifs.
+    If config has write_threads, the image files are written in the background (see src.util.asyncwriter) and every file is written when run() returns. A failed write raises src.util.asyncwriter.WriteError with the parameter group of the file.
+    workers = number of processes. 1 runs serially in the current process.
+    sink = optional src.data.resultsink.ResultSink. the results of each sample-day are written to the sink as soon as they are finished instead of being returned
+    level1 = optional src.analysis.level1.Level1. the results of each sample-day are added to the level1 summaries as soon as they are finished
+
+    Output:
+    dataframe with the results of all sample-days, in the same order as the serial loop. None if sink is given
+    '''
+
+    stores = []
+    if config.get('arraystore'):
+        stores.append(arraystore.ArrayStore(config['arraystore']))
+    if config.get('pixelstore'):
+        stores.append(pixelstore.PixelStore(config['pixelstore']))
+
+    # groupby sorts the keys so the order of the work units (and the output) is deterministic
+    workunits = []
+    for (treatment, sampleid, jobdate), sampledf in df.groupby(WORKUNIT, sort=True, observed=True):
+        unitconfig = config
+        if config.get('cachedir') and not all(store.has(treatment, sampleid, jobdate) for store in stores):
+            # cached results have no images so process sample-days that are missing from the store
+            unitconfig = dict(config, cachedir=None)
+        workunits.append((sampledf, unitconfig))
+
+    if workers is None or workers <= 1:
+        return _collect(_run_serial(workunits), sink, stores, level1)
+
+    # each task is a chunk of up to MAX_CHUNK sample-days so the writes overlap with the next sample-day in every worker as well.
+    # small chunks keep every worker busy and the results (and images for the stores) of only a few sample-days in memory
+    size = max(1, min(MAX_CHUNK, len(workunits) // workers))
+    chunks = [workunits[i:i + size] for i in range(0, len(workunits), size)]
+    # map returns the results in the order of the work units regardless of which worker finishes first
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return _collect(itertools.chain.from_iterable(pool.map(_run_chunk, chunks)), sink, stores, level1)
+
+
+def _collect(results, sink, stores=(), level1=None):
+    outdfs = []
+    for outdf, arrays in results:
+        if arrays:
+            with profiling.stage('array_write'):
+                treatment, sampleid, jobdate = outdf[WORKUNIT].iloc[0]
+                for store in stores:
+                    store.append(treatment, sampleid, jobdate, arrays)
+        if level1 is not None:
+            with profiling.stage('level1'):
+                level1.add(outdf)
+        if sink is None:
+            outdfs.append(outdf)
+        else:
+            with profiling.stage('sink_write'):
+                sink.write(outdf)
+    if sink is None:
+        return pd.concat(outdfs)
+    return None
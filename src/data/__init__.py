@@ -1 +1 @@
-__all__ = ["import_snapshots"]
+__all__ = ["arraystore", "import_snapshots", "manifest", "multiframe", "pixelstore", "resultstore", "validate", "watchfolder"]
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pandas as pd
+import cv2 as cv2
+
+# YII and NPQ of each parameter are chunked by image so a single frame or a block of dates can be read without decompressing the rest
+COMPRESSION = {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}
+
+
+def _h5py():
+    # h5py is only needed if you use the array store
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('The array store needs h5py. Install it with "conda install h5py" or "pip install h5py"')
+    return h5py
+
+
+def _datestr(date):
+    return pd.Timestamp(date).strftime('%Y-%m-%d')
+
+
+class ArrayStore:
+    '''
+    HDF5 store of the fluorescence images of an experiment. Replaces the _fvfm.tif, _yii.tif and _npq.tif files in fluordir.
+    There is one group per sample, /<treatment>/<sampleid>, with the datasets
+        yii, npq = float32 (date, parameter, height, width). for FvFm yii is Fv/Fm and npq is 0
+        fmax = Fm of each date (date, height, width)
+        mask = mask of all plants of each date (date, height, width)
+        dates = yyyy-mm-dd of each date in the order they were added
+    and the attribute parameters with the names along the parameter axis.
+    Dates are appended as they are processed. Writing a date that already exists replaces it.
+    HDF5 files must only be written by one process, src.analysis.runner.run() does all writes in the main process.
+
+    Input:
+    fn = hdf5 file, e.g. output/from_diy_data/fluorescence.h5
+    '''
+
+    def __init__(self, fn):
+        self.fn = fn
+        fdir = os.path.dirname(fn)
+        if fdir:
+            os.makedirs(fdir, exist_ok=True)
+
+    def _open(self, mode='r'):
+        return _h5py().File(self.fn, mode)
+
+    def append(self, treatment, sampleid, date, arrays):
+        '''
+        Input:
+        treatment, sampleid, date = the sample-day
+        arrays = dict with parameters (list of names), yii and npq (lists of 2d arrays in the order of parameters), fmax and mask. see src.analysis.psII.sampleday_avg()
+        '''
+        h5py = _h5py()
+        parameters = list(arrays['parameters'])
+        yii = np.stack(arrays['yii']).astype(np.float32, copy=False)
+        npq = np.stack(arrays['npq']).astype(np.float32, copy=False)
+        fmax, mask = arrays['fmax'], arrays['mask']
+        _, height, width = yii.shape
+
+        with self._open('a') as f:
+            name = '%s/%s' % (treatment, sampleid)
+            if name not in f:
+                grp = f.create_group(name)
+                grp.attrs['parameters'] = np.array(parameters, dtype=h5py.string_dtype())
+                for kind in ('yii', 'npq'):
+                    grp.create_dataset(kind, shape=(0, len(parameters), height, width), maxshape=(None, len(parameters), height, width),
+                                       dtype=np.float32, chunks=(1, 1, height, width), fillvalue=np.nan, **COMPRESSION)
+                grp.create_dataset('fmax', shape=(0, height, width), maxshape=(None, height, width),
+                                   dtype=fmax.dtype, chunks=(1, height, width), **COMPRESSION)
+                grp.create_dataset('mask', shape=(0, height, width), maxshape=(None, height, width),
+                                   dtype=np.uint8, chunks=(1, height, width), **COMPRESSION)
+                grp.create_dataset('dates', shape=(0,), maxshape=(None,), dtype='S10')
+            grp = f[name]
+
+            # the parameter axis is fixed when the sample is created
+            known = [p.decode() if isinstance(p, bytes) else p for p in grp.attrs['parameters']]
+            missing = [p for p in parameters if p not in known]
+            if missing:
+                raise ValueError('%s has no slot for the parameters %s in %s' % (name, ', '.join(missing), self.fn))
+            if grp['yii'].shape[2:] != (height, width):
+                raise ValueError('The images of %s are %dx%d but %s has %dx%d' % (name, height, width, self.fn, *grp['yii'].shape[2:]))
+
+            dates = [d.decode() for d in grp['dates'][:]]
+            datestr = _datestr(date)
+            if datestr in dates:
+                i = dates.index(datestr)
+            else:
+                i = len(dates)
+                for ds in grp.values():
+                    ds.resize(i + 1, axis=0)
+                grp['dates'][i] = datestr.encode()
+
+            for k, p in enumerate(parameters):
+                j = known.index(p)
+                grp['yii'][i, j] = yii[k]
+                grp['npq'][i, j] = npq[k]
+            grp['fmax'][i] = fmax
+            grp['mask'][i] = mask
+
+    def samples(self):
+        '''
+        Output:
+        list of (treatment, sampleid)
+        '''
+        if not os.path.exists(self.fn):
+            return []
+        with self._open() as f:
+            return [(t, s) for t in f for s in f[t]]
+
+    def dates(self, treatment, sampleid):
+        '''
+        Output:
+        list of the dates of the sample as pandas Timestamps in the order of the date axis
+        '''
+        with self._open() as f:
+            return [pd.Timestamp(d.decode()) for d in f['%s/%s/dates' % (treatment, sampleid)][:]]
+
+    def parameters(self, treatment, sampleid):
+        '''
+        Output:
+        list of the parameters in the order of the parameter axis
+        '''
+        with self._open() as f:
+            return [p.decode() if isinstance(p, bytes) else p for p in f['%s/%s' % (treatment, sampleid)].attrs['parameters']]
+
+    def has(self, treatment, sampleid, date):
+        '''
+        Output:
+        True if the sample-day is in the store
+        '''
+        if not os.path.exists(self.fn):
+            return False
+        with self._open() as f:
+            name = '%s/%s/dates' % (treatment, sampleid)
+            return name in f and _datestr(date).encode() in set(f[name][:])
+
+    def read(self, treatment, sampleid, kind, dates=None, parameters=None):
+        '''
+        Input:
+        treatment, sampleid = the sample
+        kind = 'yii', 'npq', 'fmax' or 'mask'
+        dates = list of dates. None reads all dates
+        parameters = list of parameters (only for yii and npq). None reads all parameters
+
+        Output:
+        array of (date, parameter, height, width) for yii and npq and (date, height, width) for fmax and mask.
+        Only the chunks of the requested dates and parameters are read.
+        '''
+        with self._open() as f:
+            grp = f['%s/%s' % (treatment, sampleid)]
+            alldates = [d.decode() for d in grp['dates'][:]]
+            di = list(range(len(alldates))) if dates is None else [alldates.index(_datestr(d)) for d in dates]
+            ds = grp[kind]
+            if kind in ('fmax', 'mask'):
+                return np.stack([ds[i] for i in di]) if di else np.empty((0,) + ds.shape[1:], ds.dtype)
+            known = [p.decode() if isinstance(p, bytes) else p for p in grp.attrs['parameters']]
+            pj = list(range(len(known))) if parameters is None else [known.index(p) for p in parameters]
+            out = np.empty((len(di), len(pj)) + ds.shape[2:], dtype=ds.dtype)
+            for a, i in enumerate(di):
+                for b, j in enumerate(pj):
+                    out[a, b] = ds[i, j]
+            return out
+
+    def export_tifs(self, fluordir):
+        '''
+        Write the store as the per-file tifs of src.analysis.psII: fluordir/<sampleid>/<treatment>-<yyyymmdd>-<sampleid>-<parameter>_yii.tif, _npq.tif, and for FvFm _fvfm.tif and _fmax.tif
+
+        Output:
+        number of files written
+        '''
+        n = 0
+        for treatment, sampleid in self.samples():
+            outdir = os.path.join(fluordir, sampleid)
+            os.makedirs(outdir, exist_ok=True)
+            parameters = self.parameters(treatment, sampleid)
+            for i, date in enumerate(self.dates(treatment, sampleid)):
+                basefn = os.path.join(outdir, '%s-%s-%s' % (treatment, date.strftime('%Y%m%d'), sampleid))
+                yii = self.read(treatment, sampleid, 'yii', dates=[date])[0]
+                npq = self.read(treatment, sampleid, 'npq', dates=[date])[0]
+                for j, p in enumerate(parameters):
+                    if np.isnan(yii[j]).all():
+                        # parameter was not measured on this date
+                        continue
+                    if p == 'FvFm':
+                        cv2.imwrite(basefn + '-FvFm_fvfm.tif', yii[j])
+                        cv2.imwrite(basefn + '-FvFm_fmax.tif', self.read(treatment, sampleid, 'fmax', dates=[date])[0])
+                        n += 2
+                    else:
+                        cv2.imwrite('%s-%s_yii.tif' % (basefn, p), yii[j])
+                        cv2.imwrite('%s-%s_npq.tif' % (basefn, p), npq[j])
+                        n += 2
+        return n
+
+    def merge(self, fns):
+        '''
+        Input:
+        fns = other hdf5 stores, e.g. written by each machine with --shard
+
+        Output:
+        number of sample-days copied into this store
+        '''
+        n = 0
+        for fn in fns:
+            part = ArrayStore(fn)
+            for treatment, sampleid in part.samples():
+                parameters = part.parameters(treatment, sampleid)
+                for date in part.dates(treatment, sampleid):
+                    yii = part.read(treatment, sampleid, 'yii', dates=[date])[0]
+                    # parameters that were not measured on this date are nan
+                    measured = [j for j in range(len(parameters)) if not np.isnan(yii[j]).all()]
+                    arrays = {'parameters': [parameters[j] for j in measured],
+                              'yii': [yii[j] for j in measured],
+                              'npq': list(part.read(treatment, sampleid, 'npq', dates=[date])[0][measured]),
+                              'fmax': part.read(treatment, sampleid, 'fmax', dates=[date])[0],
+                              'mask': part.read(treatment, sampleid, 'mask', dates=[date])[0]}
+                    self.append(treatment, sampleid, date, arrays)
+                    n += 1
+        return n
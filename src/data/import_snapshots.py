@@ -5,24 +5,43 @@ import re as re
 from datetime import datetime, timedelta
 import pandas as pd
 from src.data import Multi2Singleframes
+from src.data import multiframe
 
-def import_snapshots(snapshotdir, camera='vis', extract_frames=True):
+def import_snapshots(snapshotdir, camera='vis', extract_frames=True, read_multiframe=False, manifest=None, validate=None):
     '''
     Input:
     snapshotdir = directory of .tif files
     camera = the camera which captured the images. 'vis' or 'psii'
     extract_frames = boolean. Should the frames from the multimage TIF be extracted? Useful if you are rerunning an analysis.
+    read_multiframe = boolean. Index the frames inside the multiframe TIFs instead of using extracted frames. filename will be the multiframe TIF and the 0-based frame is in column page. extract_frames is ignored.
+    manifest = optional sqlite file to keep the index of the multiframe TIFs between runs (only with read_multiframe=True). Only new or changed TIFs are opened, see src/data/manifest.py
+    validate = optional dict of keyword arguments for src.data.validate.validate(), e.g. {'pimframes': pimframes, 'report': 'output/from_diy_data/jobs_removed.csv'}. Unreadable, truncated, blank, saturated and duplicate multiframe TIFs are left out. The checks are kept in manifest if it is given
     
     Export multiframe .tif into snapshotdir using format {treatment}-{yyyymmdd}-{sampleid}.tif
     '''
 
     # %% Get metadata from .tifs
     # snapshotdir = 'data/raw_snapshots/psII'
+    if read_multiframe and manifest is not None:
+        from src.data import manifest as mf
+        mf.update(manifest, os.path.join(snapshotdir, 'raw_multiframe'))
+        fdf = mf.frames(manifest)
+        if validate is not None:
+            fdf = fdf[fdf.filename.isin(_validate(mf.files(manifest).filename.tolist(), validate, manifest))]
+        return fdf
+    if read_multiframe:
+        return _index_multiframes(snapshotdir, validate)
+
     framedir = os.path.join(snapshotdir, 'pimframes')
     os.makedirs(framedir, exist_ok=True)
+    # first find the multiframe .tif exports from the pim files
+    fns = [fn for fn in glob.glob(pathname=os.path.join(snapshotdir,'raw_multiframe','*.tif'))]
+    removed = set()
+    if validate is not None:
+        good = _validate(fns, validate)
+        removed = set(os.path.splitext(os.path.basename(fn))[0] for fn in fns if fn not in good)
+        fns = good
     if extract_frames:
-        # first find the multiframe .tif exports from the pim files
-        fns = [fn for fn in glob.glob(pathname=os.path.join(snapshotdir,'raw_multiframe','*.tif'))]
         for fn in fns:
             Multi2Singleframes.extract_frames(fn,framedir)
 
@@ -54,9 +73,83 @@ def import_snapshots(snapshotdir, camera='vis', extract_frames=True):
     fdf = fdf.sort_values(['treatment','date','sampleid'])
     fdf = fdf.set_index(['treatment','date','jobdate'])
     # check for duplicate jobs of the same sample on the same day.  if jobs_removed.csv isnt blank then you shyould investigate!
-    #dups = fdf.reset_index('datetime',drop=False).set_index(['imageid'],append=True).index.duplicated(keep='first')
-    #dups_to_remove = fdf[dups].drop(columns=['imageid','filename']).reset_index().drop_duplicates()
-    #dups_to_remove.to_csv('jobs_removed.csv',sep='\t')
-    #
+    # the frames that were extracted before from a multiframe TIF that fails the checks are left out too
+    if removed:
+        fdf = fdf[~fdf.filename.map(lambda fn: os.path.basename(fn).rsplit('-', 1)[0]).isin(removed)]
+
+    return fdf
+
+
+def parse_filename(fn):
+    '''
+    Input:
+    fn = path of a multiframe tif named {treatment}-{yyyymmdd}-{sampleid}.tif
+
+    Output:
+    list of [treatment, yyyymmdd, sampleid]
+    '''
+    return re.split('[-]', os.path.splitext(os.path.basename(fn))[0])
+
+
+def _validate(fns, validate, manifest=None):
+    '''
+    Input:
+    fns = list of multiframe tifs
+    validate, manifest = see import_snapshots()
+
+    Output:
+    the files that pass src.data.validate.validate()
+    '''
+    from src.data import validate as vd
+    kwargs = dict(validate)
+    if manifest is not None:
+        kwargs.setdefault('dbfile', manifest)
+    good, removed = vd.validate(fns, **kwargs)
+    if len(removed):
+        print('%d of %d multiframe tifs were excluded. you should investigate! %s' % (len(removed), len(fns), kwargs.get('report') or ''))
+        for row in removed.itertuples(index=False):
+            print('  %s: %s %s' % (os.path.basename(row.filename), row.reason, row.detail))
+    return good
+
+
+def _index_multiframes(snapshotdir, validate=None):
+    '''
+    Same as import_snapshots() but with one row per page of each multiframe .tif in snapshotdir/raw_multiframe. Nothing is written to disk.
+    '''
+
+    fns = sorted(glob.glob(pathname=os.path.join(snapshotdir, 'raw_multiframe', '*.tif')))
+    if not any(fns):
+        raise RuntimeError('No multiframe tif files were found in %s' % os.path.join(snapshotdir, 'raw_multiframe'))
+    if validate is not None:
+        fns = _validate(fns, validate)
+
+    return index_multiframes(fns)
+
+
+def index_multiframes(fns):
+    '''
+    Input:
+    fns = list of multiframe tif files named {treatment}-{yyyymmdd}-{sampleid}.tif
+
+    Output:
+    dataframe with one row per page of each file, see import_snapshots(..., read_multiframe=True)
+    '''
+    flist = list()
+    for fn in fns:
+        f = parse_filename(fn)
+        for page in range(multiframe.count_pages(fn)):
+            # imageid is 1-based to match the suffix of the extracted frames
+            flist.append(f + [page+1, fn, page])
+
+    fdf = pd.DataFrame(flist, columns=['treatment','date','sampleid','imageid','filename','page'])
+
+    # convert date and time columns to datetime format
+    fdf['date'] = pd.to_datetime(fdf.loc[:,'date'])
+    fdf['jobdate'] = fdf['date']
+
+    fdf['imageid'] = fdf.imageid.astype('uint8')
+    fdf['page'] = fdf.page.astype('uint16')
+    fdf = fdf.sort_values(['treatment','date','sampleid'])
+    fdf = fdf.set_index(['treatment','date','jobdate'])
 
     return fdf
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from src.data import import_snapshots
+from src.data import multiframe
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    npages INTEGER NOT NULL,
+    treatment TEXT NOT NULL,
+    date TEXT NOT NULL,
+    sampleid TEXT NOT NULL)'''
+INDEX = 'CREATE INDEX IF NOT EXISTS idx_files ON files (treatment, date, sampleid)'
+
+
+def _connect(dbfile):
+    dbdir = os.path.dirname(dbfile)
+    if dbdir:
+        os.makedirs(dbdir, exist_ok=True)
+    con = sqlite3.connect(dbfile)
+    con.execute(SCHEMA)
+    con.execute(INDEX)
+    return con
+
+
+def update(dbfile, rawdir):
+    '''
+    Input:
+    dbfile = sqlite manifest, e.g. output/from_diy_data/manifest.sqlite. created if it does not exist
+    rawdir = directory of the multiframe tifs named {treatment}-{yyyymmdd}-{sampleid}.tif
+
+    Output:
+    dict with the number of added, changed, removed and unchanged files
+
+    Only new files and files whose size or modification time changed are opened to count their frames.
+    '''
+    con = _connect(dbfile)
+    try:
+        known = {fn: (size, mtime) for fn, size, mtime in con.execute('SELECT filename, size, mtime FROM files')}
+        seen = set()
+        rows = []
+        counts = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+        with os.scandir(rawdir) as it:
+            for entry in it:
+                if not entry.name.endswith('.tif') or not entry.is_file():
+                    continue
+                fn = os.path.join(rawdir, entry.name)
+                seen.add(fn)
+                st = entry.stat()
+                if known.get(fn) == (st.st_size, st.st_mtime):
+                    counts['unchanged'] += 1
+                    continue
+                counts['changed' if fn in known else 'added'] += 1
+                treatment, date, sampleid = import_snapshots.parse_filename(fn)
+                try:
+                    npages = multiframe.count_pages(fn)
+                except Exception as e:
+                    # a truncated file has no frames to analyze. it is listed by src.data.validate
+                    print('could not read %s: %s' % (fn, e))
+                    npages = 0
+                rows.append((fn, st.st_size, st.st_mtime, npages,
+                             treatment, pd.Timestamp(date).strftime('%Y-%m-%d'), sampleid))
+        removed = [(fn,) for fn in known if fn not in seen]
+        counts['removed'] = len(removed)
+        with con:
+            con.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            con.executemany('DELETE FROM files WHERE filename = ?', removed)
+    finally:
+        con.close()
+    return counts
+
+
+def files(dbfile, **filters):
+    '''
+    Input:
+    dbfile = sqlite manifest from update()
+    filters = column=value or column=list of values of treatment, date and sampleid, e.g. sampleid='tray2' or date=['2019-08-01', '2019-08-02']
+
+    Output:
+    dataframe with one row per multiframe tif sorted by treatment, date and sampleid
+    '''
+    where = []
+    params = []
+    for col, val in filters.items():
+        if col not in ('treatment', 'date', 'sampleid'):
+            raise KeyError('Unknown filter %s. Use treatment, date or sampleid' % col)
+        vals = list(val) if isinstance(val, (list, tuple, set)) else [val]
+        if col == 'date':
+            vals = [pd.Timestamp(v).strftime('%Y-%m-%d') for v in vals]
+        where.append('%s IN (%s)' % (col, ', '.join('?' * len(vals))))
+        params.extend(vals)
+    sql = 'SELECT treatment, date, sampleid, filename, npages FROM files'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY treatment, date, sampleid'
+    con = _connect(dbfile)
+    try:
+        return pd.read_sql_query(sql, con, params=params)
+    finally:
+        con.close()
+
+
+def frames(dbfile, **filters):
+    '''
+    Input:
+    dbfile, filters = see files()
+
+    Output:
+    dataframe with one row per page of each multiframe tif, the same as import_snapshots(..., read_multiframe=True)
+    '''
+    fdf = files(dbfile, **filters)
+    if fdf.empty:
+        raise RuntimeError('No multiframe tif files are in the manifest %s' % dbfile)
+
+    # one row per page without a python loop over files
+    npages = fdf.npages.values
+    idx = np.repeat(np.arange(len(fdf)), npages)
+    page = np.arange(npages.sum()) - np.repeat(np.cumsum(npages) - npages, npages)
+    out = fdf.iloc[idx, :4].reset_index(drop=True)
+    out.insert(3, 'imageid', (page + 1).astype('uint8'))
+    out['page'] = page.astype('uint16')
+    out = out[['treatment', 'date', 'sampleid', 'imageid', 'filename', 'page']]
+
+    out['date'] = pd.to_datetime(out['date'])
+    out['jobdate'] = out['date']
+    return out.set_index(['treatment', 'date', 'jobdate'])
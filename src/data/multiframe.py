@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+from PIL import Image
+
+
+def count_pages(infile):
+    '''
+    input:  infile - a multiframe image file
+    output: the number of frames (pages) in the file
+
+    Only the page directory of the tif is read, not the pixel data.
+    '''
+    with Image.open(infile) as im:
+        return getattr(im, 'n_frames', 1)
+
+
+def read_frame(infile, page):
+    '''
+    input:  infile - a multiframe image file
+            page - 0-based index of the frame
+    output: numpy array of the frame with the dtype of the file (the same as cv2.imread(..., -1) of the extracted frame)
+
+    PIL opens the file lazily so only the requested page is decoded.
+    '''
+    with Image.open(infile) as im:
+        im.seek(int(page))
+        return np.array(im)
+
+
+def read_frames(infile, pages):
+    '''
+    input:  infile - a multiframe image file
+            pages - iterable of 0-based frame indices
+    output: list of numpy arrays in the order of pages
+
+    The file is opened once for all pages.
+    '''
+    frames = []
+    with Image.open(infile) as im:
+        for page in pages:
+            im.seek(int(page))
+            frames.append(np.array(im))
+    return frames
+
+
+def frame_name(infile, page):
+    '''
+    input:  infile - a multiframe image file
+            page - 0-based index of the frame
+    output: the filename the frame would have if it were extracted with Multi2Singleframes.extract_frames, without directory
+    '''
+    bn = os.path.splitext(os.path.basename(infile))[0]
+    return "%s-%d.tif" % (bn, int(page) + 1)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+
+class PixelStore:
+    '''
+    Store of the YII and NPQ values of the plant pixels only. One npz file per sample-day, pixeldir/<sampleid>/<treatment>-<yyyymmdd>-<sampleid>.npz, with
+        shape = (height, width) of the images
+        index = int32 flat index of each pixel of the FvFm mask (after the roi filter), in raster order
+        objects = int32 plant object of each pixel, 1..nobjects
+        member = bool (nobjects + 1, nroi). True if the object is part of the roi, the same assignment as the roi averages of src.analysis.psII.roi_avg()
+        parameters = names of the steps, FvFm first
+        yii, npq = float32 (n_steps, n_pixels). for FvFm yii is Fv/Fm and npq is 0
+        fmax = Fm of each pixel
+    A plant is usually a few percent of the image so the files are much smaller than the full frame tifs and the kinetics of every pixel are one contiguous read.
+
+    Input:
+    pixeldir = directory of the npz files, e.g. output/from_diy_data/pixels
+    '''
+
+    def __init__(self, pixeldir):
+        self.pixeldir = pixeldir
+
+    def filename(self, treatment, sampleid, date):
+        return os.path.join(self.pixeldir, sampleid, '%s-%s-%s.npz' % (treatment, pd.Timestamp(date).strftime('%Y%m%d'), sampleid))
+
+    def append(self, treatment, sampleid, date, arrays):
+        '''
+        Input:
+        treatment, sampleid, date = the sample-day
+        arrays = dict with parameters, yii, npq, fmax, mask, labels and member of the sample-day, see src.analysis.psII.sampleday_avg(). Writing a sample-day again replaces it
+        '''
+        mask = arrays['mask']
+        index = np.flatnonzero(mask.ravel()).astype(np.int32)
+        labels = arrays['labels'].ravel()[index]
+        # renumber the objects that are left after the roi filter
+        kept, objects = np.unique(labels, return_inverse=True)
+        member = np.vstack((np.zeros((1, arrays['member'].shape[1]), dtype=bool), arrays['member'][kept]))
+
+        # (n_steps, n_pixels) with one gather per step
+        yii = np.stack([img.ravel()[index] for img in arrays['yii']]).astype(np.float32, copy=False)
+        npq = np.stack([img.ravel()[index] for img in arrays['npq']]).astype(np.float32, copy=False)
+
+        fn = self.filename(treatment, sampleid, date)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        # write to a temporary name so a crash never leaves a partial file
+        tmpfn = fn[:-4] + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmpfn,
+                 shape=np.array(mask.shape, dtype=np.int32),
+                 index=index,
+                 objects=(objects + 1).astype(np.int32),
+                 member=member,
+                 parameters=np.array(arrays['parameters']),
+                 yii=np.ascontiguousarray(yii),
+                 npq=np.ascontiguousarray(npq),
+                 fmax=arrays['fmax'].ravel()[index])
+        os.replace(tmpfn, fn)
+
+    def has(self, treatment, sampleid, date):
+        return os.path.exists(self.filename(treatment, sampleid, date))
+
+    def dates(self, treatment, sampleid):
+        '''
+        Output:
+        sorted list of the dates of the sample as pandas Timestamps
+        '''
+        fns = glob.glob(os.path.join(self.pixeldir, sampleid, '%s-*-%s.npz' % (treatment, sampleid)))
+        return sorted(pd.Timestamp(os.path.basename(fn).split('-')[1]) for fn in fns)
+
+    def load(self, treatment, sampleid, date):
+        '''
+        Output:
+        dict with the arrays of the sample-day, see the class docstring
+        '''
+        with np.load(self.filename(treatment, sampleid, date)) as f:
+            out = {k: f[k] for k in f.files}
+        out['shape'] = tuple(int(v) for v in out['shape'])
+        out['parameters'] = [str(p) for p in out['parameters']]
+        return out
+
+    def plant(self, treatment, sampleid, date, roi, kind='yii'):
+        '''
+        Input:
+        treatment, sampleid, date = the sample-day
+        roi = roi number of the plant
+        kind = 'yii' or 'npq'
+
+        Output:
+        dict with
+            parameters = names of the steps
+            values = float32 (n_steps, n_pixels) of the pixels of the plant in roi
+            y, x = image coordinates of the pixels
+        '''
+        d = self.load(treatment, sampleid, date)
+        inroi = d['member'][d['objects'], roi]
+        y, x = np.unravel_index(d['index'][inroi], d['shape'])
+        return {'parameters': d['parameters'], 'values': d[kind][:, inroi], 'y': y, 'x': x}
+
+    def timeseries(self, treatment, sampleid, roi, kind='yii', dates=None):
+        '''
+        Input:
+        treatment, sampleid, roi, kind = see plant()
+        dates = list of dates. None uses every date of the sample
+
+        Output:
+        long dataframe with date, parameter, y, x and value of every pixel of the plant for every step of every day
+        '''
+        out = []
+        for date in dates if dates is not None else self.dates(treatment, sampleid):
+            p = self.plant(treatment, sampleid, date, roi, kind)
+            nsteps, npixels = p['values'].shape
+            out.append(pd.DataFrame({'date': pd.Timestamp(date),
+                                     'parameter': np.repeat(p['parameters'], npixels),
+                                     'y': np.tile(p['y'], nsteps),
+                                     'x': np.tile(p['x'], nsteps),
+                                     'value': p['values'].ravel()}))
+        return pd.concat(out, ignore_index=True) if out else pd.DataFrame(columns=['date', 'parameter', 'y', 'x', 'value'])
+
+    def image(self, treatment, sampleid, date, parameter, kind='yii'):
+        '''
+        Output:
+        full frame float32 image of a step with 0 outside the plants, the same as the _yii.tif or _npq.tif (_fvfm.tif for FvFm) inside the mask
+        '''
+        return self.frame(treatment, sampleid, date, parameter, kind)[0]
+
+    def frame(self, treatment, sampleid, date, parameter, kind='yii'):
+        '''
+        Output:
+        the full frame image of image() and the uint8 mask (0/255) of the stored pixels, from one read of the file. e.g. for src.viz.timelapse
+        '''
+        d = self.load(treatment, sampleid, date)
+        img = np.zeros(d['shape'], dtype=np.float32)
+        img.ravel()[d['index']] = d[kind][d['parameters'].index(parameter)]
+        mask = np.zeros(d['shape'], dtype=np.uint8)
+        mask.ravel()[d['index']] = 255
+        return img, mask
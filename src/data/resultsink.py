@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+import pandas as pd
+
+# columns that identify a chunk. each chunk is one sample-day
+PARTITION = ['treatment', 'date', 'sampleid']
+# final sort order of output_psII_level0.csv
+SORT_COLUMNS = ['treatment', 'date', 'sampleid', 'imageid']
+CSV_OPTIONS = {'na_rep': 'nan', 'float_format': '%.4f', 'index': False}
+
+
+class ResultSink:
+    '''
+    Append-only store for the results of each sample-day.
+
+    Every chunk of results is joined with the genotype information and written immediately to
+    partsdir/treatment=<treatment>/date=<yyyy-mm-dd>/<sampleid>.<csv|parquet>
+    so memory stays flat and finished sample-days survive a crash. Writing the same sample-day again replaces its chunk.
+
+    Input:
+    partsdir = directory for the chunks
+    gtypeinfo = dataframe of genotype_map.csv. chunks are inner joined on treatment, sampleid, roi
+    fmt = 'csv' or 'parquet'. parquet needs pyarrow or fastparquet
+    '''
+
+    def __init__(self, partsdir, gtypeinfo, fmt='csv'):
+        if fmt not in ('csv', 'parquet'):
+            raise ValueError('fmt must be "csv" or "parquet"')
+        self.partsdir = partsdir
+        self.gtypeinfo = gtypeinfo
+        self.fmt = fmt
+        os.makedirs(partsdir, exist_ok=True)
+
+    def _partdir(self, treatment, date):
+        return os.path.join(self.partsdir,
+                            'treatment=%s' % treatment,
+                            'date=%s' % pd.Timestamp(date).strftime('%Y-%m-%d'))
+
+    def write(self, df):
+        '''
+        Input:
+        df = results of one or more sample-days, e.g. from src.analysis.psII.sampleday_avg()
+        '''
+        df = pd.merge(df, self.gtypeinfo, on=['treatment', 'sampleid', 'roi'], how='inner')
+        for (treatment, date, sampleid), chunk in df.groupby(PARTITION, sort=True):
+            partdir = self._partdir(treatment, date)
+            os.makedirs(partdir, exist_ok=True)
+            fn = os.path.join(partdir, '%s.%s' % (sampleid, self.fmt))
+            # write to a temporary file first so a crash never leaves a partial chunk
+            tmpfn = fn + '.%d.tmp' % os.getpid()
+            if self.fmt == 'csv':
+                chunk.to_csv(tmpfn, **CSV_OPTIONS)
+            else:
+                chunk.to_parquet(tmpfn, index=False)
+            os.replace(tmpfn, fn)
+
+    def partitions(self):
+        '''
+        Output:
+        list of the partition directories in the order of treatment and date
+        '''
+        return sorted(glob.glob(os.path.join(self.partsdir, 'treatment=*', 'date=*')))
+
+    def read_partition(self, partdir):
+        '''
+        Output:
+        dataframe with all chunks of one treatment and date
+        '''
+        fns = sorted(glob.glob(os.path.join(partdir, '*.' + self.fmt)))
+        if self.fmt == 'csv':
+            chunks = [pd.read_csv(fn, parse_dates=['date', 'jobdate']) for fn in fns]
+        else:
+            chunks = [pd.read_parquet(fn) for fn in fns]
+        return pd.concat(chunks)
+
+    def export_csv(self, fn):
+        '''
+        Write all chunks to a single csv, sorted by treatment, date, sampleid and imageid, one partition at a time.
+        '''
+        tmpfn = fn + '.tmp'
+        header = True
+        for partdir in self.partitions():
+            part = self.read_partition(partdir)
+            # stable sort so rows with the same key keep the roi order
+            part = part.sort_values(SORT_COLUMNS, kind='mergesort')
+            part.to_csv(tmpfn, mode='w' if header else 'a', header=header, **CSV_OPTIONS)
+            header = False
+        if header:
+            raise RuntimeError('No results were found in %s' % self.partsdir)
+        os.replace(tmpfn, fn)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from src.data.resultsink import PARTITION, SORT_COLUMNS, CSV_OPTIONS
+
+TABLE = 'level0'
+# indexes for the usual queries of a single plant, a sample or a parameter over time
+INDEXES = {'idx_sample': ['treatment', 'sampleid', 'roi', 'parameter', 'date'],
+           'idx_parameter': ['parameter', 'date'],
+           'idx_partition': PARTITION}
+DATE_COLUMNS = ['date', 'jobdate']
+BOOL_COLUMNS = ['obj_in_frame', 'unique_roi']
+# dtypes of query(..., typed=True). the database keeps float64 so export_csv() is identical to the csv of ResultSink
+DTYPES = {'imageid': 'uint8',
+          'roi': 'uint8',
+          'page': 'uint16',
+          'frame_avg': 'float32',
+          'yii_avg': 'float32',
+          'npq_avg': 'float32',
+          'yii_std': 'float32',
+          'npq_std': 'float32',
+          'plantarea': 'float32'}
+
+
+class ResultStore:
+    '''
+    SQLite store for the results of each sample-day with indexes on (treatment, sampleid, roi, parameter, date).
+    Same interface as src.data.resultsink.ResultSink so it can be passed as sink to src.analysis.runner.run(), plus query() to load only the rows and columns you need.
+
+    Input:
+    dbfile = sqlite database, e.g. output/from_diy_data/output_psII_level0.sqlite
+    gtypeinfo = dataframe of genotype_map.csv. results are inner joined on treatment, sampleid, roi. None stores the results without the genotypes, e.g. the partial results of one shard
+    '''
+
+    def __init__(self, dbfile, gtypeinfo=None):
+        self.dbfile = dbfile
+        self.gtypeinfo = gtypeinfo
+        dbdir = os.path.dirname(dbfile)
+        if dbdir:
+            os.makedirs(dbdir, exist_ok=True)
+
+    def _connect(self):
+        return sqlite3.connect(self.dbfile)
+
+    def columns(self):
+        '''
+        Output:
+        dict of column name -> sqlite type. empty if nothing was written yet
+        '''
+        con = self._connect()
+        try:
+            info = con.execute('PRAGMA table_info(%s)' % TABLE).fetchall()
+        finally:
+            con.close()
+        return {row[1]: row[2] for row in info}
+
+    def write(self, df):
+        '''
+        Input:
+        df = results of one or more sample-days, e.g. from src.analysis.psII.sampleday_avg(). Writing the same sample-day again replaces its rows.
+        '''
+        if self.gtypeinfo is not None:
+            df = pd.merge(df, self.gtypeinfo, on=['treatment', 'sampleid', 'roi'], how='inner')
+        df = df.copy()
+        for col in DATE_COLUMNS:
+            df[col] = pd.to_datetime(df[col]).dt.strftime('%Y-%m-%d')
+        for col in df.columns[df.dtypes == 'category']:
+            df[col] = df[col].astype(str)
+
+        con = self._connect()
+        try:
+            with con:
+                if self.columns():
+                    keys = df[PARTITION].drop_duplicates().itertuples(index=False)
+                    con.executemany('DELETE FROM %s WHERE %s' % (TABLE, ' AND '.join('%s = ?' % c for c in PARTITION)),
+                                    [tuple(k) for k in keys])
+                df.to_sql(TABLE, con, if_exists='append', index=False)
+                for name, cols in INDEXES.items():
+                    con.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, TABLE, ', '.join(cols)))
+        finally:
+            con.close()
+
+    def _sql(self, known, columns=None, orderby=None, **filters):
+        # build the sql from known column names only. values are always passed as parameters
+        if not known:
+            raise RuntimeError('No results were found in %s' % self.dbfile)
+        columns = list(known) if columns is None else list(columns)
+        unknown = [c for c in columns + list(filters) if c not in known]
+        if unknown:
+            raise KeyError('Unknown columns: %s' % ', '.join(unknown))
+
+        where = []
+        params = []
+        for col, val in filters.items():
+            vals = list(val) if isinstance(val, (list, tuple, set, np.ndarray, pd.Index, pd.Series)) else [val]
+            if col in DATE_COLUMNS:
+                vals = [pd.Timestamp(v).strftime('%Y-%m-%d') for v in vals]
+            elif col in BOOL_COLUMNS:
+                vals = [int(v) for v in vals]
+            else:
+                vals = [v.item() if isinstance(v, np.generic) else v for v in vals]
+            where.append('%s IN (%s)' % (col, ', '.join('?' * len(vals))))
+            params.extend(vals)
+
+        sql = 'SELECT %s FROM %s' % (', '.join(columns), TABLE)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        if orderby:
+            sql += ' ORDER BY ' + ', '.join(orderby)
+        return sql, params
+
+    def _restore(self, df, known):
+        # sqlite has no bool or date type and returns None for a column that is NULL in every row
+        # obj_in_frame is nan for rois without a plant so bool columns stay object if they have missing values
+        for col in df.columns:
+            if known[col] == 'REAL':
+                df[col] = df[col].astype('float64')
+            elif col in BOOL_COLUMNS:
+                df[col] = df[col].map({1: True, 0: False})
+        return df
+
+    def parameters(self):
+        '''
+        Output:
+        list of the parameters in the order of their imageid, i.e. FvFm first and then the induction curve
+        '''
+        con = self._connect()
+        try:
+            rows = con.execute('SELECT parameter FROM %s GROUP BY parameter ORDER BY MIN(imageid)' % TABLE).fetchall()
+        finally:
+            con.close()
+        return [r[0] for r in rows]
+
+    def query(self, columns=None, typed=True, **filters):
+        '''
+        Input:
+        columns = list of columns to load. None loads all columns
+        typed = True to return date and jobdate as datetime, parameter as an ordered categorical, roi and imageid as uint8 and the statistics as float32
+        filters = column=value or column=list of values, e.g. sampleid='tray2', roi=[0, 1], parameter='FvFm', date='2019-08-01'
+
+        Output:
+        dataframe of the matching rows, sorted like output_psII_level0.csv
+
+        Example:
+        store = ResultStore('output/from_diy_data/output_psII_level0.sqlite')
+        store.query(['date', 'roi', 'yii_avg'], sampleid='tray2', parameter='FvFm')
+        '''
+        known = self.columns()
+        orderby = [c for c in SORT_COLUMNS if c in known] + ['rowid']
+        sql, params = self._sql(known, columns, orderby=orderby, **filters)
+        con = self._connect()
+        try:
+            df = self._restore(pd.read_sql_query(sql, con, params=params), known)
+        finally:
+            con.close()
+        if not typed:
+            return df
+        for col in df.columns:
+            if col in DATE_COLUMNS:
+                df[col] = pd.to_datetime(df[col])
+            elif col == 'parameter':
+                df[col] = pd.Categorical(df[col], categories=self.parameters(), ordered=True)
+            elif col in DTYPES and not (DTYPES[col].startswith('uint') and df[col].isna().any()):
+                df[col] = df[col].astype(DTYPES[col])
+        return df
+
+    def export_csv(self, fn, chunksize=100000):
+        '''
+        Write all results to a single csv, sorted by treatment, date, sampleid and imageid. Same file as ResultSink.export_csv()
+        '''
+        known = self.columns()
+        orderby = [c for c in SORT_COLUMNS if c in known] + ['rowid']
+        sql, params = self._sql(known, orderby=orderby)
+        tmpfn = fn + '.tmp'
+        header = True
+        con = self._connect()
+        try:
+            for chunk in pd.read_sql_query(sql, con, params=params, chunksize=chunksize):
+                self._restore(chunk, known).to_csv(tmpfn, mode='w' if header else 'a', header=header, **CSV_OPTIONS)
+                header = False
+        finally:
+            con.close()
+        if header:
+            raise RuntimeError('No results were found in %s' % self.dbfile)
+        os.replace(tmpfn, fn)
+
+    def partitions(self):
+        '''
+        Output:
+        dataframe of the (treatment, date, sampleid) in the store
+        '''
+        if not self.columns():
+            return pd.DataFrame(columns=PARTITION)
+        con = self._connect()
+        try:
+            return pd.read_sql_query('SELECT DISTINCT %s FROM %s ORDER BY %s' % (', '.join(PARTITION), TABLE, ', '.join(PARTITION)), con)
+        finally:
+            con.close()
+
+    def merge(self, dbfiles):
+        '''
+        Input:
+        dbfiles = stores without genotypes, e.g. written by each machine with --shard
+
+        Output:
+        number of sample-days merged. each sample-day is joined with gtypeinfo and replaces the same sample-day in this store
+        '''
+        if self.gtypeinfo is None:
+            raise RuntimeError('gtypeinfo is needed to merge results')
+        n = 0
+        for dbfile in dbfiles:
+            part = ResultStore(dbfile)
+            for treatment, date, sampleid in part.partitions().itertuples(index=False):
+                df = part.query(typed=False, treatment=treatment, date=date, sampleid=sampleid)
+                # the genotypes are added by write()
+                self.write(df.drop(columns=[c for c in self.gtypeinfo.columns if c in df.columns and c not in ('treatment', 'sampleid', 'roi')]))
+                n += 1
+        return n
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pandas as pd
+from datetime import date, timedelta
+from PIL import Image
+
+# mean fluorescence of plant pixels for each frame type. Fp and Fmp change along the induction curve
+PLANT_LEVELS = {'Fo': 50, 'Fm': 200, 'Fp': 70, 'Fmp': 150}
+
+
+def roi_grid(shape, nrows, ncols):
+    '''
+    Input:
+    shape = (height, width) of the images
+    nrows, ncols = number of pots in each direction
+
+    Output:
+    dict of keyword arguments for pcv.roi.multi with one circle in the center of each pot
+    '''
+    height, width = shape
+    spacing = (width // ncols, height // nrows)
+    return {'coord': (spacing[0] // 2, spacing[1] // 2),
+            'radius': max(2, min(spacing) // 6),
+            'spacing': spacing,
+            'ncols': ncols,
+            'nrows': nrows}
+
+
+def make_dataset(datadir, pimframes, ntrays=2, nrows=3, ncols=3, shape=(480, 640), ndays=2, treatments=('control',), start=date(2019, 8, 1), dtype='uint8', seed=0):
+    '''
+    Input:
+    datadir = directory for the dataset. multiframe tifs are written to datadir/raw_multiframe and a genotype_map.csv to datadir
+    pimframes = dataframe of pimframes_map.csv. there is one page per row in the order of imageid
+    ntrays = number of trays (sampleid) per treatment
+    nrows, ncols = pots per tray
+    shape = (height, width) of the images
+    ndays = number of days
+    treatments = treatment names
+    start = date of the first day
+    dtype = dtype of the frames
+    seed = seed for the random noise so datasets are reproducible
+
+    Output:
+    dict of keyword arguments for pcv.roi.multi that match the pots. The side effect is a dataset in the format expected by import_snapshots.
+
+    Plants are discs with noise that grow every day. Fo/Fm give Fv/Fm of about 0.75, Fm' decreases along the induction curve so NPQ increases. Absorptivity frames are blank.
+    '''
+    rng = np.random.default_rng(seed)
+    rawdir = os.path.join(datadir, 'raw_multiframe')
+    os.makedirs(rawdir, exist_ok=True)
+    roi = roi_grid(shape, nrows, ncols)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    pimframes = pimframes.sort_values('imageid')
+    steps = list(pimframes.parameter.unique())
+
+    gmap = []
+    for treatment in treatments:
+        for t in range(ntrays):
+            sampleid = 'tray%d' % (t + 1)
+            gmap.extend((treatment, sampleid, r, 'wt' if r % 2 == 0 else 'mut%d' % (r % 3))
+                        for r in range(nrows * ncols))
+            # size of each plant relative to the roi on the first day
+            size0 = rng.uniform(0.8, 1.6, nrows * ncols)
+            for d in range(ndays):
+                plant = np.zeros(shape, dtype=bool)
+                for i in range(nrows):
+                    for j in range(ncols):
+                        radius = roi['radius'] * size0[i * ncols + j] * (1 + 0.1 * d)
+                        cx = roi['coord'][0] + j * roi['spacing'][0]
+                        cy = roi['coord'][1] + i * roi['spacing'][1]
+                        plant |= (xx - cx)**2 + (yy - cy)**2 < radius**2
+
+                frames = []
+                for _, row in pimframes.iterrows():
+                    if row.frame not in PLANT_LEVELS:
+                        frames.append(np.zeros(shape, dtype=dtype))
+                        continue
+                    level = PLANT_LEVELS[row.frame]
+                    if row.frame == 'Fmp':
+                        level = level - 3 * steps.index(row.parameter)
+                    img = np.where(plant,
+                                   rng.normal(level, level * 0.05, shape),
+                                   rng.uniform(0, 6, shape))
+                    frames.append(np.clip(img, 0, np.iinfo(dtype).max).astype(dtype))
+
+                jobdate = (start + timedelta(days=d)).strftime('%Y%m%d')
+                images = [Image.fromarray(f) for f in frames]
+                images[0].save(os.path.join(rawdir, '%s-%s-%s.tif' % (treatment, jobdate, sampleid)),
+                               save_all=True, append_images=images[1:])
+
+    pd.DataFrame(gmap, columns=['treatment', 'sampleid', 'roi', 'gtype']).to_csv(os.path.join(datadir, 'genotype_map.csv'), index=False)
+    pimframes.to_csv(os.path.join(datadir, 'pimframes_map.csv'), index=False)
+    return roi
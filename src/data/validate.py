@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+'''
+Checks of the multiframe tifs before they are analyzed. Each file is read once, page by page, and a file is excluded if
+    unreadable = the file or one of its pages can not be decoded, e.g. a truncated export
+    pages = the number of pages is not the number of frames in pimframes_map.csv
+    blank = an analyzed frame has a single value, e.g. the camera was off
+    saturated = at least satfrac of the pixels of an analyzed frame are at the maximum value of the file type. the plants are a few percent of the image so the default is small
+    duplicate = the pages are byte for byte the same as those of another file, e.g. a job that was exported twice or copied to another date. the first file by treatment, date and sampleid is kept
+'''
+import os
+import json
+import hashlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from src.data import import_snapshots
+from src.data.resultsink import CSV_OPTIONS
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS checks (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    settings TEXT NOT NULL,
+    jobhash TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    detail TEXT NOT NULL)'''
+REPORT_COLUMNS = ['treatment', 'date', 'sampleid', 'filename', 'reason', 'detail']
+
+
+def analyzed_pages(pimframes):
+    '''
+    Input:
+    pimframes = dataframe of pimframes_map.csv with whitespace stripped
+
+    Output:
+    dict of 0-based page: 'parameter frame' of the frames that are analyzed, the same frames as src.analysis.runner.worklist(). absorptivity frames are blank in the default protocol
+    '''
+    frames = pimframes[~pimframes.parameter.str.contains('Abs') & ~pimframes.parameter.str.contains('FRon')]
+    frames = frames[(frames.parameter != 'FvFm') | frames.frame.isin(['Fo', 'Fm'])]
+    return {int(imageid) - 1: '%s %s' % (parameter, frame) for imageid, frame, parameter in frames[['imageid', 'frame', 'parameter']].itertuples(index=False)}
+
+
+def page_summary(img):
+    '''
+    Input:
+    img = numpy array of a page
+
+    Output:
+    dict with the hash of the pixels, min, max and satfrac, the fraction of pixels at the maximum value of the dtype.
+    one histogram pass for integer images instead of separate min, max and comparisons
+    '''
+    img = np.ascontiguousarray(img)
+    out = {'hash': hashlib.blake2b(img.data, digest_size=16).hexdigest()}
+    if img.dtype in (np.uint8, np.uint16):
+        counts = np.bincount(img.ravel())
+        nonzero = np.flatnonzero(counts)
+        out['min'], out['max'] = int(nonzero[0]), int(nonzero[-1])
+        top = np.iinfo(img.dtype).max
+        out['satfrac'] = counts[top] / img.size if top < len(counts) else 0.
+    else:
+        out['min'], out['max'] = float(img.min()), float(img.max())
+        out['satfrac'] = 0.
+    return out
+
+
+def check_file(fn, npages=None, pages=None, satfrac=0.001):
+    '''
+    Input:
+    fn = multiframe tif
+    npages = expected number of pages. None skips the check
+    pages = dict of 0-based page: name of the pages that are checked for blank and saturated frames, see analyzed_pages(). None checks every page
+    satfrac = fraction of the pixels of the frame at the maximum value that makes a frame saturated, e.g. 0.001 is 300 pixels of a 640 x 480 frame
+
+    Output:
+    dict with filename, jobhash (hash of all pages), reason ('' if the file is fine) and detail
+    '''
+    out = {'filename': fn, 'jobhash': '', 'reason': '', 'detail': ''}
+    summaries = []
+    try:
+        with Image.open(fn) as im:
+            for page in range(getattr(im, 'n_frames', 1)):
+                im.seek(page)
+                summaries.append(page_summary(np.asarray(im)))
+    except Exception as e:
+        out.update(reason='unreadable', detail='page %d: %s' % (len(summaries) + 1, e))
+        return out
+    out['jobhash'] = hashlib.blake2b(''.join(s['hash'] for s in summaries).encode(), digest_size=16).hexdigest()
+
+    if npages is not None and len(summaries) != npages:
+        out.update(reason='pages', detail='%d pages instead of %d' % (len(summaries), npages))
+        return out
+    if pages is None:
+        pages = {page: '' for page in range(len(summaries))}
+    # saturated first so a frame that is all at the maximum is not reported as blank
+    for reason, bad in (('saturated', lambda s: s['satfrac'] >= satfrac),
+                        ('blank', lambda s: s['min'] == s['max'])):
+        badpages = ['page %d %s' % (page + 1, name) for page, name in sorted(pages.items()) if page < len(summaries) and bad(summaries[page])]
+        if badpages:
+            out.update(reason=reason, detail='; '.join(p.strip() for p in badpages))
+            return out
+    return out
+
+
+def _check_file(args):
+    # unpack for ProcessPoolExecutor.map
+    return check_file(*args)
+
+
+def _load(con, settings):
+    # cached checks of the files that have not changed, keyed by filename
+    rows = con.execute('SELECT filename, size, mtime, jobhash, reason, detail FROM checks WHERE settings = ?', (settings,))
+    return {fn: ((size, mtime), {'filename': fn, 'jobhash': jobhash, 'reason': reason, 'detail': detail}) for fn, size, mtime, jobhash, reason, detail in rows}
+
+
+def _settings(pimframes, satfrac):
+    # expected pages, checked pages and the settings that the cached checks depend on
+    npages = None if pimframes is None else len(pimframes)
+    pages = None if pimframes is None else analyzed_pages(pimframes)
+    return npages, pages, json.dumps([npages, sorted(pages.items()) if pages is not None else None, satfrac])
+
+
+def _connect(dbfile):
+    dbdir = os.path.dirname(dbfile)
+    if dbdir:
+        os.makedirs(dbdir, exist_ok=True)
+    con = sqlite3.connect(dbfile)
+    con.execute(SCHEMA)
+    return con
+
+
+def _store(con, checked, stats, settings):
+    with con:
+        con.executemany('INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        [(r['filename'], stats[r['filename']].st_size, stats[r['filename']].st_mtime, settings,
+                          r['jobhash'], r['reason'], r['detail']) for r in checked])
+
+
+def _report_rows(results):
+    # REPORT_COLUMNS of a list of check results, sorted by treatment, date and sampleid
+    fns = [r['filename'] for r in results]
+    df = pd.DataFrame(results, columns=['filename', 'jobhash', 'reason', 'detail'])
+    df[['treatment', 'date', 'sampleid']] = pd.DataFrame([import_snapshots.parse_filename(fn)[:3] for fn in fns], index=df.index, columns=['treatment', 'date', 'sampleid'])
+    df['date'] = pd.to_datetime(df['date'])
+    return df.sort_values(['treatment', 'date', 'sampleid', 'filename'], kind='mergesort')
+
+
+def validate(fns, pimframes=None, satfrac=0.001, report=None, dbfile=None, workers=1):
+    '''
+    Input:
+    fns = list of multiframe tifs named {treatment}-{yyyymmdd}-{sampleid}.tif
+    pimframes = dataframe of pimframes_map.csv. None skips the page count and checks every page for blank and saturated frames
+    satfrac = see check_file()
+    report = csv file of the excluded files, e.g. output/from_diy_data/jobs_removed.csv. it is empty except for the header if every file is fine
+    dbfile = optional sqlite file, e.g. the manifest of import_snapshots(), to keep the checks between runs. Only new or changed files are read again
+    workers = number of processes that read the files
+
+    Output:
+    list of the files that passed, in the order of fns, and a dataframe with one row per excluded file
+    '''
+    npages, pages, settings = _settings(pimframes, satfrac)
+
+    con = None
+    cached = {}
+    if dbfile is not None:
+        con = _connect(dbfile)
+        cached = _load(con, settings)
+    try:
+        stats = {fn: os.stat(fn) for fn in fns}
+        results = {}
+        todo = []
+        for fn in fns:
+            st = stats[fn]
+            key, result = cached.get(fn, (None, None))
+            if key == (st.st_size, st.st_mtime):
+                results[fn] = result
+            else:
+                todo.append(fn)
+
+        jobs = [(fn, npages, pages, satfrac) for fn in todo]
+        if workers is None or workers <= 1:
+            checked = list(map(_check_file, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                checked = list(pool.map(_check_file, jobs))
+        for result in checked:
+            results[result['filename']] = result
+
+        if con is not None and checked:
+            _store(con, checked, stats, settings)
+    finally:
+        if con is not None:
+            con.close()
+
+    # duplicates among the readable files. the first file of the same pages is kept
+    df = _report_rows([results[fn] for fn in fns])
+    hashed = df[df.jobhash != '']
+    dups = hashed.jobhash.duplicated(keep='first') & (hashed.reason == '')
+    first = hashed.drop_duplicates('jobhash').set_index('jobhash').filename
+    df.loc[dups[dups].index, 'reason'] = 'duplicate'
+    df.loc[dups[dups].index, 'detail'] = ['same pages as ' + os.path.basename(first[h]) for h in hashed.jobhash[dups]]
+
+    removed = df.loc[df.reason != '', REPORT_COLUMNS].reset_index(drop=True)
+    if report is not None:
+        removed.to_csv(report, date_format='%Y-%m-%d', **CSV_OPTIONS)
+    bad = set(removed.filename)
+    return [fn for fn in fns if fn not in bad], removed
+
+
+def check_new(fn, pimframes=None, satfrac=0.001, report=None, dbfile=None):
+    '''
+    Input:
+    fn = a new multiframe tif, e.g. from src.data.watchfolder.watch()
+    pimframes, satfrac, report, dbfile = see validate(). with dbfile the pages of fn are also compared with the files that passed before, so a job that is exported again is not processed twice
+
+    Output:
+    dict with filename, jobhash, reason ('' if the file is fine) and detail. an excluded file is added to report
+    '''
+    npages, pages, settings = _settings(pimframes, satfrac)
+    result = check_file(fn, npages, pages, satfrac)
+    if dbfile is not None:
+        con = _connect(dbfile)
+        try:
+            if result['reason'] == '' and result['jobhash']:
+                same = con.execute("SELECT filename FROM checks WHERE jobhash = ? AND reason = '' AND filename != ? ORDER BY filename",
+                                   (result['jobhash'], fn)).fetchone()
+                if same is not None:
+                    result = dict(result, reason='duplicate', detail='same pages as ' + os.path.basename(same[0]))
+            if result['reason'] != 'duplicate':
+                # a duplicate is not stored as passed so the original stays the one that is kept
+                _store(con, [result], {fn: os.stat(fn)}, settings)
+        finally:
+            con.close()
+
+    if result['reason'] and report is not None:
+        removed = _report_rows([result])[REPORT_COLUMNS]
+        if os.path.exists(report):
+            removed.to_csv(report, mode='a', header=False, date_format='%Y-%m-%d', **CSV_OPTIONS)
+        else:
+            removed.to_csv(report, date_format='%Y-%m-%d', **CSV_OPTIONS)
+    return result
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+import time
+import warnings
+from datetime import datetime
+
+from src.data import import_snapshots
+from src.data import multiframe
+
+
+def is_complete(fn, npages=None):
+    '''
+    Input:
+    fn = multiframe tif
+    npages = expected number of frames, e.g. the number of rows in pimframes_map.csv. None only checks that the file can be read
+
+    Output:
+    True if the tif can be opened and has the expected number of frames
+    '''
+    try:
+        with warnings.catch_warnings():
+            # PIL warns about truncated tags of partially written files
+            warnings.simplefilter('ignore')
+            n = multiframe.count_pages(fn)
+    except Exception:
+        # still being written or not a tif
+        return False
+    return npages is None or n >= npages
+
+
+def watch(rawdir, npages=None, poll=2., settle=5., known=None, stop=None):
+    '''
+    Input:
+    rawdir = directory that ImagingWin exports {treatment}-{yyyymmdd}-{sampleid}.tif into, e.g. diy_data/raw_multiframe
+    npages = expected number of frames in each file. see is_complete()
+    poll = seconds between scans of the directory
+    settle = seconds the size and modification time of a file must be unchanged before it is considered fully written
+    known = dict of path -> (size, mtime) of files that are already processed. these are only reported again if they change
+    stop = optional threading.Event to end the generator
+
+    Output:
+    generator of paths of new or changed multiframe tifs, each once it is completely written. Runs until stop is set or the caller breaks out.
+
+    Polls the directory instead of using inotify so it also works on network shares and Windows acquisition PCs.
+    '''
+    known = dict(known or {})
+    pending = {}  # path -> (size, mtime, time first seen with this size and mtime)
+    while stop is None or not stop.is_set():
+        now = time.time()
+        for fn in sorted(glob.glob(os.path.join(rawdir, '*.tif'))):
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            sig = (st.st_size, st.st_mtime)
+            if known.get(fn) == sig:
+                continue
+            if fn not in pending or pending[fn][:2] != sig:
+                # new or still growing
+                pending[fn] = sig + (now,)
+                continue
+            if now - pending[fn][2] < settle or not is_complete(fn, npages):
+                continue
+            try:
+                import_snapshots.parse_filename(fn)[2]
+            except IndexError:
+                print('%s: skipped %s. the filename must be {treatment}-{yyyymmdd}-{sampleid}.tif' % (datetime.now().strftime('%H:%M:%S'), fn))
+                known[fn] = sig
+                del pending[fn]
+                continue
+            known[fn] = sig
+            del pending[fn]
+            yield fn
+        if stop is None:
+            time.sleep(poll)
+        else:
+            stop.wait(poll)
+
+
+def snapshot(rawdir):
+    '''
+    Output:
+    dict of path -> (size, mtime) of the tifs in rawdir, to pass as known to watch()
+    '''
+    known = {}
+    for fn in glob.glob(os.path.join(rawdir, '*.tif')):
+        st = os.stat(fn)
+        known[fn] = (st.st_size, st.st_mtime)
+    return known
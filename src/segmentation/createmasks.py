@@ -1,18 +1,19 @@
-from plantcv import plantcv as pcv
 import os
 import numpy as np
 import cv2 as cv2
-from skimage import filters
 
 def psIImask(img, mode='thresh'):
     ''' 
     Input:
-    img = greyscale image
-    mode = type of thresholding to perform. Currently only 'thresh' is available
+    img = greyscale image. With mode='fast' this can also be a stack of images (n, H, W) and a stack of masks is returned
+    mode = type of thresholding to perform. 'thresh' uses plantcv, 'fast' gives the same mask with numpy/OpenCV only
     '''
 
     # pcv.plot_image(img)
-    if mode is 'thresh':
+    if mode == 'thresh':
+        # plantcv and scikit-image are only needed for this mode
+        from plantcv import plantcv as pcv
+        from skimage import filters
 
         # this entropy based technique seems to work well when algae is present
         algaethresh = filters.threshold_yen(image=img)
@@ -24,7 +25,101 @@ def psIImask(img, mode='thresh'):
         # mask = pcv.dilate(mask, 2,1)
         final_mask = mask  # pcv.fill(mask, 270)
 
+    elif mode == 'fast':
+        final_mask = fastmask(img)
+
     else:
-        pcv.fatal_error('mode must be "thresh" (default) or an object of class pd.DataFrame')
+        raise RuntimeError('mode must be "thresh" (default) or "fast"')
 
     return final_mask
+
+
+def threshold_yen(img):
+    '''
+    Input:
+    img = greyscale image or stack of images (n, H, W)
+
+    Output:
+    the same threshold as skimage.filters.threshold_yen, or an array with one threshold per image of a stack. The histogram of each image is computed with a single np.bincount
+    '''
+    stack = img if img.ndim == 3 else img[np.newaxis]
+    n = stack.shape[0]
+
+    if np.issubdtype(stack.dtype, np.integer):
+        # one bin per integer value between min and max of each image, like skimage.exposure.histogram
+        flat = stack.reshape(n, -1)
+        lo = flat.min(axis=1).astype(np.int64)
+        hi = flat.max(axis=1).astype(np.int64)
+        nbins = int((hi - lo).max()) + 1
+        idx = flat - lo[:, np.newaxis] + (np.arange(n) * nbins)[:, np.newaxis]
+        counts = np.bincount(idx.ravel(), minlength=n * nbins).reshape(n, nbins)
+        centers = [np.arange(lo[i], hi[i] + 1) for i in range(n)]
+        counts = [counts[i, :hi[i] - lo[i] + 1] for i in range(n)]
+    else:
+        counts = []
+        centers = []
+        for a in stack:
+            c, edges = np.histogram(a, bins=256, range=(a.min(), a.max()))
+            counts.append(c)
+            centers.append((edges[:-1] + edges[1:]) / 2.)
+
+    thresholds = []
+    for c, centers_i in zip(counts, centers):
+        if centers_i.size == 1:
+            thresholds.append(centers_i[0])
+            continue
+        pmf = c.astype('float32') / c.sum()
+        P1 = np.cumsum(pmf)
+        P1_sq = np.cumsum(pmf ** 2)
+        P2_sq = np.cumsum(pmf[::-1] ** 2)[::-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crit = np.log(((P1_sq[:-1] * P2_sq[1:]) ** -1) * (P1[:-1] * (1.0 - P1[:-1])) ** 2)
+        thresholds.append(centers_i[crit.argmax()])
+
+    return thresholds[0] if img.ndim == 2 else np.array(thresholds)
+
+
+def remove_small_objects(mask, size):
+    '''
+    Input:
+    mask = binary mask
+    size = minimum number of pixels of an object
+
+    Output:
+    uint8 mask (0/255) without the objects smaller than size. The same as pcv.fill (4-connected objects) with one cv2.connectedComponentsWithStats pass
+    '''
+    nobj, labels, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=4)
+    keep = stats[:, cv2.CC_STAT_AREA] >= size
+    keep[0] = False
+    if keep[1:].all():
+        # nothing to remove
+        return np.where(labels > 0, 255, 0).astype(np.uint8)
+    lut = np.where(keep, 255, 0).astype(np.uint8)
+    return lut[labels]
+
+
+def fastmask(img):
+    '''
+    Input:
+    img = greyscale image or stack of images (n, H, W)
+
+    Output:
+    the same mask as psIImask(img, mode='thresh') without plantcv. A stack of images gives a stack of masks.
+    '''
+    if img.ndim == 3:
+        thresholds = threshold_yen(img)
+        return np.stack([_fastmask(a, t) for a, t in zip(img, thresholds)])
+    return _fastmask(img, threshold_yen(img))
+
+
+def _fastmask(img, thresh):
+    # the same steps as mode='thresh': binary threshold, fill(150), erode(2, 1), fill(45)
+    if img.dtype == np.uint8:
+        # integer threshold so cv2 gives the same result as img > thresh
+        _, threshy = cv2.threshold(img, np.floor(thresh), 255, cv2.THRESH_BINARY)
+    else:
+        threshy = np.where(img > thresh, 255, 0).astype(np.uint8)
+    mask = remove_small_objects(threshy, 150)
+    mask = cv2.erode(mask, np.ones((2, 2), np.uint8), iterations=1)
+    mask = remove_small_objects(mask, 45)
+    return mask
@@ -0,0 +1,151 @@
+'''
+Declarative roi layouts. A layout is a list of shapes, numbered in order starting at roi 0:
+    {"type": "circle", "center": [x, y], "radius": r}
+    {"type": "rect", "center": [x, y], "size": [width, height]}
+    {"type": "polygon", "points": [[x0, y0], [x1, y1], ...]}
+    {"type": "grid", "shape": "circle" or "rect", "coord": [x, y], "spacing": [dx, dy], "ncols": n, "nrows": m, "radius": r or "size": [width, height]}
+A grid expands row by row into one shape per pot centered at coord + (col*dx, row*dy), the same order as pcv.roi.multi.
+The keyword arguments of pcv.roi.multi (coord, radius, spacing, ncols, nrows) are accepted as a circle grid.
+
+Different trays can have different layouts with a dict of sampleid -> layout and an optional "default", e.g. diy_data/roi_layouts.json
+'''
+
+import json
+import functools
+import numpy as np
+import cv2 as cv2
+
+SHAPES = ('circle', 'rect', 'polygon')
+
+
+def _is_layout(spec):
+    return isinstance(spec, list) or 'type' in spec or 'coord' in spec
+
+
+def load(fn):
+    '''
+    Input:
+    fn = json file with a layout or a dict of sampleid -> layout
+
+    Output:
+    the parsed json
+    '''
+    with open(fn) as f:
+        return json.load(f)
+
+
+def layout_for(spec, sampleid):
+    '''
+    Input:
+    spec = a layout or a dict of sampleid -> layout with an optional "default" layout
+    sampleid = e.g. tray2
+
+    Output:
+    the layout of sampleid
+    '''
+    if _is_layout(spec):
+        return spec
+    if sampleid in spec:
+        return spec[sampleid]
+    if 'default' in spec:
+        return spec['default']
+    raise KeyError('No roi layout for %s and no default layout' % sampleid)
+
+
+def _grid(g):
+    shape = g.get('shape', 'circle')
+    spacing = g.get('spacing') or (0, 0)
+    shapes = []
+    for i in range(g['nrows']):
+        for j in range(g['ncols']):
+            center = [g['coord'][0] + j * spacing[0], g['coord'][1] + i * spacing[1]]
+            if shape == 'circle':
+                shapes.append({'type': 'circle', 'center': center, 'radius': g['radius']})
+            elif shape == 'rect':
+                shapes.append({'type': 'rect', 'center': center, 'size': g['size']})
+            else:
+                raise ValueError('grid shape must be "circle" or "rect"')
+    return shapes
+
+
+def expand(layout):
+    '''
+    Input:
+    layout = see the top of this module
+
+    Output:
+    list of circle, rect and polygon shapes in the order of the roi numbers
+    '''
+    if isinstance(layout, dict):
+        layout = [layout]
+    shapes = []
+    for s in layout:
+        stype = s.get('type', 'grid' if 'coord' in s else None)
+        if stype == 'grid':
+            shapes.extend(_grid(s))
+        elif stype in SHAPES:
+            shapes.append(s)
+        else:
+            raise ValueError('Unknown roi shape %s. Use one of %s or grid' % (stype, ', '.join(SHAPES)))
+    return shapes
+
+
+def count(layout):
+    '''
+    Output:
+    number of rois in the layout
+    '''
+    return len(expand(layout))
+
+
+def _polygon(s):
+    # corners of the shape as an int32 array for cv2
+    if s['type'] == 'rect':
+        (x, y), (w, h) = s['center'], s['size']
+        x0, y0 = int(round(x - w / 2.)), int(round(y - h / 2.))
+        return np.array([[x0, y0], [x0 + w - 1, y0], [x0 + w - 1, y0 + h - 1], [x0, y0 + h - 1]], dtype=np.int32)
+    return np.asarray(s['points'], dtype=np.int32)
+
+
+def bounds(s):
+    '''
+    Output:
+    (x0, y0, x1, y1) bounding box of a shape
+    '''
+    if s['type'] == 'circle':
+        (x, y), r = s['center'], s['radius']
+        return x - r, y - r, x + r, y + r
+    pts = _polygon(s)
+    return pts[:, 0].min(), pts[:, 1].min(), pts[:, 0].max(), pts[:, 1].max()
+
+
+@functools.lru_cache(maxsize=32)
+def _label_image(shape, key):
+    height, width = shape
+    labels = np.zeros((height, width), dtype=np.int32)
+    for i, s in enumerate(expand(json.loads(key))):
+        x0, y0, x1, y1 = bounds(s)
+        # same check as pcv.roi.multi
+        if x0 < 0 or y0 < 0 or x1 > width or y1 > height:
+            raise RuntimeError('roi %d (%s) extends outside of the image!' % (i, s['type']))
+        if s['type'] == 'circle':
+            # same pixels as the filled contour of the circle from pcv.roi.multi
+            cv2.circle(labels, tuple(int(v) for v in s['center']), int(s['radius']), i + 1, thickness=-1)
+        else:
+            cv2.fillPoly(labels, [_polygon(s)], i + 1)
+    labels.setflags(write=False)
+    return labels
+
+
+def label_image(shape, layout):
+    '''
+    Input:
+    shape = (height, width) of the image
+    layout = see the top of this module
+
+    Output:
+    read-only int32 label image with 0 as background and i+1 inside the ith roi, for src.segmentation.roiobjects.label_objects().
+    Rasterized once per image shape and layout and then reused. Where rois overlap the later roi wins.
+    '''
+    key = json.dumps(layout, sort_keys=True, default=list)
+    return _label_image(tuple(shape[:2]), key)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2 as cv2
+
+from src.util import profiling
+
+# default number of images that can wait to be written before the pipeline blocks
+DEFAULT_QUEUE = 32
+
+
+class WriteError(RuntimeError):
+    '''
+    Raised by AsyncWriter.flush() (or right away without threads) when output files could not be written.
+    errors = list of (group, filename, exception), e.g. group = control-20190801-tray2-t40_ALon
+    '''
+
+    def __init__(self, errors):
+        self.errors = errors
+        lines = ['%s: could not write %s (%s)' % (group, fn, e) for group, fn, e in errors]
+        super().__init__('%d output file(s) failed\n' % len(errors) + '\n'.join(lines))
+
+
+class AsyncWriter:
+    '''
+    Encodes and writes output images in background threads so the disk writes of one sample-day overlap the computation of the next.
+    At most maxpending writes wait in the queue, submit() blocks until there is room so the images waiting to be written cannot fill the memory.
+    Each write belongs to a unit (the sample-day) and a group (the parameter) so flush(unit) waits for the files of one sample-day and reports the failed files by group.
+    The arrays passed to submit() must not be modified afterwards.
+    With profiling enabled (see src.util.profiling), flush(unit) adds a 'background_write' record with the seconds and bytes of the writer threads for the files of the unit, under the profiling group that was current when they were submitted.
+
+    Input:
+    threads = number of writer threads. 0 writes in the calling thread and raises WriteError right away
+    maxpending = number of writes that can be queued before submit() blocks
+    fsync = call os.fsync on every file after it is written, e.g. on network storage to be sure the files are complete when the run ends
+    '''
+
+    def __init__(self, threads=2, maxpending=DEFAULT_QUEUE, fsync=False):
+        self.threads = threads
+        self.maxpending = maxpending
+        self.fsync = fsync
+        self.pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(max(1, maxpending))
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='writer') if threads > 0 else None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._errors = {}
+        # unit: [profiling group, seconds, bytes read, bytes written] of the writer threads
+        self._stats = {}
+
+    def _write(self, unit, group, fn, func, args, kwargs, profgroup=None):
+        if profgroup is not None:
+            rchar0, wchar0 = profiling._io_chars()
+            t0 = time.perf_counter()
+        try:
+            if func(*args, **kwargs) is False:
+                # cv2.imwrite returns False instead of raising
+                raise IOError('the image encoder failed')
+            if self.fsync:
+                with open(fn, 'rb+') as f:
+                    os.fsync(f.fileno())
+        except Exception as e:
+            with self._lock:
+                self._errors.setdefault(unit, []).append((group, fn, e))
+        finally:
+            if profgroup is not None:
+                wall = time.perf_counter() - t0
+                rchar1, wchar1 = profiling._io_chars()
+                with self._lock:
+                    stats = self._stats.setdefault(unit, [profgroup, 0., 0, 0])
+                    stats[1] += wall
+                    stats[2] += rchar1 - rchar0
+                    stats[3] += wchar1 - wchar0
+            if self._pool is not None:
+                self._slots.release()
+
+    def submit(self, unit, group, fn, func, *args, **kwargs):
+        '''
+        Input:
+        unit = key of the sample-day, e.g. (treatment, sampleid, jobdate)
+        group = name of the parameter group for error messages
+        fn = file written by func
+        func, args, kwargs = function that writes fn. a return value of False is a failed write, like cv2.imwrite
+        '''
+        if self._pool is None:
+            self._write(unit, group, fn, func, args, kwargs)
+            self._raise(unit)
+            return
+        # the writes without threads (above) are counted in the open profiling stage of the calling thread
+        profgroup = profiling.get_group() if profiling.is_enabled() else None
+        # backpressure: wait for a free slot before more images are queued
+        self._slots.acquire()
+        future = self._pool.submit(self._write, unit, group, fn, func, args, kwargs, profgroup)
+        with self._lock:
+            self._pending.setdefault(unit, []).append(future)
+
+    def imwrite(self, unit, group, fn, img, params=None):
+        '''
+        Queue cv2.imwrite(fn, img, params)
+        '''
+        if params is None:
+            self.submit(unit, group, fn, cv2.imwrite, fn, img)
+        else:
+            self.submit(unit, group, fn, cv2.imwrite, fn, img, params)
+
+    def _raise(self, unit):
+        with self._lock:
+            if unit is None:
+                errors = [err for errs in self._errors.values() for err in errs]
+                self._errors.clear()
+            else:
+                errors = self._errors.pop(unit, [])
+        if errors:
+            raise WriteError(errors)
+
+    def flush(self, unit=None):
+        '''
+        Barrier: wait until the queued files of unit (None: all units) are written.
+        Raises WriteError with the group and file of every failed write.
+        '''
+        with self._lock:
+            if unit is None:
+                futures = [f for fs in self._pending.values() for f in fs]
+                self._pending.clear()
+            else:
+                futures = self._pending.pop(unit, [])
+        for f in futures:
+            f.result()
+        self._record(unit)
+        self._raise(unit)
+
+    def _record(self, unit):
+        # profiling records of the written units
+        with self._lock:
+            if unit is None:
+                stats = list(self._stats.values())
+                self._stats.clear()
+            else:
+                stats = [self._stats.pop(unit)] if unit in self._stats else []
+        for profgroup, wall, rbytes, wbytes in stats:
+            profiling.record('background_write', wall, rbytes, wbytes, group=profgroup)
+
+    def close(self):
+        '''
+        Write everything that is queued and stop the threads
+        '''
+        try:
+            self.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+
+
+# one writer per process
+WRITER = None
+
+
+def get_writer(config):
+    '''
+    Input:
+    config = dict of pipeline settings. config['write_threads'] is the number of writer threads (default 0: write in the calling thread),
+    config['write_queue'] the number of queued writes before the pipeline waits (default DEFAULT_QUEUE) and config['fsync'] to fsync every file
+
+    Output:
+    the writer of this process with these settings
+    '''
+    global WRITER
+    threads = int(config.get('write_threads', 0))
+    maxpending = int(config.get('write_queue', DEFAULT_QUEUE))
+    fsync = bool(config.get('fsync', False))
+    # a forked worker process inherits the object but not the threads of its parent
+    if WRITER is None or WRITER.pid != os.getpid() or (WRITER.threads, WRITER.maxpending, WRITER.fsync) != (threads, maxpending, fsync):
+        if WRITER is not None and WRITER.pid == os.getpid():
+            WRITER.close()
+        WRITER = AsyncWriter(threads, maxpending, fsync)
+    return WRITER
@@ -5,3 +5,35 @@ def mean(a, m):
 
 def std(a, m):
     return(np.std(a[np.where(m > 0)]))
+
+def roi_stats(imgs, labels, member):
+    '''
+    Input:
+    imgs = list of images with the same shape as labels
+    labels = label image of objects with 0 as background
+    member = boolean array (number of objects + 1, number of rois). True if the object is part of the plant in the roi. see src.segmentation.roiobjects.label_objects
+
+    Output:
+    avg = array (len(imgs), number of rois) with the mean of each image within each roi. nan if there are no pixels
+    std = array (len(imgs), number of rois) with the standard deviation
+    count = array (number of rois,) with the number of pixels in each roi
+
+    The sums for each object are computed with one np.bincount per image and then combined for each roi, so the cost does not grow with the number of rois.
+    '''
+    sel = np.flatnonzero(labels)
+    lab = labels.ravel()[sel]
+    nobj = member.shape[0]
+    m = member.astype(np.float64)
+
+    count = np.bincount(lab, minlength=nobj) @ m
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = []
+        std = []
+        for a in imgs:
+            vals = a.ravel()[sel].astype(np.float64)
+            s = np.bincount(lab, weights=vals, minlength=nobj) @ m
+            ss = np.bincount(lab, weights=vals * vals, minlength=nobj) @ m
+            mu = s / count
+            avg.append(mu)
+            std.append(np.sqrt(np.maximum(ss / count - mu * mu, 0)))
+    return np.array(avg), np.array(std), count
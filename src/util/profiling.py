@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import glob
+import time
+import contextlib
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# profiling state of this process. each worker process has its own records
+_enabled = False
+_group = None
+_records = []
+# running peak RSS of the open stages, innermost last. see stage()
+_peaks = []
+
+
+def enable(flag=True):
+    '''
+    Turn recording on or off for this process. While it is on, each stage() resets the peak RSS of the process on linux, see stage()
+    '''
+    global _enabled
+    _enabled = flag
+
+
+def set_group(group):
+    '''
+    Input:
+    group = label of the unit of work, e.g. treatment-sampleid-jobdate. stored with every record until changed
+    '''
+    global _group
+    _group = group
+
+
+def is_enabled():
+    '''
+    True while this process records, see enable()
+    '''
+    return _enabled
+
+
+def get_group():
+    '''
+    The label of the current unit of work, see set_group()
+    '''
+    return _group
+
+
+def _io_chars():
+    # bytes requested by read()/write() calls, whether or not they hit the page cache.
+    # on linux only those of the calling thread, so the files of the writer threads of src.util.asyncwriter are not counted in the stage that happens to be open
+    for fn in ('/proc/thread-self/io', '/proc/self/io'):
+        try:
+            with open(fn) as f:
+                io = dict(line.split(': ') for line in f.read().splitlines())
+            return int(io['rchar']), int(io['wchar'])
+        except (OSError, KeyError, ValueError):
+            pass
+    try:
+        import psutil
+        io = psutil.Process().io_counters()
+        return getattr(io, 'read_chars', io.read_bytes), getattr(io, 'write_chars', io.write_bytes)
+    except (ImportError, AttributeError):
+        return 0, 0
+
+
+def _rss_status():
+    # current and peak resident memory in MB from /proc on linux, None elsewhere
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if line.startswith(('VmRSS', 'VmHWM')))
+        return int(status['VmRSS'].split()[0]) / 2**10, int(status['VmHWM'].split()[0]) / 2**10
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _reset_peak():
+    # start a new peak RSS (VmHWM) on linux >= 4.0. False if the peak can not be reset
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _current_rss_mb():
+    status = _rss_status()
+    if status is not None:
+        return status[0]
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        return float('nan')
+
+
+def _peak_rss_mb():
+    # peak resident memory of the process so far
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macos
+        return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+    try:
+        import psutil
+        mem = psutil.Process().memory_info()
+        return getattr(mem, 'peak_wset', mem.rss) / 2**20
+    except ImportError:
+        return float('nan')
+
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+    Context manager that records wall time, bytes read/written, the peak RSS of a pipeline stage and the change of RSS from its start to its end.
+    Does nothing unless enable() was called.
+    On linux the peak (VmHWM) is reset at the start of each stage so it is the peak of the stage (including its nested stages). Elsewhere it is the peak of the process so far.
+    The reset is for the whole process, so only enable profiling in processes where nothing else reads VmHWM or ru_maxrss. Without enable() nothing is reset
+
+    Example:
+    with profiling.stage('psIImask'):
+        mask = createmasks.psIImask(img)
+    '''
+    if not _enabled:
+        yield
+        return
+
+    # the peak of the enclosing stage up to now, before it is reset for this stage
+    status = _rss_status()
+    if _peaks and status is not None:
+        _peaks[-1] = max(_peaks[-1], status[1])
+    perstage = status is not None and _reset_peak()
+    rss0 = _current_rss_mb()
+    _peaks.append(rss0)
+    rchar0, wchar0 = _io_chars()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - t0
+        rchar1, wchar1 = _io_chars()
+        rss1 = _current_rss_mb()
+        peak = _peaks.pop()
+        if perstage:
+            peak = max(peak, _rss_status()[1])
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], peak)
+        else:
+            peak = _peak_rss_mb()
+        _records.append({'group': _group,
+                         'stage': name,
+                         'wall_s': wall,
+                         'read_bytes': rchar1 - rchar0,
+                         'write_bytes': wchar1 - wchar0,
+                         'peak_rss_mb': peak,
+                         'rss_delta_mb': rss1 - rss0,
+                         'pid': os.getpid()})
+
+
+def record(name, wall_s, read_bytes=0, write_bytes=0, group=None):
+    '''
+    Add a record of work that was not timed with stage(), e.g. the files that the writer threads of src.util.asyncwriter wrote for a unit of work.
+    Does nothing unless enable() was called.
+
+    Input:
+    name = stage name in the report
+    wall_s = seconds spent, summed over threads
+    read_bytes, write_bytes = bytes read and written
+    group = label of the unit of work. None is the current group, see set_group()
+    '''
+    if not _enabled:
+        return
+    _records.append({'group': _group if group is None else group,
+                     'stage': name,
+                     'wall_s': wall_s,
+                     'read_bytes': read_bytes,
+                     'write_bytes': write_bytes,
+                     'peak_rss_mb': float('nan'),
+                     'rss_delta_mb': float('nan'),
+                     'pid': os.getpid()})
+
+
+def flush(profdir):
+    '''
+    Append the records of this process to profdir/<pid>.jsonl and clear them.
+    '''
+    global _records
+    if not _records:
+        return
+    os.makedirs(profdir, exist_ok=True)
+    with open(os.path.join(profdir, '%d.jsonl' % os.getpid()), 'a') as f:
+        for rec in _records:
+            f.write(json.dumps(rec) + '\n')
+    _records = []
+
+
+def report(profdir, outdir=None):
+    '''
+    Input:
+    profdir = directory with the records from flush()
+    outdir = optional directory for timing_records.csv (one row per stage per group), timing_summary.csv and timing_summary.json
+
+    Output:
+    dataframe with the summary of each stage. it is also printed.
+    '''
+    recs = []
+    for fn in sorted(glob.glob(os.path.join(profdir, '*.jsonl'))):
+        with open(fn) as f:
+            recs.extend(json.loads(line) for line in f)
+    if not recs:
+        print('No profiling records found in ' + profdir)
+        return None
+
+    df = pd.DataFrame(recs)
+    summary = (df.groupby('stage', sort=False)
+               .agg(calls=('wall_s', 'size'),
+                    total_s=('wall_s', 'sum'),
+                    mean_s=('wall_s', 'mean'),
+                    max_s=('wall_s', 'max'),
+                    read_mb=('read_bytes', lambda x: x.sum() / 2**20),
+                    write_mb=('write_bytes', lambda x: x.sum() / 2**20),
+                    peak_rss_mb=('peak_rss_mb', 'max'),
+                    max_rss_delta_mb=('rss_delta_mb', 'max'))
+               .sort_values('total_s', ascending=False))
+
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+        df.to_csv(os.path.join(outdir, 'timing_records.csv'), index=False)
+        summary.to_csv(os.path.join(outdir, 'timing_summary.csv'))
+        summary.reset_index().to_json(os.path.join(outdir, 'timing_summary.json'), orient='records', indent=1)
+
+    with pd.option_context('display.float_format', '{:.3f}'.format, 'display.width', 120):
+        print(summary)
+    return summary
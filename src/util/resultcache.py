@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+import sqlite3
+import pandas as pd
+
+# the settings in the pipeline config that change the results. output directories are deliberately not part of the key
+PARAMETER_KEYS = ['pixelresolution', 'maskmode', 'roi']
+
+# digests of the input files, e.g. in the manifest sqlite of src.data.manifest. a file is only read again if its size or modification time changed
+HASH_SCHEMA = '''CREATE TABLE IF NOT EXISTS hashes (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT NOT NULL)'''
+
+# increase when the computation of the results changes so old cache entries are not reused
+VERSION = 3
+
+
+def file_hash(fn, blocksize=2**20):
+    '''
+    Input:
+    fn = path to a file
+    blocksize = number of bytes read at a time
+
+    Output:
+    sha1 hex digest of the content of the file
+    '''
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_hashes(filenames, dbfile=None):
+    '''
+    Input:
+    filenames = list of files
+    dbfile = optional sqlite file that keeps the digests between runs, e.g. the manifest. None hashes every file
+
+    Output:
+    dict of filename -> sha1 hex digest. with dbfile only the files whose (size, mtime_ns) changed are read
+    '''
+    stats = {fn: os.stat(fn) for fn in set(filenames)}
+    if dbfile is None:
+        return {fn: file_hash(fn) for fn in stats}
+    # several worker processes may update the table at the same time
+    con = sqlite3.connect(dbfile, timeout=60)
+    try:
+        con.execute(HASH_SCHEMA)
+        out = {}
+        new = []
+        for fn, st in stats.items():
+            row = con.execute('SELECT size, mtime_ns, sha1 FROM hashes WHERE filename = ?', (fn,)).fetchone()
+            if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+                out[fn] = row[2]
+            else:
+                out[fn] = file_hash(fn)
+                new.append((fn, st.st_size, st.st_mtime_ns, out[fn]))
+        if new:
+            with con:
+                con.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)', new)
+    finally:
+        con.close()
+    return out
+
+
+def params_hash(config, pimframes):
+    '''
+    Input:
+    config = dict of pipeline settings. only the keys in PARAMETER_KEYS are used
+    pimframes = dataframe of pimframes_map.csv
+
+    Output:
+    sha1 hex digest of the settings that affect the results
+    '''
+    params = {k: config.get(k) for k in PARAMETER_KEYS}
+    params['pimframes'] = pimframes.astype(str).values.tolist()
+    params['version'] = VERSION
+    # json with sorted keys so the hash is the same between runs. tuples and lists serialize the same
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def cache_key(filenames, paramhash, unit, dbfile=None):
+    '''
+    Input:
+    filenames = input image files of one unit of work
+    paramhash = output of params_hash()
+    unit = label of the unit of work, e.g. treatment-sampleid-yyyymmdd. the cached rows carry treatment, sampleid and date so byte-identical files of another unit must not share the key
+    dbfile = optional sqlite file with the digests of unchanged files, see file_hashes()
+
+    Output:
+    sha1 hex digest combining the unit, the content of all files and the parameters
+    '''
+    h = hashlib.sha1(paramhash.encode())
+    h.update(unit.encode())
+    digests = file_hashes(filenames, dbfile)
+    for fn in sorted(digests):
+        h.update(digests[fn].encode())
+    return h.hexdigest()
+
+
+def load(cachedir, key):
+    '''
+    Output:
+    the cached dataframe for key or None if there is no cache entry
+    '''
+    fn = os.path.join(cachedir, key + '.pkl')
+    if not os.path.exists(fn):
+        return None
+    return pd.read_pickle(fn)
+
+
+def save(cachedir, key, df):
+    '''
+    Store df for key. The file is written to a temporary name first so an interrupted run never leaves a partial cache entry.
+    '''
+    os.makedirs(cachedir, exist_ok=True)
+    fn = os.path.join(cachedir, key + '.pkl')
+    tmpfn = fn + '.%d.tmp' % os.getpid()
+    df.to_pickle(tmpfn)
+    os.replace(tmpfn, fn)
@@ -1,7 +1,3 @@
-import numpy as np
-import pandas as pd
-
-
 def strip_dfwhitespace(df):
     '''
     Iterate through all columns of a dataframe and strip whitespace from fields
@@ -9,7 +5,7 @@ def strip_dfwhitespace(df):
 
     df = df.copy()
     for c in df.columns:
-        if df[c].dtype == np.object:
-            df[c] = pd.core.strings.str_strip(df[c])
+        if df[c].dtype == object:
+            df[c] = df[c].str.strip()
         df = df.rename(columns={c: c.strip()})
     return df
@@ -0,0 +1,166 @@
+import io
+import functools
+import threading
+import numpy as np
+import cv2 as cv2
+
+# 12 pt font at 150 dpi
+FONT_PX = 12 * 150 / 72.
+# the writer threads of src.util.asyncwriter render the figure of a new shape or colormap one at a time, matplotlib is not thread safe
+_layout_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_lut(cmap='imagingwin'):
+    '''
+    Input:
+        cmap - "imagingwin" (see custom_colormaps) or the name of any matplotlib colormap, e.g. "inferno"
+    Output:
+        a (N, 3) uint8 lookup table in BGR order for cv2 with one row per color of the colormap (236 for imagingwin, 256 for inferno)
+
+    matplotlib is only needed to build the table the first time each colormap is used.
+    '''
+    if cmap == 'imagingwin':
+        from src.viz import custom_colormaps
+        colors = custom_colormaps.get_colors(cmap)
+    else:
+        from matplotlib import cm
+        mplcmap = cm.get_cmap(cmap)
+        colors = mplcmap(np.arange(mplcmap.N))
+
+    lut = np.round(np.asarray(colors)[:, :3] * 255).astype(np.uint8)
+    return np.ascontiguousarray(lut[:, ::-1])
+
+
+def pseudocolor(img, mask, cmap='imagingwin', min_value=0, max_value=1):
+    '''
+    Input:
+        img - greyscale image, e.g. YII or NPQ
+        mask - binary mask. pixels outside the mask are black
+        cmap - see get_lut()
+        min_value, max_value - range of values spread over the colormap. values outside the range get the first/last color
+    Output:
+        BGR uint8 image
+    '''
+    lut = get_lut(cmap)
+    ncolors = len(lut)
+    # same binning as a matplotlib colormap with ncolors colors
+    idx = (img.astype(np.float32) - min_value) * (float(ncolors) / (max_value - min_value))
+    idx = np.clip(np.nan_to_num(idx, nan=0), 0, ncolors - 1).astype(np.intp)
+    rgb = lut[idx]
+    rgb[mask == 0] = 0
+    return rgb
+
+
+def figure_layout(shape, cmap='imagingwin', min_value=0, max_value=1):
+    '''
+    Input:
+        shape - (height, width) of the images
+        cmap, min_value, max_value - see pseudocolor()
+    Output:
+        canvas - BGR uint8 image of the pseudocolor figure of src.analysis.psII.save_pseudocolor() with matplotlib: pcv.visualize.pseudocolor
+                 (black image, colorbar with its ticks), set_size_inches(6, 6) and savefig(bbox_inches='tight', dpi=150). read only
+        box - (x, y, width, height) of the image in canvas
+
+    matplotlib renders the figure once per shape and colormap in each process, every image is then pasted into a copy of the canvas,
+    so the pngs have the same size and layout as those of matplotlib and the annotations of scripts/makeVideos.R stay in place.
+    '''
+    with _layout_lock:
+        return _figure_layout(tuple(shape), cmap, min_value, max_value)
+
+
+@functools.lru_cache(maxsize=None)
+def _figure_layout(shape, cmap, min_value, max_value):
+    import logging
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from src.viz import custom_colormaps
+    # the same text as the matplotlib renderer, without a warning in every process if Arial is not installed
+    logging.getLogger('matplotlib.font_manager').setLevel(logging.ERROR)
+    mplcmap = custom_colormaps.get_cmap(cmap) if cmap == 'imagingwin' else cmap
+    # a figure without pyplot so the figures of the main thread are not touched
+    with matplotlib.rc_context({'font.family': 'Arial'}):
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.imshow(np.zeros(shape, dtype=np.uint8), cmap='gray')
+        im = ax.imshow(np.ma.array(np.zeros(shape), mask=True), cmap=mplcmap, vmin=min_value, vmax=max_value)
+        # as in pcv.visualize.pseudocolor of plantcv 3.6 with axes=False
+        fig.colorbar(im, ax=ax, fraction=0.033, pad=0.04)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        fig.set_size_inches(6, 6, forward=False)
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', bbox_inches='tight', dpi=150)
+    canvas = cv2.imdecode(np.frombuffer(buf.getvalue(), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    # the black image is the largest dark object, the colorbar is apart from it
+    _, _, cstats, _ = cv2.connectedComponentsWithStats((canvas.max(axis=2) < 64).astype(np.uint8), connectivity=8)
+    x, y, width, height = (int(v) for v in cstats[1 + np.argmax(cstats[1:, cv2.CC_STAT_AREA]), :4])
+    canvas.setflags(write=False)
+    return canvas, (x, y, width, height)
+
+
+def render(img, mask, cmap, min_value, max_value, pixelresolution, barwidth=20):
+    '''
+    Input:
+        img, mask, cmap, min_value, max_value - see pseudocolor()
+        pixelresolution, barwidth - see add_scalebar()
+    Output:
+        BGR uint8 image with the same size and layout as the matplotlib figure, see figure_layout()
+    '''
+    canvas, (x, y, width, height) = figure_layout(img.shape[:2], cmap, min_value, max_value)
+    rgb = cv2.resize(pseudocolor(img, mask, cmap, min_value, max_value), (width, height), interpolation=cv2.INTER_NEAREST)
+    add_scalebar(rgb, pixelresolution, barwidth, float(width) / img.shape[1])
+    out = canvas.copy()
+    # the antialiased edge of the black frame around the image stays
+    box = out[y:y + height, x:x + width]
+    np.copyto(box, rgb, where=~box.any(axis=2, keepdims=True))
+    return out
+
+
+def add_scalebar(rgb, pixelresolution, barwidth=20, scale=1.):
+    '''
+    Input:
+        rgb - BGR image to draw on (modified in place)
+        pixelresolution - mm per pixel of the original image
+        barwidth - length of the bar in mm
+        scale - output pixels per original pixel
+    Output:
+        rgb with a white scalebar and label in the lower left, like src.viz.add_scalebar
+    '''
+    barlabel = str(int(barwidth/10)) + ' cm'
+    pad = int(round(0.5 * FONT_PX))
+    barlength = int(round(barwidth / pixelresolution * scale))
+    barheight = max(1, int(round(barlength / 30.)))
+
+    # bold 12 pt text
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    thickness = 2
+    (tw, th), baseline = cv2.getTextSize(barlabel, font, 1, thickness)
+    fontscale = 0.7 * FONT_PX / th
+    (tw, th), baseline = cv2.getTextSize(barlabel, font, fontscale, thickness)
+
+    h = rgb.shape[0]
+    texty = h - pad - baseline
+    bary1 = texty - th - int(round(5 * 150 / 72.))  # sep=5 pt between bar and label
+    bary0 = bary1 - barheight
+    cv2.rectangle(rgb, (pad, bary0), (pad + barlength, bary1), (255, 255, 255), thickness=-1)
+    textx = pad + max(0, (barlength - tw) // 2)
+    cv2.putText(rgb, barlabel, (textx, texty), font, fontscale, (255, 255, 255), thickness, cv2.LINE_AA)
+    return rgb
+
+
+def save_pseudocolor(fn, img, mask, cmap, min_value, max_value, pixelresolution, barwidth=20):
+    '''
+    Input:
+        fn - output png filename
+        img, mask, cmap, min_value, max_value - see pseudocolor()
+        pixelresolution, barwidth - see add_scalebar()
+    Output:
+        True if the png was written (the return value of cv2.imwrite). The png has the size and colorbar of the matplotlib figure, see render()
+    '''
+    rgb = render(img, mask, cmap, min_value, max_value, pixelresolution, barwidth)
+    # low png compression, the encode is the most expensive step
+    return cv2.imwrite(fn, rgb, [cv2.IMWRITE_PNG_COMPRESSION, 1])
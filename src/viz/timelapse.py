@@ -0,0 +1,271 @@
+import os
+import glob
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import cv2 as cv2
+
+from src.data import arraystore
+from src.data import pixelstore
+from src.segmentation import roilayout
+from src.viz import lut_pseudocolor
+
+# colormap and range of each pseudocolor image, the same as src.analysis.psII.save_pseudocolor()
+# suffix of the float32 tifs written to fluordir. for FvFm the YII image is _fvfm.tif
+KINDS = {'YII': {'cmap': 'imagingwin', 'min_value': 0, 'max_value': 1, 'suffix': 'yii'},
+         'NPQ': {'cmap': 'inferno', 'min_value': 0, 'max_value': 2.5, 'suffix': 'npq'}}
+# 24 px bold labels like the magick annotations of scripts/makeVideos.R
+LABEL_PX = 24
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+THICKNESS = 2
+
+
+def tif_name(fluordir, treatment, date, sampleid, parameter, kind):
+    '''
+    Output:
+    path of the YII or NPQ tif that src.analysis.psII wrote for this sample-day and parameter
+    '''
+    suffix = 'fvfm' if parameter == 'FvFm' and kind == 'YII' else KINDS[kind]['suffix']
+    return os.path.join(fluordir, sampleid, '%s-%s-%s-%s_%s.tif' % (treatment, pd.Timestamp(date).strftime('%Y%m%d'), sampleid, parameter, suffix))
+
+
+def mask_name(maskdir, treatment, date, sampleid):
+    '''
+    Output:
+    path of the mask of all plants of this sample-day. see src.analysis.psII.fvfm_avg()
+    '''
+    return os.path.join(maskdir, '%s-%s-%s-FvFm_mask.png' % (treatment, pd.Timestamp(date).strftime('%Y%m%d'), sampleid))
+
+
+def load_frame(fluordir, maskdir, treatment, date, sampleid, parameter, kind):
+    '''
+    Output:
+    img = float32 YII or NPQ image exactly as computed by the pipeline
+    mask = uint8 mask of all plants
+    '''
+    img = cv2.imread(tif_name(fluordir, treatment, date, sampleid, parameter, kind), cv2.IMREAD_UNCHANGED)
+    mask = cv2.imread(mask_name(maskdir, treatment, date, sampleid), cv2.IMREAD_GRAYSCALE)
+    if img is None or mask is None:
+        raise FileNotFoundError('No %s image of %s for %s-%s-%s' % (kind, parameter, treatment, pd.Timestamp(date).strftime('%Y%m%d'), sampleid))
+    return img, mask
+
+
+def dates(fluordir, treatment, sampleid, parameter, kind):
+    '''
+    Output:
+    sorted list of the dates that have a YII or NPQ image of parameter
+    '''
+    pattern = tif_name(fluordir, treatment, '2000-01-01', sampleid, parameter, kind).replace('20000101', '*')
+    return sorted(pd.Timestamp(os.path.basename(fn).split('-')[1]) for fn in glob.glob(pattern))
+
+
+def _fontscale():
+    # scale of the hershey font so capital letters are LABEL_PX*0.7 high, like a 24 px font
+    (_, th), _ = cv2.getTextSize('W', FONT, 1, THICKNESS)
+    return 0.7 * LABEL_PX / th
+
+
+def _text(rgb, text, org, italic=False, center=False, right=False):
+    fontscale = _fontscale()
+    font = FONT | cv2.FONT_ITALIC if italic else FONT
+    (tw, th), _ = cv2.getTextSize(text, font, fontscale, THICKNESS)
+    x, y = org
+    if center:
+        x = x - tw // 2
+    elif right:
+        x = x - tw
+    # org is the top left corner as in magick's gravity NorthWest
+    cv2.putText(rgb, text, (int(x), int(y + th)), font, fontscale, (255, 255, 255), THICKNESS, cv2.LINE_AA)
+
+
+def render_frame(img, mask, kind, pixelresolution, title, datelabel, gtypes=None, roi=None):
+    '''
+    Input:
+    img, mask = see load_frame()
+    kind = 'YII' or 'NPQ'
+    pixelresolution = mm per pixel, for the scalebar
+    title = label in the upper left, e.g. "tray2 fluc"
+    datelabel = label in the upper right, e.g. "2019-08-01"
+    gtypes = dict of roi number -> genotype. WT is upright and mutants italic
+    roi = roi layout of this sample, see src.segmentation.roilayout. genotypes are written above each roi
+
+    Output:
+    BGR uint8 frame with the same size and layout as the pseudocolor pngs, see lut_pseudocolor.render()
+    '''
+    opts = KINDS[kind]
+    rgb = lut_pseudocolor.render(img, mask, opts['cmap'], opts['min_value'], opts['max_value'], pixelresolution, 20)
+    _, (x, y, width, _) = lut_pseudocolor.figure_layout(img.shape[:2], opts['cmap'], opts['min_value'], opts['max_value'])
+    scale = float(width) / img.shape[1]
+
+    if gtypes and roi is not None:
+        for roinum, shape in enumerate(roilayout.expand(roi)):
+            if roinum not in gtypes:
+                continue
+            gtype = gtypes[roinum]
+            x0, y0, x1, _ = roilayout.bounds(shape)
+            _text(rgb, gtype, (x + (x0 + x1) / 2. * scale, y + max(0, y0 * scale - LABEL_PX - 4)),
+                  italic=gtype.upper() != 'WT', center=True)
+
+    # the title where scripts/makeVideos.R puts it, the date ends at the right edge of the image instead of running into the colorbar
+    _text(rgb, title, (30, 20))
+    _text(rgb, datelabel, (x + width - 15, 20), right=True)
+    return rgb
+
+
+class VideoWriter:
+    '''
+    Stream BGR frames into a video file. Frames are encoded as they are written so only one frame is in memory.
+    Uses the ffmpeg executable over a pipe if it is on the PATH and imageio otherwise (.gif works without ffmpeg).
+
+    Input:
+    fn = output file, e.g. .mp4 or .gif
+    fps = frames per second
+    '''
+
+    def __init__(self, fn, fps=2):
+        self.fn = fn
+        self.fps = fps
+        self._proc = None
+        self._writer = None
+
+    def _open(self, frame):
+        h, w = frame.shape[:2]
+        if shutil.which('ffmpeg') and not self.fn.endswith('.gif'):
+            cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d' % (w, h), '-r', str(self.fps), '-i', '-',
+                   # h264 needs an even width and height
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white',
+                   '-c:v', 'libx264', '-pix_fmt', 'yuv420p', self.fn]
+            self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        else:
+            import imageio
+            if self.fn.endswith('.gif'):
+                self._writer = imageio.get_writer(self.fn, mode='I', duration=1. / self.fps)
+            else:
+                self._writer = imageio.get_writer(self.fn, fps=self.fps)
+
+    def write(self, frame):
+        if self._proc is None and self._writer is None:
+            self._open(frame)
+        if self._proc is not None:
+            self._proc.stdin.write(np.ascontiguousarray(frame).tobytes())
+        else:
+            self._writer.append_data(frame[:, :, ::-1])
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            if self._proc.wait() != 0:
+                raise RuntimeError('ffmpeg failed to write %s' % self.fn)
+        elif self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def make_video(outfn, samples, parameter, kind, config, gtypeinfo, fps=2):
+    '''
+    Input:
+    outfn = video file
+    samples = list of (treatment, sampleid) that are shown side by side, e.g. [('control', 'tray1'), ('fluc', 'tray2')]
+    parameter = e.g. 'FvFm' or 't300_ALon'
+    kind = 'YII' or 'NPQ'
+    config = dict of pipeline settings of scripts/ProcessImages.py. uses fluordir and maskdir, or arraystore or else pixelstore if set, pixelresolution and the roi layouts.
+    no tifs are written with an array or pixel store so the frames are read from the store
+    gtypeinfo = dataframe of genotype_map.csv
+    fps = frames per second
+
+    Output:
+    number of frames. one frame per date that all samples have in common. the side effect is the video file
+    '''
+    store = arraystore.ArrayStore(config['arraystore']) if config.get('arraystore') else None
+    pixels = pixelstore.PixelStore(config['pixelstore']) if store is None and config.get('pixelstore') else None
+    common = None
+    for treatment, sampleid in samples:
+        if store is not None:
+            d = set(store.dates(treatment, sampleid)) if (treatment, sampleid) in store.samples() else set()
+        elif pixels is not None:
+            d = set(pixels.dates(treatment, sampleid))
+        else:
+            d = set(dates(config['fluordir'], treatment, sampleid, parameter, kind))
+        common = d if common is None else common & d
+    common = sorted(common)
+    if not common:
+        return 0
+
+    if store is not None:
+        # one read of all dates of each sample instead of one file per frame
+        blocks = [(store.read(treatment, sampleid, kind.lower(), dates=common, parameters=[parameter])[:, 0],
+                   store.read(treatment, sampleid, 'mask', dates=common))
+                  for treatment, sampleid in samples]
+
+    labels = []
+    for treatment, sampleid in samples:
+        g = gtypeinfo[(gtypeinfo.treatment == treatment) & (gtypeinfo.sampleid == sampleid)]
+        labels.append(dict(zip(g.roi.astype(int), g.gtype.astype(str))))
+
+    os.makedirs(os.path.dirname(outfn) or '.', exist_ok=True)
+    with VideoWriter(outfn, fps) as writer:
+        for i, date in enumerate(common):
+            frames = []
+            for k, ((treatment, sampleid), gtypes) in enumerate(zip(samples, labels)):
+                if store is not None:
+                    img, mask = blocks[k][0][i], blocks[k][1][i]
+                elif pixels is not None:
+                    img, mask = pixels.frame(treatment, sampleid, date, parameter, kind.lower())
+                else:
+                    img, mask = load_frame(config['fluordir'], config['maskdir'], treatment, date, sampleid, parameter, kind)
+                frames.append(render_frame(img, mask, kind, config['pixelresolution'],
+                                           title='%s %s' % (sampleid, treatment),
+                                           datelabel=date.strftime('%Y-%m-%d'),
+                                           gtypes=gtypes, roi=roilayout.layout_for(config['roi'], sampleid)))
+            writer.write(np.hstack(frames))
+    return len(common)
+
+
+def pairs(gtypeinfo, control='control'):
+    '''
+    Output:
+    list of [(control, sampleid), (treatment, sampleid)] for every combination of a control and a treated sample, like scripts/makeVideos.R
+    '''
+    samples = gtypeinfo[['treatment', 'sampleid']].drop_duplicates().values.tolist()
+    cntrl = [tuple(s) for s in samples if s[0] == control]
+    treated = [tuple(s) for s in samples if s[0] != control]
+    return [[c, t] for t in treated for c in cntrl]
+
+
+def _make_video(args):
+    # unpack for ProcessPoolExecutor.map
+    outfn, samples, parameter, kind, config, gtypeinfo, fps = args
+    return outfn, make_video(outfn, samples, parameter, kind, config, gtypeinfo, fps)
+
+
+def make_videos(outdir, config, gtypeinfo, parameters=(('FvFm', 'YII'), ('t300_ALon', 'YII'), ('t300_ALon', 'NPQ')), fps=2, ext='.mp4', workers=1):
+    '''
+    Input:
+    outdir = directory for the videos, e.g. output/from_diy_data/timelapse
+    config, gtypeinfo, fps = see make_video()
+    parameters = list of (parameter, kind)
+    ext = '.mp4' (needs ffmpeg or imageio-ffmpeg) or '.gif'
+    workers = number of processes. each process encodes one video at a time
+
+    Output:
+    list of (video file, number of frames)
+    '''
+    jobs = []
+    for parameter, kind in parameters:
+        for samples in pairs(gtypeinfo):
+            (_, sampleid_c), (treatment_t, sampleid_t) = samples
+            outfn = os.path.join(outdir, '%s_%s_%s_x_%s_%s%s' % (parameter, kind, sampleid_c, sampleid_t, treatment_t, ext))
+            jobs.append((outfn, samples, parameter, kind, config, gtypeinfo, fps))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(_make_video, jobs))
+    return [_make_video(job) for job in jobs]